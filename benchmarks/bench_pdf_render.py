@@ -0,0 +1,125 @@
+"""
+Latency and peak memory of the PDF export on large scans:
+legacy (overlay + PIL image to PDF + PyPDF2 merge) vs the single pass renderer.
+
+    python benchmarks/bench_pdf_render.py --width 5100 --height 6600 --fields 60 --repeat 5
+
+Every variant runs in a fresh process so ru_maxrss only sees its own allocations.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import random
+import resource
+import time
+
+
+def make_scan(width, height, quality=85):
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    rng = random.Random(0)
+    # Text-like noise so the JPEG is about as large as a real scan
+    for _ in range(width * height // 400):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle((x, y, x + rng.randrange(2, 12), y + rng.randrange(2, 6)), fill=(20, 20, 20))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def make_fields(count):
+    rng = random.Random(1)
+    fields = {}
+    for i in range(count):
+        fields[f"Field {i}"] = {
+            "BoundingBox": {"Left": rng.uniform(0, 0.7), "Top": rng.uniform(0, 0.95), "Width": 0.25, "Height": 0.02},
+            "Value": f"value {i} " * rng.randrange(1, 4),
+        }
+    return fields
+
+
+def legacy_render(image_bytes, key_value_pairs_obj):
+    from PIL import Image
+    from PyPDF2 import PdfFileReader, PdfFileWriter
+    from quickfill.pdf.render import draw_form_fields
+    from reportlab.pdfgen import canvas
+
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        page_size = img.size
+    packet = io.BytesIO()
+    can = canvas.Canvas(packet, pagesize=page_size)
+    draw_form_fields(can, key_value_pairs_obj, page_size)
+    can.save()
+    packet.seek(0)
+    form_pdf = PdfFileReader(packet)
+
+    image_pdf = io.BytesIO()
+    Image.open(io.BytesIO(image_bytes)).convert('RGB').save(image_pdf, format='PDF')
+    image_pdf.seek(0)
+    input_pdf = PdfFileReader(image_pdf)
+
+    output = PdfFileWriter()
+    page = input_pdf.getPage(0)
+    page.mergePage(form_pdf.getPage(0))
+    output.addPage(page)
+    output_pdf_bytes = io.BytesIO()
+    output.write(output_pdf_bytes)
+    output_pdf_bytes.seek(0)
+    return output_pdf_bytes
+
+
+def single_pass_render(image_bytes, key_value_pairs_obj):
+    from quickfill.pdf.render import render_filled_pdf
+    return render_filled_pdf(image_bytes, key_value_pairs_obj)
+
+
+VARIANTS = {"legacy": legacy_render, "single_pass": single_pass_render}
+
+
+def _run_variant(name, image_bytes, fields, repeat, queue):
+    render = VARIANTS[name]
+    render(make_scan(64, 64), fields)  # Warm up imports before taking the RSS baseline
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = render(image_bytes, fields)
+        timings.append(time.perf_counter() - start)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({
+        "variant": name,
+        "mean_ms": round(sum(timings) / len(timings) * 1000, 2),
+        "min_ms": round(min(timings) * 1000, 2),
+        "peak_rss_delta_mb": round((peak_kb - baseline_kb) / 1024, 2),
+        "output_bytes": len(output.getvalue()),
+    })
+
+
+def run(width, height, fields, repeat):
+    image_bytes = make_scan(width, height)
+    key_value_pairs_obj = make_fields(fields)
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in VARIANTS:
+        queue = context.Queue()
+        process = context.Process(target=_run_variant, args=(name, image_bytes, key_value_pairs_obj, repeat, queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"{name} failed with exit code {process.exitcode}")
+        results.append(queue.get())
+    return {"image": {"width": width, "height": height, "bytes": len(image_bytes)}, "fields": fields,
+            "repeat": repeat, "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=5100)  # Letter page at 600 dpi
+    parser.add_argument("--height", type=int, default=6600)
+    parser.add_argument("--fields", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.width, args.height, args.fields, args.repeat), indent=2))
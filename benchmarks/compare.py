@@ -0,0 +1,74 @@
+"""
+Compares two result files of benchmarks/run.py, metric by metric.
+
+    python -m benchmarks.compare before.json after.json --threshold 10
+
+Exits with 1 when a metric got worse by more than --threshold percent, so it can gate CI.
+Throughput and hit ratios are better when higher, every other metric when lower.
+"""
+import argparse
+import json
+import sys
+
+# Compared metrics, the rest (min / max, request counts, statuses) is too noisy or informational
+METRICS = ("wall_ms.p50", "wall_ms.p95", "cpu_ms.mean", "peak_rss_delta_mb", "request_peak_rss_mb.max",
+           "throughput_rps", "latency_ms.p50", "latency_ms.p95", "cpu_ms_per_request", "errors",
+           "textract_calls", "llm_calls", "ocr_hit_ratio", "fill_hit_ratio", "worker_peak_rss_mb")
+HIGHER_IS_BETTER = ("throughput_rps", "hit_ratio")
+
+
+def flatten(results, prefix=""):
+    items = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            items.update(flatten(value, f"{path}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items[path] = value
+    return items
+
+
+def compare(before, after, threshold=10.0):
+    '''
+    Returns [(metric, before, after, change in percent, regressed)] of the metrics found in both runs.
+    '''
+    before = flatten({key: value for key, value in before.items() if key != "meta"})
+    after = flatten({key: value for key, value in after.items() if key != "meta"})
+    rows = []
+    for path in sorted(before.keys() & after.keys()):
+        if not path.endswith(METRICS):
+            continue
+        old, new = before[path], after[path]
+        if old == new:
+            change = 0.0
+        elif old == 0:
+            change = float("inf")
+        else:
+            change = (new - old) / abs(old) * 100
+        worse = -change if path.endswith(HIGHER_IS_BETTER) else change
+        if path.endswith("errors"):
+            regressed = new > old
+        elif "rss" in path:
+            regressed = worse > threshold and new - old > 1  # Ignore allocator noise below 1MB
+        else:
+            regressed = worse > threshold
+        rows.append((path, old, new, change, regressed))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Regression threshold, in percent")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    rows = compare(before, after, args.threshold)
+    width = max((len(row[0]) for row in rows), default=0)
+    for path, old, new, change, regressed in rows:
+        print(f"{path:<{width}}  {old:>12}  {new:>12}  {change:>+9.1f}%{'  REGRESSION' if regressed else ''}")
+    sys.exit(1 if any(row[4] for row in rows) else 0)
@@ -0,0 +1,142 @@
+"""
+End-to-end throughput of the FastAPI endpoints, in process through httpx's ASGI transport,
+with Textract and the LLM replaced by the recorded stand-ins (see benchmarks/stand_ins.py).
+
+Every request uploads its own copy of the scans, so OCR and fill caches never hit unless --cached is given.
+Each endpoint runs in a fresh process, at each concurrency level in turn.
+At concurrency 1, request_peak_rss_mb is how far the RSS rose above its level before each request.
+"""
+import asyncio
+import contextlib
+import json
+import time
+
+from benchmarks import stand_ins
+from benchmarks.measure import RSSSampler, peak_rss_kb, run_isolated, summarize
+
+JPEG = "image/jpeg"
+
+
+def _files(**scans):
+    return {field: (f"{field}.jpg", data, JPEG) for field, data in scans.items()}
+
+
+def _requests(form_a, form_b):
+    # Endpoint -> n -> httpx request kwargs. form_a / form_b are n -> scan bytes
+    form_b_schema = json.dumps(stand_ins.RecordedLLM().extraction)
+    form_a_text = "My name is Steven Paul Jobs, born on 02/24/1955. I live at 2066 Crist Dr, Los Altos, CA 94024."
+    return {
+        "/ping": lambda n: {"method": "GET", "url": "/ping"},
+        "/analyze_identity_documents": lambda n: {
+            "method": "POST", "url": "/analyze_identity_documents",
+            "params": {"return_type": "key_value_pairs"}, "files": _files(file=form_a(n))},
+        "/general_fill_form": lambda n: {
+            "method": "POST", "url": "/general_fill_form",
+            "params": {"form_a_text": f"{form_a_text} #{n}", "form_b_text": form_b_schema, "use_cache": "false"}},
+        "/ai_fill_form_template": lambda n: {
+            "method": "POST", "url": "/ai_fill_form_template",
+            "params": {"form_b_schema": form_b_schema, "use_cache": "false"}, "files": _files(file=form_a(n))},
+        "/ai_fill_form_template/batch": lambda n: {
+            "method": "POST", "url": "/ai_fill_form_template/batch", "params": {"use_cache": "false"},
+            "data": {"form_b_schema": form_b_schema},
+            "files": [("files", (f"a{n}_{i}.jpg", form_a(n * 10 + i), JPEG)) for i in range(4)]},
+        "/ai_process_form/": lambda n: {
+            "method": "POST", "url": "/ai_process_form/", "params": {"use_cache": "false"},
+            "data": {"text_description": form_a_text}, "files": _files(file=form_b(n))},
+        "/general_fill_form_files": lambda n: {
+            "method": "POST", "url": "/general_fill_form_files", "params": {"use_cache": "false"},
+            "files": _files(form_a_file=form_a(n), form_b_file=form_b(n))},
+        "/gpt4v_general_fill_form_files": lambda n: {
+            "method": "POST", "url": "/gpt4v_general_fill_form_files", "params": {"use_cache": "false"},
+            "files": _files(form_a_file=form_a(n), form_b_file=form_b(n))},
+        "/batch_fill_form_files": lambda n: {
+            "method": "POST", "url": "/batch_fill_form_files", "params": {"use_cache": "false"},
+            "files": [("form_a_files", (f"a{n}.jpg", form_a(n), JPEG))]
+                     + [("form_b_files", (f"b{n}_{i}.jpg", form_b(n * 10 + i), JPEG)) for i in range(3)]},
+    }
+
+
+ENDPOINTS = list(_requests(None, None))
+
+
+async def _load(client, make_request, concurrency, requests, offset):
+    latencies, statuses, request_rss_kb = [], {}, []
+    next_request = iter(range(offset, offset + requests))
+
+    async def worker():
+        for n in next_request:
+            request = make_request(n)
+            start = time.perf_counter()
+            # One request at a time, so the process' RSS growth is that request's
+            with RSSSampler() if concurrency == 1 else contextlib.nullcontext() as rss:
+                try:
+                    response = await client.request(**request)
+                    status = str(response.status_code)
+                except Exception as e:
+                    status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            if rss is not None and rss.peak_delta_kb is not None:
+                request_rss_kb.append(rss.peak_delta_kb)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start, start_cpu = time.perf_counter(), time.process_time()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+    errors = sum(count for status, count in statuses.items() if not status.startswith("2"))
+    result = {
+        "requests": requests,
+        "throughput_rps": round(requests / wall, 2),
+        "latency_ms": summarize(latencies),
+        "cpu_ms_per_request": round(cpu / requests * 1000, 3),
+        "errors": errors,
+        "statuses": statuses,
+    }
+    if request_rss_kb:
+        result["request_peak_rss_mb"] = {"mean": round(sum(request_rss_kb) / len(request_rss_kb) / 1024, 2),
+                                         "max": round(max(request_rss_kb) / 1024, 2)}
+    return result
+
+
+async def _measure(endpoint, concurrency_levels, requests, cached):
+    import httpx
+    from quickfill.executor import shutdown_executors
+    from quickfill.main import app
+
+    form_a_scan = stand_ins.make_scan(stand_ins.FORM_A_SIZE)
+    form_b_scan = stand_ins.make_scan(stand_ins.FORM_B_SIZE, seed=1)
+    if cached:
+        form_a, form_b = (lambda n: form_a_scan), (lambda n: form_b_scan)
+    else:
+        form_a, form_b = (lambda n: stand_ins.unique(form_a_scan, n)), (lambda n: stand_ins.unique(form_b_scan, n))
+    make_request = _requests(form_a, form_b)[endpoint]
+
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    results = {}
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://quickfill") as client:
+            await _load(client, make_request, 1, 1, -1)  # Warm up before taking the RSS baseline
+            baseline_kb = peak_rss_kb()
+            offset = 0
+            for concurrency in concurrency_levels:
+                count = max(requests, concurrency)
+                results[str(concurrency)] = await _load(client, make_request, concurrency, count, offset)
+                offset += count
+    finally:
+        shutdown_executors(wait=True)
+    results["peak_rss_delta_mb"] = round((peak_rss_kb() - baseline_kb) / 1024, 2)
+    return results
+
+
+def measure_endpoint(endpoint, concurrency_levels, requests, textract_latency, llm_latency, cached=False):
+    import quickfill.main  # noqa: F401, the stand-ins patch the app's template registry too
+
+    stand_ins.install(textract_latency=textract_latency, llm_latency=llm_latency)
+    return asyncio.run(_measure(endpoint, concurrency_levels, requests, cached))
+
+
+def run_endpoints(names=None, concurrency_levels=(1, 4, 16), requests=16, textract_latency=0.25,
+                  llm_latency=0.5, cached=False):
+    return {name: run_isolated(measure_endpoint, name, tuple(concurrency_levels), requests, textract_latency,
+                               llm_latency, cached)
+            for name in (names or ENDPOINTS)}
@@ -0,0 +1,83 @@
+import multiprocessing
+import os
+import resource
+import threading
+
+
+def peak_rss_kb():
+    # High-water mark of this process, in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def current_rss_kb():
+    # Resident set size right now, None where /proc isn't available
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return None
+
+
+class RSSSampler:
+    '''
+    Samples the resident set size on a background thread while the block runs.
+    peak_delta_kb is the highest sample above the one taken on entry, ru_maxrss can't be reset between requests.
+    '''
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.peak_delta_kb = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self, start):
+        peak = start
+        while not self._stop.wait(self.interval):
+            peak = max(peak, current_rss_kb())
+        self.peak_delta_kb = max(peak, current_rss_kb()) - start
+
+    def __enter__(self):
+        start = current_rss_kb()
+        if start is not None:
+            self._thread = threading.Thread(target=self._sample, args=(start,), daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def summarize(seconds):
+    # Milliseconds, rounded for readable diffs
+    values = sorted(seconds)
+    return {
+        "mean": round(sum(values) / len(values) * 1000, 3),
+        "p50": round(percentile(values, 0.5) * 1000, 3),
+        "p95": round(percentile(values, 0.95) * 1000, 3),
+        "min": round(values[0] * 1000, 3),
+        "max": round(values[-1] * 1000, 3),
+    }
+
+
+def _child(target, args, queue):
+    queue.put(target(*args))
+
+
+def run_isolated(target, *args):
+    '''
+    Runs target(*args) in a fresh spawned process and returns its result,
+    so ru_maxrss only sees that benchmark's allocations.
+    '''
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_child, args=(target, args, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"{target.__name__}{args} failed with exit code {process.exitcode}")
+    return queue.get()
@@ -0,0 +1,79 @@
+"""
+Offline benchmark suite: per-stage costs and end-to-end endpoint throughput,
+on recorded Textract / OpenAI responses replayed with injected latency. Run from the repo root:
+
+    python -m benchmarks.run --output before.json
+    python -m benchmarks.run --output after.json
+    python -m benchmarks.compare before.json after.json
+
+    python -m benchmarks.run --stages ocr.text pdf.export --skip-endpoints
+    python -m benchmarks.run --skip-stages --endpoints /general_fill_form_files --concurrency 1 8 32 \\
+        --textract-latency 0.8 --llm-latency 3
+    python -m benchmarks.run --skip-stages --skip-endpoints --workers 1 4 8
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from benchmarks.endpoints import ENDPOINTS, run_endpoints
+from benchmarks.stages import STAGES, run_stages
+from benchmarks.workers import run_workers
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": {key: value for key, value in vars(args).items() if key != "output"},
+        },
+    }
+    if not args.skip_stages:
+        results["stages"] = run_stages(args.stages, repeat=args.repeat)
+    if not args.skip_endpoints:
+        results["endpoints"] = run_endpoints(args.endpoints, concurrency_levels=args.concurrency,
+                                             requests=args.requests, textract_latency=args.textract_latency,
+                                             llm_latency=args.llm_latency, cached=args.cached)
+    if not args.skip_workers:
+        results["workers"] = run_workers(args.workers, textract_latency=args.textract_latency,
+                                         llm_latency=args.llm_latency)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), help="Default: all")
+    parser.add_argument("--repeat", type=int, default=20, help="Samples per stage")
+    parser.add_argument("--skip-stages", action="store_true")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, help="Default: all")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=16, help="Requests per concurrency level")
+    parser.add_argument("--textract-latency", type=float, default=0.25, help="Seconds per Textract call")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds per LLM call")
+    parser.add_argument("--cached", action="store_true", help="Upload the same scans every time")
+    parser.add_argument("--skip-endpoints", action="store_true")
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4],
+                        help="Worker processes sharing the caches, see benchmarks/workers.py")
+    parser.add_argument("--skip-workers", action="store_true")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    results = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(results + "\n")
+    else:
+        sys.stdout.write(results + "\n")
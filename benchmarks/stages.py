@@ -0,0 +1,187 @@
+"""
+Per-stage benchmarks: wall time, CPU time and peak RSS of each step of a fill,
+on the recorded fixtures (see benchmarks/stand_ins.py). Every stage runs in a fresh process.
+
+    ocr.<return type>       api_analyze_document on a new image, Textract answers from the fixture
+    schema.flatten_keys     flatten_keys of a nested form b schema
+    schema.build            extraction_schema + chunk_schema, what happens before the LLM calls
+    json.parse_response     parse_json_response of a recorded completion
+    json.incremental        IncrementalJSONParser over the same completion, fed in streaming sized chunks
+    pdf.fill_in_forms       Form field overlay
+    pdf.layout.<n>          layout_fields of a page of n fields, values from a few characters to a paragraph
+    pdf.fields.<n>          fill_in_forms of the same page, layout plus reportlab
+    pdf.export              export_pdf_through_json of a filled scan
+"""
+import random
+import time
+
+from benchmarks import stand_ins
+from benchmarks.measure import peak_rss_kb, run_isolated, summarize
+
+# Calls per sample for the stages too fast to time one by one
+NUMBER = {"schema.flatten_keys": 20, "schema.build": 20, "json.parse_response": 200, "json.incremental": 50,
+          "pdf.layout.10": 100, "pdf.layout.100": 20, "pdf.fields.10": 20}
+FIELD_COUNTS = (10, 100, 1000)
+
+
+def nested_schema(sections=6):
+    # Form b keys grouped in sections, as a hand written nested target schema would be
+    kv_pairs, _ = _form_b_fields()
+    return {f"Section {i}": {"Applicant": dict(kv_pairs), "Notes": {"Comment": "", "Reviewed By": ""}}
+            for i in range(sections)}
+
+
+def _form_b_fields():
+    from quickfill.ocr.document import TextractDocument
+
+    return TextractDocument(stand_ins.load_fixture("textract_form_b.json")).key_value_pairs()
+
+
+def _filled_fields():
+    _, kv_obj = _form_b_fields()
+    answers = stand_ins.RecordedLLM().general_fill
+    for key, field in kv_obj.items():
+        field["Value"] = answers.get(key, "") or key.upper()
+    return kv_obj
+
+
+def _ocr(return_type):
+    def setup():
+        from quickfill.ocr.aws_text_extract import (OCRReturnType,
+                                                    api_analyze_document)
+
+        stand_ins.install()
+        scan = stand_ins.make_scan(stand_ins.FORM_B_SIZE)
+        return lambda i: api_analyze_document(stand_ins.unique(scan, i), OCRReturnType(return_type))
+    return setup
+
+
+def _flatten_keys():
+    from quickfill.ai.form_filling import flatten_keys
+
+    schema = nested_schema()
+    return lambda i: flatten_keys(schema)
+
+
+def _schema_build():
+    from quickfill.ai.chunked_fill import chunk_schema
+    from quickfill.ai.form_filling import extraction_schema
+
+    schema = nested_schema()
+    return lambda i: chunk_schema(extraction_schema(schema)["properties"])
+
+
+def _completion():
+    return stand_ins.load_fixture("llm_completions.json")["general_fill"]
+
+
+def _parse_response():
+    from quickfill.ai.json_stream import parse_json_response
+
+    completion = _completion()
+    return lambda i: parse_json_response(completion)
+
+
+def _incremental():
+    from quickfill.ai.json_stream import IncrementalJSONParser
+
+    completion = _completion()
+    tokens = [completion[start:start + 4] for start in range(0, len(completion), 4)]  # ~1 token per chunk
+
+    def parse(i):
+        parser = IncrementalJSONParser()
+        for token in tokens:
+            parser.feed(token)
+        return parser.result()
+    return parse
+
+
+def _fill_in_forms():
+    from quickfill.ai.ai_form_filling import fill_in_forms
+
+    kv_obj = _filled_fields()
+    return lambda i: fill_in_forms(kv_obj, stand_ins.FORM_B_SIZE)
+
+
+def page_fields(count):
+    # count fields in a grid over the page, like a dense form b, with values of every length
+    words = "Steven Paul Jobs 2066 Crist Dr Los Altos CA 94024 born 02/24/1955 in San Francisco".split()
+    rng = random.Random(count)
+    columns = max(1, int(count ** 0.5 / 2))
+    rows = -(-count // columns)
+    fields = {}
+    for i in range(count):
+        row, column = divmod(i, columns)
+        fields[f"Field {i}"] = {
+            "BoundingBox": {"Left": column / columns, "Top": row / rows,
+                            "Width": 0.9 / columns, "Height": 0.8 / rows},
+            "Value": " ".join(rng.choices(words, k=rng.choice((1, 2, 4, 8, 24)))),
+        }
+    return fields
+
+
+def _layout(count):
+    def setup():
+        from quickfill.pdf.layout import layout_fields
+
+        fields = page_fields(count)
+        return lambda i: list(layout_fields(fields, stand_ins.FORM_B_SIZE))
+    return setup
+
+
+def _fields(count):
+    def setup():
+        from quickfill.ai.ai_form_filling import fill_in_forms
+
+        fields = page_fields(count)
+        return lambda i: fill_in_forms(fields, stand_ins.FORM_B_SIZE)
+    return setup
+
+
+def _export():
+    from quickfill.ai.ai_form_filling import export_pdf_through_json
+
+    kv_obj = _filled_fields()
+    scan = stand_ins.make_scan(stand_ins.FORM_B_SIZE)
+    return lambda i: export_pdf_through_json(scan, kv_obj)
+
+
+STAGES = {
+    "ocr.text": _ocr("text"),
+    "ocr.key_value_pairs": _ocr("key_value_pairs"),
+    "ocr.table_content": _ocr("table_content"),
+    "ocr.raw": _ocr("raw"),
+    "schema.flatten_keys": _flatten_keys,
+    "schema.build": _schema_build,
+    "json.parse_response": _parse_response,
+    "json.incremental": _incremental,
+    "pdf.fill_in_forms": _fill_in_forms,
+    "pdf.export": _export,
+    **{f"pdf.layout.{count}": _layout(count) for count in FIELD_COUNTS},
+    **{f"pdf.fields.{count}": _fields(count) for count in FIELD_COUNTS},
+}
+
+
+def measure_stage(name, repeat):
+    run = STAGES[name]()
+    number = NUMBER.get(name, 1)
+    run(-1)  # Warm up imports and lazy state before taking the RSS baseline
+    baseline_kb = peak_rss_kb()
+    wall, cpu = [], []
+    for sample in range(repeat):
+        start, start_cpu = time.perf_counter(), time.process_time()
+        for n in range(number):
+            run(sample * number + n)
+        wall.append((time.perf_counter() - start) / number)
+        cpu.append((time.process_time() - start_cpu) / number)
+    return {
+        "repeat": repeat,
+        "number": number,
+        "wall_ms": summarize(wall),
+        "cpu_ms": summarize(cpu),
+        "peak_rss_delta_mb": round((peak_rss_kb() - baseline_kb) / 1024, 2),
+    }
+
+
+def run_stages(names=None, repeat=20):
+    return {name: run_isolated(measure_stage, name, repeat) for name in (names or STAGES)}
@@ -0,0 +1,178 @@
+"""
+Local stand-ins for Textract and the OpenAI calls, replaying the recorded responses in benchmarks/fixtures/.
+
+    textract_form_a.json, textract_form_b.json   AnalyzeDocument responses (an ID card and a blank form)
+    llm_completions.json                         Completions of the general fill, GPT-4V and extraction prompts
+
+Both stand-ins sleep for a configurable latency before answering, so the pipeline sees realistic I/O waits
+while staying offline and deterministic. install() also swaps the OCR / fill caches for memory only ones
+(or ones on a given directory) and points the template registry at an empty directory,
+nothing is read from or written to data/.
+"""
+import io
+import json
+import pathlib
+import sys
+import tempfile
+import time
+
+FIXTURES_PATH = pathlib.Path(__file__).parent / "fixtures"
+
+FORM_A_SIZE = (1012, 638)  # ID card, landscape
+FORM_B_SIZE = (1275, 1650)  # Letter page at 150 dpi
+
+
+def load_fixture(name):
+    with open(FIXTURES_PATH / name) as f:
+        return json.load(f)
+
+
+def make_scan(size, seed=0, quality=85):
+    # Text-like noise so the JPEG is about as large as a real scan
+    import random
+
+    from PIL import Image, ImageDraw
+
+    width, height = size
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    rng = random.Random(seed)
+    for _ in range(width * height // 400):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle((x, y, x + rng.randrange(2, 12), y + rng.randrange(2, 6)), fill=(20, 20, 20))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def unique(jpeg_bytes, n):
+    # Same pixels, different bytes: a JPEG comment right after SOI defeats every content hash cache
+    comment = f"quickfill benchmark {n}".encode()
+    return jpeg_bytes[:2] + b"\xff\xfe" + (len(comment) + 2).to_bytes(2, "big") + comment + jpeg_bytes[2:]
+
+
+class RecordedTextract:
+    '''
+    Stand-in for the boto3 Textract client. ID cards are landscape and forms portrait,
+    so the recorded response is picked from the page orientation.
+    '''
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        # boto3 parses the JSON body on every call, so does the stand-in
+        self._responses = {name: json.dumps(load_fixture(f"textract_{name}.json")) for name in ("form_a", "form_b")}
+
+    def analyze_document(self, Document, FeatureTypes):
+        from PIL import Image
+
+        with Image.open(io.BytesIO(Document["Bytes"])) as image:
+            width, height = image.size
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return json.loads(self._responses["form_a" if width > height else "form_b"])
+
+
+class RecordedLLM:
+    '''
+    Stand-in for the LLM calls behind genearl_form_filling, ai_form_filling (single and batched) and the GPT-4V fill.
+    Answers are the recorded completions, limited to the keys each call asks for.
+    '''
+
+    def __init__(self, latency=0.0):
+        from quickfill.ai.json_stream import parse_json_response
+
+        self.latency = latency
+        self.calls = 0
+        completions = load_fixture("llm_completions.json")
+        self.general_fill = parse_json_response(completions["general_fill"])
+        self.gpt4v = parse_json_response(completions["gpt4v"])
+        self.extraction = completions["extraction"]
+
+    def _wait(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def _answer(recorded, keys):
+        if keys is None:
+            return dict(recorded)
+        return {key: recorded.get(key, "") for key in keys}
+
+    def genearl_form_filling(self, form_a_str, form_b_str):
+        self._wait()
+        try:
+            keys = json.loads(form_b_str)
+        except ValueError:
+            keys = None  # Free text schema, eg: from /general_fill_form
+        return self._answer(self.general_fill, keys if isinstance(keys, dict) else None)
+
+    def ai_form_filling(self, context_str, schema):
+        self._wait()
+        return self._answer(self.extraction, schema.get("properties"))
+
+    def compile_extraction(self, schema):
+        # One entity per "### Document <n>" section of the packed text, see quickfill/ai/batch_extraction.py
+        keys = [key for key in schema["properties"] if key != "document_number"]
+
+        def extract(text):
+            self._wait()
+            return [{**self._answer(self.extraction, keys), "document_number": number}
+                    for number in range(text.count("### Document "))]
+
+        return extract
+
+    def process_text_with_images_gpt4v(self, images, text_input, expected_keys):
+        self._wait()
+        return self._answer(self.gpt4v, expected_keys)
+
+
+def install(textract_latency=0.0, llm_latency=0.0, cache_directory=None):
+    '''
+    Patches the Textract client, the LLM calls, the caches and the template registry in this process.
+    With a cache_directory the OCR / fill caches keep their disk tier there, shared with other processes.
+    Returns the (RecordedTextract, RecordedLLM) stand-ins.
+    '''
+    from quickfill import pipeline, providers
+    from quickfill.ai import (ai_form_filling, batch_extraction, fill_cache,
+                              form_filling, multimodal_form_filling)
+    from quickfill.cache import SharedDiskCache, TieredCache, register_cache
+    from quickfill.ocr import aws_text_extract, textract_client
+    from quickfill.templates import TemplateRegistry
+
+    textract = RecordedTextract(textract_latency)
+    llm = RecordedLLM(llm_latency)
+
+    # Real TextractClient (metrics, retries) around the stand-in, without the TPS limit
+    client = textract_client.TextractClient(client_factory=lambda: textract, tps=0)
+    textract_client._client = client
+    providers.register_provider("ocr", "textract", lambda: client)
+
+    ai_form_filling._genearl_form_filling = llm.genearl_form_filling
+    form_filling._genearl_form_filling = llm.genearl_form_filling
+    form_filling._ai_form_filling = llm.ai_form_filling
+    batch_extraction._compile_extraction = llm.compile_extraction
+    multimodal_form_filling._process_text_with_images_gpt4v = llm.process_text_with_images_gpt4v
+
+    if cache_directory is None:
+        aws_text_extract.ocr_cache = TieredCache("ocr", memory_items=256)
+        fill_cache.fill_cache = TieredCache("llm_fill", memory_items=1024)
+    else:
+        ocr_disk = aws_text_extract.ocr_cache.disk
+        aws_text_extract.ocr_cache = TieredCache("ocr", memory_items=256, disk=SharedDiskCache(
+            pathlib.Path(cache_directory) / "ocr", suffix=ocr_disk.suffix, dumps=ocr_disk.dumps,
+            open_file=ocr_disk.open_file))
+        fill_cache.fill_cache = TieredCache("llm_fill", memory_items=1024,
+                                            disk=SharedDiskCache(pathlib.Path(cache_directory) / "llm_fill"))
+
+    register_cache(aws_text_extract.ocr_cache)
+    register_cache(fill_cache.fill_cache)
+
+    registry = TemplateRegistry(pathlib.Path(tempfile.mkdtemp(prefix="quickfill-bench-")) / "templates")
+    pipeline.template_registry = registry
+    main = sys.modules.get("quickfill.main")  # Only patched when the app is loaded
+    if main is not None:
+        main.template_registry = registry
+    return textract, llm
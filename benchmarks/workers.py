@@ -0,0 +1,116 @@
+"""
+Cache sharing between worker processes, as with `uvicorn --workers N` on one host.
+N workers fill the same forms at the same time, with the Textract / LLM stand-ins (see benchmarks/stand_ins.py)
+and the OCR and fill caches on disk: one directory for all workers (shared), or one per worker (private,
+what every worker would redo without sharing).
+
+    python -m benchmarks.workers --workers 1 2 4 8
+
+Reported per worker count: Textract and LLM calls of the whole host, mean cache hit ratio of a worker,
+peak RSS of a worker and of all of them, and the cache's bytes on disk.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import pathlib
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks import stand_ins
+from benchmarks.measure import peak_rss_kb
+
+
+def _directory_bytes(directory):
+    return sum(path.stat().st_size for path in pathlib.Path(directory).rglob("*")
+               if path.is_file() and not path.name.startswith(".") and path.suffix != ".lock")
+
+
+async def _fill_forms(order, concurrency):
+    from quickfill.pipeline import filea_to_fileb_fill_async
+
+    form_a_scan = stand_ins.make_scan(stand_ins.FORM_A_SIZE)
+    form_b_scan = stand_ins.make_scan(stand_ins.FORM_B_SIZE, seed=1)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fill(n):
+        async with semaphore:
+            await filea_to_fileb_fill_async(stand_ins.unique(form_a_scan, n), stand_ins.unique(form_b_scan, n))
+
+    await asyncio.gather(*[fill(n) for n in order])
+
+
+def _worker(index, cache_directory, forms, workers, concurrency, textract_latency, llm_latency, barrier, queue):
+    from quickfill.ai import fill_cache
+    from quickfill.executor import shutdown_executors
+    from quickfill.ocr import aws_text_extract
+
+    textract, llm = stand_ins.install(textract_latency, llm_latency, cache_directory=cache_directory)
+    # Workers start at different forms, so some fills race for the same key and some find it done
+    start = index * forms // workers
+    order = [(start + i) % forms for i in range(forms)]
+    barrier.wait()
+    try:
+        asyncio.run(_fill_forms(order, concurrency))
+    finally:
+        shutdown_executors(wait=True)
+    queue.put({
+        "textract_calls": textract.calls,
+        "llm_calls": llm.calls,
+        "ocr_hit_ratio": aws_text_extract.ocr_cache.stats.as_dict()["hit_ratio"],
+        "fill_hit_ratio": fill_cache.fill_cache.stats.as_dict()["hit_ratio"],
+        "peak_rss_kb": peak_rss_kb(),
+    })
+
+
+def measure_workers(workers, shared=True, forms=8, concurrency=4, textract_latency=0.25, llm_latency=0.5):
+    root = pathlib.Path(tempfile.mkdtemp(prefix="quickfill-bench-workers-"))
+    context = multiprocessing.get_context("spawn")
+    barrier, queue = context.Barrier(workers), context.Queue()
+    processes = [context.Process(target=_worker, args=(i, str(root if shared else root / str(i)), forms, workers,
+                                                       concurrency, textract_latency, llm_latency, barrier, queue))
+                 for i in range(workers)]
+    start = time.perf_counter()
+    try:
+        for process in processes:
+            process.start()
+        results = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+        wall = time.perf_counter() - start
+        cache_bytes = _directory_bytes(root)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return {
+        "workers": workers,
+        "wall_s": round(wall, 3),
+        "textract_calls": sum(r["textract_calls"] for r in results),
+        "llm_calls": sum(r["llm_calls"] for r in results),
+        "ocr_hit_ratio": round(sum(r["ocr_hit_ratio"] for r in results) / workers, 3),
+        "fill_hit_ratio": round(sum(r["fill_hit_ratio"] for r in results) / workers, 3),
+        "worker_peak_rss_mb": round(max(r["peak_rss_kb"] for r in results) / 1024, 2),
+        "total_peak_rss_mb": round(sum(r["peak_rss_kb"] for r in results) / 1024, 2),
+        "cache_disk_mb": round(cache_bytes / 1024 ** 2, 3),
+    }
+
+
+def run_workers(worker_counts=(1, 2, 4), forms=8, concurrency=4, textract_latency=0.25, llm_latency=0.5):
+    return {mode: {str(workers): measure_workers(workers, shared=mode == "shared", forms=forms,
+                                                 concurrency=concurrency, textract_latency=textract_latency,
+                                                 llm_latency=llm_latency)
+                   for workers in worker_counts}
+            for mode in ("shared", "private")}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4])
+    parser.add_argument("--forms", type=int, default=8, help="Distinct form a / form b pairs")
+    parser.add_argument("--concurrency", type=int, default=4, help="Fills in flight per worker")
+    parser.add_argument("--textract-latency", type=float, default=0.25, help="Seconds per Textract call")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds per LLM call")
+    args = parser.parse_args()
+    sys.stdout.write(json.dumps(run_workers(args.workers, args.forms, args.concurrency, args.textract_latency,
+                                            args.llm_latency), indent=2) + "\n")
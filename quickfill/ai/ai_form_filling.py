@@ -1,13 +1,17 @@
 import io
 import json
-import re
 
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
 from PIL import Image
 from PyPDF2 import PdfFileReader, PdfFileWriter
+from quickfill.ai.chunked_fill import fill_in_chunks
+from quickfill.ai.fill_cache import cached_fill, stream_cached_fill
+from quickfill.ai.json_stream import parse_json_response
+from quickfill.ai.key_matcher import LLM_ENGINE, fill_locally, llm_updates
 from quickfill.ai.multimodal_form_filling import process_text_with_images_gpt4v
 from quickfill.ocr.aws_text_extract import OCRReturnType, api_analyze_document
+from quickfill.pdf.render import draw_form_fields, render_filled_pdf
+from quickfill.providers import get_provider
+from quickfill.singleflight import llm_flight, single_flight
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
@@ -70,56 +74,29 @@ def merge_pdfs(form_pdf, existing_file_path, output_pdf_path):
     with open(output_pdf_path, 'wb') as outputStream:
         output.write(outputStream)
 
-def calculate_font_size(field_height, text_length, max_font_size=24):
-    # Start with a font size that's 70% of the field's height
-    font_size = field_height * 0.7
-
-    # Adjust the font size if the text is too long
-    # This is a simple heuristic and might need fine-tuning
-    max_char_in_line = field_height * 1.5
-    if text_length > max_char_in_line:
-        font_size *= max_char_in_line / text_length
-
-    return min(font_size, max_font_size)
-
 def fill_in_forms(key_value_pairs_obj, page_size):
     packet = io.BytesIO()
     can = canvas.Canvas(packet, pagesize=page_size)
 
-    form = can.acroForm
-
-    page_width, page_height = page_size
-
-    for key, dict_value in key_value_pairs_obj.items():
-        bounding_box = dict_value['BoundingBox']
-        x = bounding_box['Left'] * page_size[0]
-        y = (1 - bounding_box['Top'] - bounding_box['Height']) * page_size[1]
-        width = bounding_box['Width'] * page_size[0]
-        height = bounding_box['Height'] * page_size[1]
-        text = dict_value.get('Value', 'Hello World')
-
-        font_size = calculate_font_size(height, len(text))
-        form.textfield(name=key, tooltip=key, x=x, y=y, width=width, height=height,
-                       borderColor=colors.black, fillColor=colors.white,
-                       textColor=colors.black, borderWidth=1, fontSize=font_size,
-                       borderStyle='underlined', forceBorder=True,
-                       value=text)
+    draw_form_fields(can, key_value_pairs_obj, page_size)
     can.save()
     packet.seek(0)
     return PdfFileReader(packet)
 
 
 # Function to update nested values
-def update_nested_dict(main_dict, updates):
+def update_nested_dict(main_dict, updates, engine=None):
+    # engine: what filled the values, recorded as 'FilledBy' (see quickfill/ai/key_matcher.py)
     for key, value in updates.items():
         if key in main_dict and 'Value' in main_dict[key]:
             main_dict[key]['Value'] = value
-            # print(main_dict)
-            print(f"Assign value [{value}] to key [{key}]")
+            if engine is not None:
+                main_dict[key]['FilledBy'] = engine
 
 
-def genearl_form_filling(form_a_str:str, form_b_str:str) -> dict:
-    prompt = '''
+GENERAL_FILL_MODEL = 'gpt-4-1106-preview'
+GENERAL_FILL_TEMPERATURE = 0.1
+GENERAL_FILL_PROMPT = '''
 You are a form filling expert. You will help user fill the content from forma to formb. You should respond in json format.
 
 # Rules:
@@ -138,79 +115,86 @@ You reply:
 ?
 ```
     '''
-    model = ChatOpenAI(model='gpt-4-1106-preview', temperature=0.1)
-    prompt = ChatPromptTemplate.from_template(prompt)
-    print(prompt.invoke({"form_a_content": form_a_str, "form_b_schema": form_b_str}))
-    chain = prompt | model
-    res = chain.invoke({"form_a_content": form_a_str, "form_b_schema": form_b_str}).content
-    print(res)
-    pattern = r'```json\s*({.*?}|\[.*?])\s*```'
-    # Search for the pattern in the input string
-    match = re.search(pattern, res, re.DOTALL)
-
-    # If a match is found, return the JSON string
-    if match:
-        res = match.group(1)
-    res = json.loads(res)
-    return res
-
-def export_pdf_through_json(image_bytes, key_value_pairs_obj):
-    # Get page size from image bytes
-    with Image.open(io.BytesIO(image_bytes)) as img:
-        page_size = img.size  # Returns (width, height)
 
-    # Create a form PDF with fields based on OCR results
-    form_pdf = fill_in_forms(key_value_pairs_obj, page_size)
 
-    # Convert the image to a PDF if it's not already a PDF
-    input_pdf = convert_image_to_pdf(io.BytesIO(image_bytes))
+@single_flight(llm_flight)
+def genearl_form_filling(form_a_str:str, form_b_str:str, use_cache: bool = True) -> dict:
+    return cached_fill(lambda: _genearl_form_filling(form_a_str, form_b_str),
+                       GENERAL_FILL_MODEL, GENERAL_FILL_TEMPERATURE, GENERAL_FILL_PROMPT,
+                       form_a_str, form_b_str, use_cache=use_cache)
 
-    # Merge the form fields PDF with the input PDF
-    output_pdf_bytes = io.BytesIO()
-    output_pdf = PdfFileWriter()
-    
-    for i in range(len(input_pdf.pages)):
-        page = input_pdf.getPage(i)
-        if i == 0:  # Add form only to the first page
-            page.mergePage(form_pdf.getPage(0))
-        output_pdf.addPage(page)
 
-    output_pdf.write(output_pdf_bytes)
-    output_pdf_bytes.seek(0)  # Reset buffer pointer to the beginning
-    return output_pdf_bytes
+def _genearl_form_filling(form_a_str:str, form_b_str:str) -> dict:
+    res = get_provider("llm").complete(GENERAL_FILL_PROMPT, {"form_a_content": form_a_str, "form_b_schema": form_b_str},
+                                       GENERAL_FILL_MODEL, GENERAL_FILL_TEMPERATURE)
+    return parse_json_response(res)
 
-def process_image_and_text(image_bytes, text_input):
+
+def chunked_form_filling(form_a_str:str, form_b_schema:dict, use_cache: bool = True, **chunking) -> dict:
+    # Large schemas are split into key chunks filled in parallel, see quickfill/ai/chunked_fill.py
+    # chunking: max_tokens, max_keys and parallelism overrides
+    return fill_in_chunks(lambda chunk: genearl_form_filling(form_a_str, json.dumps(chunk), use_cache=use_cache),
+                          form_b_schema, **chunking)
+
+
+def stream_genearl_form_filling(form_a_str:str, form_b_str:str, use_cache: bool = True):
+    # Yields ("token", text), ("field", (key, value)) and finally ("result", dict)
+    def stream_tokens():
+        yield from get_provider("llm").stream(GENERAL_FILL_PROMPT,
+                                              {"form_a_content": form_a_str, "form_b_schema": form_b_str},
+                                              GENERAL_FILL_MODEL, GENERAL_FILL_TEMPERATURE)
+
+    return stream_cached_fill(stream_tokens, GENERAL_FILL_MODEL, GENERAL_FILL_TEMPERATURE, GENERAL_FILL_PROMPT,
+                              form_a_str, form_b_str, use_cache=use_cache)
+
+def get_image_page_size(image_bytes):
+    # Only the header is decoded here, Image.open is lazy
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        return img.size  # Returns (width, height)
+
+def export_pdf_through_json(image_bytes, key_value_pairs_obj, page_size=None, output=None, orientation=1):
+    # Image and form fields are written in one pass, see quickfill/pdf/render.py
+    return render_filled_pdf(image_bytes, key_value_pairs_obj, page_size=page_size, output=output,
+                             orientation=orientation)
+
+def process_image_and_text(image_bytes, text_input, use_cache=True, form_a_pairs=None):
     # Run OCR on the image bytes
     kv_pairs_result, key_value_pairs_obj = api_analyze_document(image_bytes, OCRReturnType.KEY_VALUE_PAIRS)
 
-    # Generate the JSON result from text input using the genearl_form_filling function
-    json_res = genearl_form_filling(text_input, json.dumps(kv_pairs_result))
+    # Fields matching form a's key value pairs are filled locally, the LLM only gets the rest
+    matches, remaining = fill_locally(form_a_pairs, kv_pairs_result, key_value_pairs_obj)
+
+    # Generate the JSON result from text input, in parallel chunks for large forms
+    json_res = chunked_form_filling(text_input, remaining, use_cache=use_cache) if remaining else {}
 
     # Update the key_value_pairs_obj with values from json_res
-    update_nested_dict(key_value_pairs_obj, json_res)
+    update_nested_dict(key_value_pairs_obj, llm_updates(json_res, matches), engine=LLM_ENGINE)
 
     output_pdf_bytes = export_pdf_through_json(image_bytes, key_value_pairs_obj)
     return output_pdf_bytes
 
 
-def gpt4v_filea_to_fileb_fill(filea_img_bytes, fileb_img_bytes):
+def gpt4v_filea_to_fileb_fill(filea_img_bytes, fileb_img_bytes, use_cache=True):
     # Run OCR on the image bytes
     kv_pairs_result, key_value_pairs_obj = api_analyze_document(fileb_img_bytes, OCRReturnType.KEY_VALUE_PAIRS)
 
-    json_res = process_text_with_images_gpt4v(image_paths=[filea_img_bytes], expected_keys=kv_pairs_result, from_bytes=True)
+    json_res = process_text_with_images_gpt4v(image_paths=[filea_img_bytes], expected_keys=kv_pairs_result, from_bytes=True,
+                                              use_cache=use_cache)
     # print("json_res:")
     # print(json_res)
     # Update the key_value_pairs_obj with values from json_res
-    update_nested_dict(key_value_pairs_obj, json_res)
+    update_nested_dict(key_value_pairs_obj, json_res, engine=LLM_ENGINE)
 
     output_pdf_bytes = export_pdf_through_json(fileb_img_bytes, key_value_pairs_obj)
     return output_pdf_bytes
 
 
-def filea_to_fileb_fill(filea_img_bytes, fileb_img_bytes):
+def filea_to_fileb_fill(filea_img_bytes, fileb_img_bytes, use_cache=True):
     # Run OCR on the image bytes
     text_res = api_analyze_document(filea_img_bytes, OCRReturnType.TEXT)
-    output_pdf_bytes = process_image_and_text(fileb_img_bytes, text_res)
+    form_a_pairs, _ = api_analyze_document(filea_img_bytes, OCRReturnType.KEY_VALUE_PAIRS)
+    output_pdf_bytes = process_image_and_text(fileb_img_bytes, text_res, use_cache=use_cache,
+                                              form_a_pairs=form_a_pairs)
     return output_pdf_bytes
 
 
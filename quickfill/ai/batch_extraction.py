@@ -0,0 +1,143 @@
+import json
+
+from quickfill.ai.chunked_fill import estimate_tokens
+from quickfill.ai import fill_cache as fill_cache_module
+from quickfill.ai.fill_cache import call_model, fill_cache_key
+from quickfill.ai.form_filling import (AI_FILL_MODEL, AI_FILL_TEMPERATURE,
+                                       ai_form_filling, extraction_schema)
+from quickfill.const import (LLM_BATCH_MAX_DOCUMENTS, LLM_BATCH_PARALLELISM,
+                             LLM_BATCH_TOKENS)
+from quickfill.executor import Stage, map_in_stage
+from quickfill.providers import get_provider
+
+# Extraction of many contexts (eg: a backlog of OCR'd documents) against one target schema.
+# The schema and the extraction chain are built once, contexts are packed into requests under a token budget,
+# each document marked with its number, and the requests run in parallel within the LLM stage's concurrency
+# limit (quickfill/executor.py). Every context gets its own result or error, in input order.
+# A failed request is retried document by document through ai_form_filling, as is a document it returned
+# no entity for.
+
+AI_FILL_BATCH_PROMPT_VERSION = "langchain-extraction-chain-batch-v1"
+DOCUMENT_KEY = "document_number"
+BATCH_INSTRUCTIONS = ("The passage holds several documents, each one under a heading with its number. "
+                      f"Extract one entity per document and set its {DOCUMENT_KEY} to that number.")
+
+
+class ExtractionItem:
+    def __init__(self, index, result=None, error=None):
+        self.index = index
+        self.result = result
+        self.error = error
+
+    def to_dict(self):
+        entry = {"index": self.index, "result": self.result}
+        if self.error is not None:
+            entry["error"] = self.error
+        return entry
+
+
+def pack_contexts(contexts, schema_tokens=0, max_tokens=LLM_BATCH_TOKENS, max_documents=LLM_BATCH_MAX_DOCUMENTS):
+    '''
+    Greedy split of contexts (in input order) into batches of indexes. A context over the budget
+    on its own gets its own batch, a limit of 0 disables it.
+    '''
+    batches = []
+    batch, batch_tokens = [], schema_tokens
+    for index, context in enumerate(contexts):
+        tokens = estimate_tokens(context)
+        if batch and ((max_tokens > 0 and batch_tokens + tokens > max_tokens)
+                      or (max_documents > 0 and len(batch) >= max_documents)):
+            batches.append(batch)
+            batch, batch_tokens = [], schema_tokens
+        batch.append(index)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def batch_schema(schema: dict) -> dict:
+    properties = {**schema["properties"], DOCUMENT_KEY: {"type": "integer"}}
+    return {**schema, "properties": properties, "required": list(schema.get("required", [])) + [DOCUMENT_KEY]}
+
+
+def pack_documents(contexts) -> str:
+    documents = "\n\n".join(f"### Document {number}\n{context}" for number, context in enumerate(contexts))
+    return f"{BATCH_INSTRUCTIONS}\n\n{documents}"
+
+
+def unpack_entities(entities, count):
+    # The model may split a document into several entities or skip one, the first answer for a key wins
+    results = [{} for _ in range(count)]
+    if isinstance(entities, dict):
+        entities = [entities]
+    for entity in entities or []:
+        if not isinstance(entity, dict):
+            continue
+        try:
+            number = int(entity.get(DOCUMENT_KEY))
+        except (TypeError, ValueError):
+            continue
+        if not 0 <= number < count:
+            continue
+        for key, value in entity.items():
+            if key != DOCUMENT_KEY and value not in (None, "") and results[number].get(key) in (None, ""):
+                results[number][key] = value
+    return results
+
+
+def _compile_extraction(schema: dict):
+    return get_provider("llm").compile_extraction(schema, AI_FILL_MODEL, AI_FILL_TEMPERATURE)
+
+
+def ai_form_filling_batch(contexts, target_json: dict, auto: bool = True, use_cache: bool = True,
+                          max_tokens=LLM_BATCH_TOKENS, max_documents=LLM_BATCH_MAX_DOCUMENTS,
+                          parallelism=LLM_BATCH_PARALLELISM) -> list:
+    '''
+    Returns an ExtractionItem per context, in input order.
+    Called on the LLM stage's pool, the calling thread's slot runs the first request.
+    '''
+    schema = extraction_schema(target_json, auto)
+    items = [None] * len(contexts)
+    keys = {}
+    for index, context in enumerate(contexts):
+        if not use_cache:
+            continue
+        keys[index] = fill_cache_key(AI_FILL_MODEL, AI_FILL_TEMPERATURE, AI_FILL_BATCH_PROMPT_VERSION, context,
+                                     schema)
+        result = fill_cache_module.fill_cache.get(keys[index])
+        if result is not None:
+            items[index] = ExtractionItem(index, result)
+    pending = [index for index, item in enumerate(items) if item is None]
+    if not pending:
+        return items
+
+    extract = _compile_extraction(batch_schema(schema))
+    schema_tokens = estimate_tokens(json.dumps(schema))
+    batches = [[pending[i] for i in batch]
+               for batch in pack_contexts([contexts[i] for i in pending], schema_tokens, max_tokens, max_documents)]
+
+    def run_batch(batch):
+        text = pack_documents([contexts[index] for index in batch])
+        try:
+            results = unpack_entities(call_model(lambda: extract(text), AI_FILL_MODEL), len(batch))
+        except Exception:
+            return [_fill_one(index, contexts[index], schema, use_cache) for index in batch]
+        # A document the model skipped (no entity for it) is retried on its own
+        return [ExtractionItem(index, result) if result else _fill_one(index, contexts[index], schema, use_cache)
+                for index, result in zip(batch, results)]
+
+    for batch_items in map_in_stage(Stage.LLM, run_batch, batches, max(1, parallelism)):
+        for item in batch_items:
+            items[item.index] = item
+            # An empty result is never reused, the next batch asks the model again
+            if use_cache and item.error is None and item.result:
+                fill_cache_module.fill_cache.set(keys[item.index], item.result)
+    return items
+
+
+def _fill_one(index, context, schema, use_cache):
+    try:
+        return ExtractionItem(index, ai_form_filling(context, schema, auto=False, use_cache=use_cache))
+    except Exception as e:
+        return ExtractionItem(index, error=f"{type(e).__name__}: {e}")
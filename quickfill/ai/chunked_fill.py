@@ -0,0 +1,68 @@
+import json
+
+from quickfill.const import (LLM_CHUNK_MAX_KEYS, LLM_CHUNK_PARALLELISM,
+                             LLM_CHUNK_TOKENS)
+from quickfill.executor import Stage, map_in_stage
+
+# Schema partitioning for large form b's: the target keys are split into token budgeted chunks,
+# every chunk is filled by its own LLM call with the same form a context, in parallel within the
+# LLM stage's concurrency limit (quickfill/executor.py), and the answers are merged back into one result.
+# Small schemas fit in one chunk and go through a single call, exactly as before.
+
+
+def estimate_tokens(text):
+    # ~4 characters per token for English and JSON punctuation, close enough for budgeting
+    return len(text) // 4 + 1
+
+
+def chunk_schema(schema: dict, max_tokens=LLM_CHUNK_TOKENS, max_keys=LLM_CHUNK_MAX_KEYS):
+    # Greedy split in schema order, a limit of 0 disables it
+    chunks = []
+    chunk, chunk_tokens = {}, 0
+    for key, value in schema.items():
+        tokens = estimate_tokens(json.dumps({key: value}))
+        if chunk and ((max_tokens > 0 and chunk_tokens + tokens > max_tokens)
+                      or (max_keys > 0 and len(chunk) >= max_keys)):
+            chunks.append(chunk)
+            chunk, chunk_tokens = {}, 0
+        chunk[key] = value
+        chunk_tokens += tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _filled(value):
+    return value not in (None, "")
+
+
+def merge_chunk_results(chunks, results):
+    '''
+    A chunk's answers for its own keys win. Answers about keys of other chunks (the model sometimes
+    fills them from context) only fill in keys that are still missing or blank.
+    '''
+    merged = {}
+    for chunk, result in zip(chunks, results):
+        for key, value in result.items():
+            if key in chunk:
+                merged[key] = value
+    for result in results:
+        for key, value in result.items():
+            if _filled(value) and not _filled(merged.get(key)):
+                merged[key] = value
+    return merged
+
+
+def fill_in_chunks(fill_chunk, schema: dict, max_tokens=LLM_CHUNK_TOKENS, max_keys=LLM_CHUNK_MAX_KEYS,
+                   parallelism=LLM_CHUNK_PARALLELISM):
+    '''
+    fill_chunk(sub_schema) runs one LLM call and returns a dict.
+    Called on the LLM stage's pool, the calling thread's slot fills the first chunk.
+    '''
+    chunks = chunk_schema(schema, max_tokens, max_keys)
+    if len(chunks) <= 1:
+        return fill_chunk(schema)
+
+    results = map_in_stage(Stage.LLM, fill_chunk, chunks, max(1, parallelism))
+    results = [result if isinstance(result, dict) else {} for result in results]
+    return merge_chunk_results(chunks, results)
@@ -0,0 +1,90 @@
+import hashlib
+
+from quickfill.ai.json_stream import IncrementalJSONParser
+from quickfill.cache import SharedDiskCache, TieredCache, register_cache
+from quickfill.const import (FILL_CACHE_MAX_BYTES, FILL_CACHE_MEMORY_ITEMS,
+                             FILL_CACHE_PATH, FILL_CACHE_TTL,
+                             TELEMETRY_ENABLED)
+from quickfill.singleflight import make_key
+from quickfill.telemetry import record_llm_tokens, span
+
+# Content addressed cache of LLM fill results, shared by every fill path.
+# Key: model, temperature, prompt template version, form a content hash, form b schema hash
+
+fill_cache = register_cache(TieredCache(
+    "llm_fill",
+    memory_items=FILL_CACHE_MEMORY_ITEMS,
+    disk=SharedDiskCache(FILL_CACHE_PATH, max_bytes=FILL_CACHE_MAX_BYTES, ttl=FILL_CACHE_TTL),
+))
+
+
+def content_hash(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return hashlib.md5(value).hexdigest()
+    if isinstance(value, str):
+        return hashlib.md5(value.encode('utf-8')).hexdigest()
+    return make_key(value)
+
+
+def prompt_version(template: str):
+    # Editing a prompt template changes its version, so stale results are never reused
+    return content_hash(template)[:12]
+
+
+def fill_cache_key(model, temperature, prompt_template, form_a, form_b):
+    return make_key(model, temperature, prompt_version(prompt_template), content_hash(form_a), content_hash(form_b))
+
+
+def call_model(compute, model):
+    # Runs compute() (an LLM call) in an "llm.<model>" span, counting the tokens OpenAI reports
+    if not TELEMETRY_ENABLED:
+        return compute()
+    # ~100ms to import, only paid on the first model call
+    from langchain_community.callbacks import get_openai_callback
+
+    with span(f"llm.{model}"), get_openai_callback() as usage:
+        result = compute()
+    record_llm_tokens(model, usage.prompt_tokens, usage.completion_tokens)
+    return result
+
+
+def cached_fill(compute, model, temperature, prompt_template, form_a, form_b, use_cache=True):
+    # compute() runs the actual LLM call, use_cache=False always calls the model and skips the store
+    if not use_cache:
+        return call_model(compute, model)
+    key = fill_cache_key(model, temperature, prompt_template, form_a, form_b)
+    result = fill_cache.get(key)
+    if result is not None:
+        return result
+    # Workers missing the same key at once wait for the first one's call
+    return fill_cache.compute_shared(key, call_model, compute, model)
+
+
+def stream_cached_fill(stream_tokens, model, temperature, prompt_template, form_a, form_b, use_cache=True):
+    '''
+    Streaming variant of cached_fill, stream_tokens() yields the model's text chunks.
+    Yields ("token", text), ("field", (key, value)) as fields complete, then ("result", dict).
+    '''
+    key = fill_cache_key(model, temperature, prompt_template, form_a, form_b) if use_cache else None
+    result = fill_cache.get(key) if use_cache else None
+    if result is not None:
+        if isinstance(result, dict):
+            for field in result.items():
+                yield "field", field
+        yield "result", result
+        return
+
+    # Streamed responses carry no usage, every chunk is one completion token
+    parser = IncrementalJSONParser()
+    tokens = 0
+    with span(f"llm.{model}"):
+        for token in stream_tokens():
+            tokens += 1
+            yield "token", token
+            for field in parser.feed(token):
+                yield "field", field
+    record_llm_tokens(model, completion_tokens=tokens)
+    result = parser.result()
+    if use_cache:
+        fill_cache.set(key, result)
+    yield "result", result
@@ -1,8 +1,9 @@
 import json
 
-from langchain.chains import create_extraction_chain
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+from quickfill.ai.chunked_fill import fill_in_chunks
+from quickfill.ai.fill_cache import cached_fill
+from quickfill.providers import get_provider
+from quickfill.singleflight import llm_flight, single_flight
 
 
 def flatten_keys(data, parent_key='', sep='$$'):
@@ -15,30 +16,58 @@ def flatten_keys(data, parent_key='', sep='$$'):
             items[new_key] = v
     return items
 
-def ai_form_filling(context_str: str, target_json: dict, auto: bool = True) -> dict:
-    if auto:
-        flattened_json = flatten_keys(target_json)
-        properties = {key: {"type": "string"} for key in flattened_json.keys()}
-        # required = list(properties.keys())
-        required = []
-        schema = {
-            "properties": properties,
-            "required": required
-        }
-        print("schema", json.dumps(schema, indent=4))
-    else:
-        schema = target_json
-
-    llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo")
-    chain = create_extraction_chain(schema, llm)
-    result = chain.run(context_str)
+AI_FILL_MODEL = "gpt-3.5-turbo"
+AI_FILL_TEMPERATURE = 0
+# The extraction chain owns its prompt, bump this when upgrading langchain changes it
+AI_FILL_PROMPT_VERSION = "langchain-extraction-chain-v1"
+
+
+@single_flight(llm_flight)
+def ai_form_filling(context_str: str, target_json: dict, auto: bool = True, use_cache: bool = True) -> dict:
+    schema = extraction_schema(target_json, auto)
+    properties = schema.get("properties")
+    if not isinstance(properties, dict):
+        return _cached_extraction(context_str, schema, use_cache)
+
+    # Large schemas are split into property chunks filled in parallel, see quickfill/ai/chunked_fill.py
+    def fill_chunk(chunk_properties):
+        required = [key for key in schema.get("required", []) if key in chunk_properties]
+        return _cached_extraction(context_str, {**schema, "properties": chunk_properties, "required": required},
+                                  use_cache)
+
+    return fill_in_chunks(fill_chunk, properties)
+
+
+def extraction_schema(target_json: dict, auto: bool = True) -> dict:
+    if not auto:
+        return target_json
+    flattened_json = flatten_keys(target_json)
+    properties = {key: {"type": "string"} for key in flattened_json.keys()}
+    # required = list(properties.keys())
+    required = []
+    return {
+        "properties": properties,
+        "required": required
+    }
+
+
+def _cached_extraction(context_str: str, schema: dict, use_cache: bool = True) -> dict:
+    return cached_fill(lambda: _ai_form_filling(context_str, schema),
+                       AI_FILL_MODEL, AI_FILL_TEMPERATURE, AI_FILL_PROMPT_VERSION,
+                       context_str, schema, use_cache=use_cache)
+
+
+def _ai_form_filling(context_str: str, schema: dict) -> dict:
+    result = get_provider("llm").extract(schema, context_str, AI_FILL_MODEL, AI_FILL_TEMPERATURE)
     # print("result", json.dumps(result, indent=4))
     if type(result) == list:
         result = result[0]
     return result
 
-def genearl_form_filling(form_a_str:str, form_b_str:str) -> dict:
-    prompt = '''
+# ChatOpenAI() defaults
+GENERAL_FILL_MODEL = "gpt-3.5-turbo"
+GENERAL_FILL_TEMPERATURE = 0.7
+GENERAL_FILL_PROMPT = '''
 You are a form filling expert. You will help user fill the content from forma to formb. You should respond in json format.
 Rules:
 - Leave items from form b as blank if you're not sure 
@@ -50,11 +79,19 @@ Here are the content from the forma:
 Here is the schema from formb:
 {form_b_schema}
     '''
-    model = ChatOpenAI()
-    prompt = ChatPromptTemplate.from_template(prompt)
-    chain = prompt | model
-    res = chain.invoke({"form_a_content": form_a_str, "form_b_schema": form_b_str})
-    res = json.loads(res.content)
+
+
+@single_flight(llm_flight)
+def genearl_form_filling(form_a_str:str, form_b_str:str, use_cache: bool = True) -> dict:
+    return cached_fill(lambda: _genearl_form_filling(form_a_str, form_b_str),
+                       GENERAL_FILL_MODEL, GENERAL_FILL_TEMPERATURE, GENERAL_FILL_PROMPT,
+                       form_a_str, form_b_str, use_cache=use_cache)
+
+
+def _genearl_form_filling(form_a_str:str, form_b_str:str) -> dict:
+    res = get_provider("llm").complete(GENERAL_FILL_PROMPT, {"form_a_content": form_a_str, "form_b_schema": form_b_str},
+                                       GENERAL_FILL_MODEL, GENERAL_FILL_TEMPERATURE)
+    res = json.loads(res)
     return res
 
 # Test
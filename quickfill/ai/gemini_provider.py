@@ -0,0 +1,44 @@
+import vertexai
+from vertexai.preview.generative_models import GenerativeModel, Image, Part
+
+# Google Gemini backend of the "vision" provider, through Vertex AI. See quickfill/providers.py
+
+GEMINI_PROJECT_ID = "aitist-390505"
+GEMINI_LOCATION = "us-central1"
+GEMINI_MODEL = "gemini-pro-vision"
+
+
+def _first_text(response):
+    for candidate in response.candidates:
+        return candidate.content.parts[0].text
+    return ""
+
+
+class GeminiProvider:
+    def __init__(self, project_id=GEMINI_PROJECT_ID, location=GEMINI_LOCATION):
+        vertexai.init(project=project_id, location=location)
+
+    def generate(self, image_path, prompt_text, project_id=GEMINI_PROJECT_ID, location=GEMINI_LOCATION,
+                 model=GEMINI_MODEL) -> str:
+        # Initialize Vertex AI
+        vertexai.init(project=project_id, location=location)
+        image = Image.load_from_file(image_path)
+        response = GenerativeModel(model).generate_content([Part.from_image(image), prompt_text])
+        return _first_text(response)
+
+    def _contents(self, text_input, images):
+        # images: [(mime, bytes)]
+        return [Part.from_data(data, mime_type=mime) for mime, data in images] + [text_input]
+
+    def complete_with_images(self, text_input, images, model, temperature, detail="auto", max_tokens=2048) -> str:
+        # detail is an OpenAI setting, Gemini picks its own resolution
+        config = {"temperature": temperature, "max_output_tokens": max_tokens}
+        response = GenerativeModel(model).generate_content(self._contents(text_input, images),
+                                                           generation_config=config)
+        return _first_text(response)
+
+    def stream_with_images(self, text_input, images, model, temperature, detail="auto", max_tokens=2048):
+        config = {"temperature": temperature, "max_output_tokens": max_tokens}
+        for chunk in GenerativeModel(model).generate_content(self._contents(text_input, images),
+                                                             generation_config=config, stream=True):
+            yield _first_text(chunk)
@@ -0,0 +1,133 @@
+import json
+
+# Incremental parser for the JSON object an LLM streams back, possibly wrapped in ```json fences
+# or surrounded by prose. Top level members are emitted as soon as their value is complete,
+# so filled fields can be pushed to the client before the whole response has arrived.
+# A ```json fence wins over brackets in the prose before it ("the fields of form [A]:"): a root found
+# outside a fence is dropped when it turns out not to be JSON, or when a fence follows it.
+# Chunks are scanned once and only the current root and member are kept, so feeding is linear.
+
+FENCE = "```json"
+
+
+class IncrementalJSONParser:
+    def __init__(self):
+        self.fields = {}
+        self.done = False
+        self._parts = []  # Every chunk, for the error of a response without JSON
+        self._pending = ""  # End of the last chunk that may be the start of a fence
+        self._fenced = False  # The root is in a ```json fence
+        self._value = None
+        self._reset_root()
+
+    def _reset_root(self):
+        self._root = None  # '{' or '[' once the root is open
+        self._root_parts = []
+        self._member_parts = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    @property
+    def text(self):
+        return "".join(self._parts)
+
+    def feed(self, chunk):
+        # Returns the (key, value) pairs completed by this chunk
+        self._parts.append(chunk)
+        text = self._pending + chunk
+        self._pending = ""
+        completed = []
+        root_start = member_start = 0
+        i = 0
+        while i < len(text) and not (self.done and self._fenced):
+            char = text[i]
+            if self._root is None or self.done:
+                # Looking for the root, or for a fence after a root found in prose
+                if char == "`":
+                    if text.startswith(FENCE, i):
+                        self._restart(fenced=True)
+                        i += len(FENCE)
+                        continue
+                    if FENCE.startswith(text[i:]):
+                        self._pending = text[i:]
+                        break
+                elif self._root is None and char in "{[":
+                    self._root = char
+                    self._depth = 1
+                    root_start, member_start = i, i + 1
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "`":
+                # Never outside a string in JSON: the root was prose, look again from here
+                self._restart(fenced=self._fenced)
+                continue
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._complete_member(text[member_start:i], completed)
+                    self._close_root("".join(self._root_parts) + text[root_start:i + 1])
+            elif char == "," and self._depth == 1:
+                self._complete_member(text[member_start:i], completed)
+                member_start = i + 1
+            i += 1
+        if self._root is not None and not self.done:
+            self._root_parts.append(text[root_start:])
+            self._member_parts.append(text[member_start:])
+        return completed
+
+    def _restart(self, fenced):
+        self._reset_root()
+        self._fenced = fenced
+        self._value = None
+        self.done = False
+        self.fields = {}
+
+    def _close_root(self, root_text):
+        try:
+            self._value = json.loads(root_text)
+        except ValueError as e:
+            if not self._fenced:
+                # Brackets in prose, keep looking
+                self._restart(fenced=False)
+                return
+            self._value = e
+        self.done = True
+
+    def _complete_member(self, end, completed):
+        member = "".join(self._member_parts) + end
+        self._member_parts = []
+        if self._root != "{" or not member.strip():
+            return
+        try:
+            (key, value), = json.loads("{" + member + "}").items()
+        except ValueError:
+            # Not valid JSON on its own (eg: trailing commas), the final parse decides
+            return
+        self.fields[key] = value
+        completed.append((key, value))
+
+    def result(self):
+        if isinstance(self._value, ValueError):
+            raise self._value
+        if self.done:
+            return self._value
+        if self._root is None:
+            # No object or array found, let json report the error
+            return json.loads(self.text)
+        raise ValueError("Incomplete JSON in LLM response")
+
+
+def parse_json_response(text):
+    parser = IncrementalJSONParser()
+    parser.feed(text)
+    return parser.result()
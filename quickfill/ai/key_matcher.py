@@ -0,0 +1,183 @@
+import re
+from difflib import SequenceMatcher
+
+from quickfill.const import KEY_MATCH_ENABLED, KEY_MATCH_FUZZY_THRESHOLD
+
+# Local, deterministic form a -> form b key matching, run before the LLM.
+# Form b keys are matched against the key value pairs Textract found on form a:
+#   exact    same key once normalized ("Zip Code:" == "zip code")
+#   synonym  same entry of the vetted synonym table ("DOB" == "Date of Birth")
+#   fuzzy    similar enough normalized keys ("Home Adress" ~ "Home Address"), differing only by typos:
+#            a word with a letter missing, extra or swapped. A different word is a different field,
+#            however close the spelling ("Employer Name" / "Employee Name", "Patient" / "Parent").
+# Typed fields (dates, phones, zip codes, emails, SSNs) only take values that validate.
+# A key two form a keys match equally well with different values is ambiguous and left to the LLM.
+# Whatever is left goes to the LLM, every filled field records its engine in 'FilledBy'.
+
+LLM_ENGINE = "llm"
+
+# Vetted: every variant names the same field on any form. Generic words ("name", "first", "street", "mobile")
+# may be another field (emergency contact name, mailing street, a second phone), those keys go to the LLM
+SYNONYMS = {
+    "first name": ("given name", "forename"),
+    "middle name": ("middle initial",),
+    "last name": ("surname", "family name"),
+    "date of birth": ("dob", "d o b", "birth date", "birthdate", "date of birth mm dd yyyy"),
+    "sex": ("gender",),
+    "phone": ("phone number", "telephone", "telephone number", "tel"),
+    "email": ("email address", "e mail", "e mail address"),
+    "address": ("street address", "home address", "residence address"),
+    "city": ("town", "city town"),
+    "state": ("province", "state province"),
+    "zip code": ("zip", "zipcode", "postal code", "postcode", "zip postal code"),
+    "social security number": ("ssn", "social security no", "ss number"),
+}
+_CANONICAL = {variant: canonical for canonical, variants in SYNONYMS.items() for variant in (canonical,) + variants}
+
+_MONTHS = ("jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec|january|february|march|april|june|july|august|"
+           "september|october|november|december")
+_VALIDATORS = {
+    "date": re.compile(
+        r"\d{1,2}[/.-]\d{1,2}[/.-](\d{2}|\d{4})"
+        r"|\d{4}[/.-]\d{1,2}[/.-]\d{1,2}"
+        rf"|({_MONTHS})\.? \d{{1,2}}(st|nd|rd|th)?,? \d{{4}}"
+        rf"|\d{{1,2}} ({_MONTHS})\.?,? \d{{4}}", re.IGNORECASE),
+    "phone": re.compile(r"\+?[\d\s().-]{10,20}"),
+    "zip": re.compile(r"\d{5}(-\d{4})?"),
+    "email": re.compile(r"[^@\s]+@[^@\s]+\.[a-z]{2,}", re.IGNORECASE),
+    "ssn": re.compile(r"\d{3}-?\d{2}-?\d{4}"),
+}
+_TYPES = {"date of birth": "date", "phone": "phone", "zip code": "zip", "email": "email",
+          "social security number": "ssn"}
+# Keys outside the synonym table are typed by keyword ("Date of Issue", "Emergency Contact Phone")
+_TYPE_KEYWORDS = (("date", "date"), ("phone", "phone"), ("zip", "zip"), ("email", "email"))
+
+
+def normalize_key(key):
+    key = key.lower().replace("&", " and ")
+    key = re.sub(r"\(.*?\)", " ", key)  # Hints and page suffixes: "(mm/dd/yyyy)", "(page 2)"
+    key = re.sub(r"^\s*(\d+|[a-z])[.)]\s+", " ", key)  # Numbering: "1. ", "a) "
+    key = re.sub(r"[^a-z0-9]+", " ", key)
+    return " ".join(key.split())
+
+
+def canonical_key(key):
+    normalized = normalize_key(key)
+    return _CANONICAL.get(normalized, normalized)
+
+
+def field_type(key):
+    canonical = canonical_key(key)
+    if canonical in _TYPES:
+        return _TYPES[canonical]
+    for keyword, kind in _TYPE_KEYWORDS:
+        if keyword in canonical.split():
+            return kind
+    return None
+
+
+def validate(kind, value):
+    if kind is None:
+        return True
+    value = value.strip()
+    if not _VALIDATORS[kind].fullmatch(value):
+        return False
+    if kind == "phone":
+        return 10 <= sum(char.isdigit() for char in value) <= 15
+    return True
+
+
+class KeyMatch:
+    def __init__(self, key, value, engine, source_key, score):
+        self.key = key  # Form b key
+        self.value = value
+        self.engine = engine  # exact, synonym or fuzzy
+        self.source_key = source_key  # Form a key
+        self.score = score
+
+
+def _similarity(a, b):
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def _typo(a, b):
+    # One letter missing or extra, or two adjacent letters swapped. Never a substituted letter,
+    # that is how different words look alike: employer / employee
+    if len(a) < len(b):
+        a, b = b, a
+    if len(a) - len(b) == 1:
+        return any(a[:i] + a[i + 1:] == b for i in range(len(a)))
+    if len(a) == len(b):
+        diff = [i for i in range(len(a)) if a[i] != b[i]]
+        return len(diff) == 2 and diff[1] == diff[0] + 1 and a[diff[0]] == b[diff[1]] and a[diff[1]] == b[diff[0]]
+    return False
+
+
+def _same_words(a, b):
+    words_a, words_b = a.split(), b.split()
+    return len(words_a) == len(words_b) and all(x == y or _typo(x, y) for x, y in zip(words_a, words_b))
+
+
+def match_keys(form_a_pairs: dict, form_b_keys, fuzzy_threshold=KEY_MATCH_FUZZY_THRESHOLD):
+    '''
+    Returns {form b key: KeyMatch} for the form b keys resolved from form a's key value pairs.
+    '''
+    candidates = []
+    for source_key, value in form_a_pairs.items():
+        if isinstance(value, str) and value.strip():
+            candidates.append((source_key, value.strip(), normalize_key(source_key), canonical_key(source_key)))
+
+    matches = {}
+    for key in form_b_keys:
+        normalized, canonical, kind = normalize_key(key), canonical_key(key), field_type(key)
+        if not normalized:
+            continue
+        best, ambiguous = None, False
+        for source_key, value, source_normalized, source_canonical in candidates:
+            if not validate(kind, value):
+                continue
+            if source_normalized == normalized:
+                match = KeyMatch(key, value, "exact", source_key, 1.0)
+            elif source_canonical == canonical:
+                match = KeyMatch(key, value, "synonym", source_key, 0.95)
+            elif source_canonical in SYNONYMS and canonical in SYNONYMS:
+                continue  # Two different known fields, eg: first name / last name
+            elif re.findall(r"\d+", source_normalized) != re.findall(r"\d+", normalized):
+                continue  # Numbered fields, eg: emergency contact 1 / 2
+            elif not (_same_words(source_normalized, normalized) or _same_words(source_canonical, canonical)):
+                continue  # A whole word differs, eg: employer name / employee name
+            else:
+                score = max(_similarity(source_normalized, normalized), _similarity(source_canonical, canonical))
+                if score < fuzzy_threshold:
+                    continue
+                match = KeyMatch(key, value, "fuzzy", source_key, score)
+            if best is None or match.score > best.score:
+                best, ambiguous = match, False
+            elif match.score == best.score and match.value != best.value:
+                ambiguous = True
+        if best is not None and not ambiguous:
+            matches[key] = best
+    return matches
+
+
+def fill_locally(form_a_pairs, kv_pairs_result: dict, key_value_pairs_obj: dict):
+    '''
+    Fills the form b fields resolved from form a in key_value_pairs_obj, tagged with their engine.
+    Returns the matches and the part of the form b schema that still needs the LLM.
+    '''
+    if not KEY_MATCH_ENABLED or not form_a_pairs:
+        return {}, kv_pairs_result
+    matches = match_keys(form_a_pairs, kv_pairs_result)
+    for key, match in matches.items():
+        if key in key_value_pairs_obj:
+            key_value_pairs_obj[key]['Value'] = match.value
+            key_value_pairs_obj[key]['FilledBy'] = match.engine
+    remaining = {key: value for key, value in kv_pairs_result.items() if key not in matches}
+    return matches, remaining
+
+
+def llm_updates(json_res, matches):
+    # The LLM only gets the remaining keys, never let it overwrite a local match
+    if not isinstance(json_res, dict):
+        return {}
+    return {key: value for key, value in json_res.items() if key not in matches}
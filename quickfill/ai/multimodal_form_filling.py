@@ -1,58 +1,24 @@
 import base64
-import io
-import json
-import re
-import time
 
-import openai
-import vertexai
-from langchain.chat_models import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
-from vertexai.preview.generative_models import GenerativeModel, Image, Part
+from quickfill.ai.fill_cache import cached_fill, stream_cached_fill
+from quickfill.ai.json_stream import parse_json_response
+from quickfill.const import GPT4V_IMAGE_DETAIL, VISION_PROVIDER
+from quickfill.preprocess import detect_mime
+from quickfill.providers import get_provider
+from quickfill.singleflight import llm_flight, single_flight
+from quickfill.telemetry import traced
 
 gpt4v_text_prompt = \
 '''Please read the text in this image and return the information in JSON format, if there is no valid result, leave it as blank.
 '''
 
 
-def time_it(func):
-    # This function shows the execution time of
-    # the function object passed
-    def wrap_func(*args, **kwargs):
-        t1 = time.time()
-        result = func(*args, **kwargs)
-        t2 = time.time()
-        print(f"### Function {func.__name__!r} executed in {(t2 - t1):.4f}s ###")
-        return result
-
-    return wrap_func
-
-
-# TODO: Add Google Gemini code
-@time_it
+@traced("llm.gemini")
 def run_gemini(image_path: str, prompt_text: str, project_id: str="aitist-390505", location: str="us-central1") -> str:
-    # Initialize Vertex AI
-    vertexai.init(project=project_id, location=location)
-    
-    # Load the image file into an Image object
-    # Assuming there's a method in the Image class to load from a file path
-    image = Image.load_from_file(image_path)  # This line might need to be adjusted
-    
-    # Load the model
-    multimodal_model = GenerativeModel("gemini-pro-vision")
-
-    # Query the model with the image
-    response = multimodal_model.generate_content(
-        [
-            Part.from_image(image),
-            prompt_text,
-        ]
-    )
-    
-    print(response)
-    # Extract and return the text content from the response
-    for candidate in response.candidates:
-        return candidate.content.parts[0].text
+    # Vertex AI is only imported here, see quickfill/ai/gemini_provider.py
+    return get_provider("vision", "gemini").generate(image_path, prompt_text, project_id=project_id,
+                                                     location=location)
+
 
 # GPT4V
 def get_base64_image(image_source, from_bytes=False):
@@ -64,47 +30,56 @@ def get_base64_image(image_source, from_bytes=False):
             return base64.b64encode(image_file.read()).decode('utf-8')
 
 
+GPT4V_MODEL = "gpt-4-vision-preview"
+GPT4V_TEMPERATURE = 0.7  # ChatOpenAI default
+# Model of each vision provider, see quickfill/providers.py
+VISION_MODELS = {
+    "openai": (GPT4V_MODEL, GPT4V_TEMPERATURE),
+    "gemini": ("gemini-pro-vision", 0.4),  # Vertex AI default
+}
+VISION_MODEL, VISION_TEMPERATURE = VISION_MODELS.get(VISION_PROVIDER, (VISION_PROVIDER, 0))
+
+
+def _read_image_bytes(image_source, from_bytes=False):
+    if from_bytes:
+        return image_source
+    with open(image_source, "rb") as image_file:
+        return image_file.read()
+
+
 # Function to process text with multiple images for form filling
-@time_it
-def process_text_with_images_gpt4v(image_paths, text_input=gpt4v_text_prompt, expected_keys=None, from_bytes=False):
-    # Convert each image to base64 and store in a list
-    base64_images = [get_base64_image(path, from_bytes=from_bytes) for path in image_paths]
+@traced("gpt4v_fill")
+@single_flight(llm_flight)
+def process_text_with_images_gpt4v(image_paths, text_input=gpt4v_text_prompt, expected_keys=None, from_bytes=False,
+                                   use_cache=True):
+    images = [_read_image_bytes(path, from_bytes=from_bytes) for path in image_paths]
+    return cached_fill(lambda: _process_text_with_images_gpt4v(images, text_input, expected_keys),
+                       VISION_MODEL, VISION_TEMPERATURE, text_input,
+                       images, expected_keys, use_cache=use_cache)
 
-    # Create a chain with the ChatOpenAI model for GPT-4 Vision
-    chat = ChatOpenAI(model="gpt-4-vision-preview", max_tokens=2048)
+
+def _vision_prompt(images, text_input, expected_keys):
     if expected_keys:
         text_input = f"{text_input}\nHere are the keys that are expected: {expected_keys}."
+    return text_input, [(detect_mime(image), image) for image in images]
+
+
+def _process_text_with_images_gpt4v(images, text_input, expected_keys):
+    text_input, images = _vision_prompt(images, text_input, expected_keys)
+    res = get_provider("vision").complete_with_images(text_input, images, VISION_MODEL, VISION_TEMPERATURE,
+                                                      detail=GPT4V_IMAGE_DETAIL)
+    return parse_json_response(res)
+
+
+def stream_text_with_images_gpt4v(images, text_input=gpt4v_text_prompt, expected_keys=None, use_cache=True):
+    # Yields ("token", text), ("field", (key, value)) and finally ("result", dict)
+    def stream_tokens():
+        prompt, prompt_images = _vision_prompt(images, text_input, expected_keys)
+        yield from get_provider("vision").stream_with_images(prompt, prompt_images, VISION_MODEL,
+                                                             VISION_TEMPERATURE, detail=GPT4V_IMAGE_DETAIL)
 
-    print("text_input promopt:", text_input)
-    contents = []
-    contents.append({"type": "text", "text": text_input})
-    for img in base64_images:
-        contents.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/jpeg;base64,{img}",
-                "detail": "auto",
-            },
-        })
-
-    message = HumanMessage(content=contents)
-
-    # Invoke the chain with the message
-    response = chat.invoke([message])
-    
-    # Extract and process the response
-    res = response.content
-    # print("Res from GPT4V:", res)
-
-    pattern = r'```json\s*({.*?}|\[.*?])\s*```'
-    # Search for the pattern in the input string
-    match = re.search(pattern, res, re.DOTALL)
-
-    # If a match is found, return the JSON string
-    if match:
-        res = match.group(1)
-    res = json.loads(res)
-    return res
+    return stream_cached_fill(stream_tokens, VISION_MODEL, VISION_TEMPERATURE, text_input,
+                              images, expected_keys, use_cache=use_cache)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+import base64
+
+from langchain.chains import create_extraction_chain
+from langchain.chat_models import ChatOpenAI
+from langchain.prompts import ChatPromptTemplate
+from langchain_core.messages import HumanMessage
+
+# OpenAI backend of the "llm" and "vision" providers, through langchain. See quickfill/providers.py
+
+
+def _image_message(text_input, images, detail):
+    # images: [(mime, bytes)]
+    contents = [{"type": "text", "text": text_input}]
+    for mime, data in images:
+        contents.append({
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}",
+                "detail": detail,
+            },
+        })
+    return HumanMessage(content=contents)
+
+
+class OpenAIProvider:
+    def complete(self, prompt_template, variables, model, temperature) -> str:
+        chain = ChatPromptTemplate.from_template(prompt_template) | ChatOpenAI(model=model, temperature=temperature)
+        return chain.invoke(variables).content
+
+    def stream(self, prompt_template, variables, model, temperature):
+        chat = ChatOpenAI(model=model, temperature=temperature, streaming=True)
+        chain = ChatPromptTemplate.from_template(prompt_template) | chat
+        for chunk in chain.stream(variables):
+            yield chunk.content
+
+    def compile_extraction(self, schema, model, temperature):
+        # run(context_str) of one extraction chain, to reuse for every context of a schema
+        return create_extraction_chain(schema, ChatOpenAI(model=model, temperature=temperature)).run
+
+    def extract(self, schema, context_str, model, temperature):
+        return self.compile_extraction(schema, model, temperature)(context_str)
+
+    def complete_with_images(self, text_input, images, model, temperature, detail="auto", max_tokens=2048) -> str:
+        chat = ChatOpenAI(model=model, temperature=temperature, max_tokens=max_tokens)
+        return chat.invoke([_image_message(text_input, images, detail)]).content
+
+    def stream_with_images(self, text_input, images, model, temperature, detail="auto", max_tokens=2048):
+        chat = ChatOpenAI(model=model, temperature=temperature, max_tokens=max_tokens, streaming=True)
+        for chunk in chat.stream([_image_message(text_input, images, detail)]):
+            yield chunk.content
@@ -0,0 +1,132 @@
+import asyncio
+import base64
+import io
+import json
+import os
+import zipfile
+from enum import Enum
+
+from quickfill.const import BATCH_CONCURRENCY
+from quickfill.pipeline import (fill_form_b_with_images_async,
+                                fill_form_b_with_text_async,
+                                form_a_pairs_async, form_a_text_async,
+                                preprocess_async)
+
+# Fill one applicant's form a (one or several images) into many form b's.
+# Form a is preprocessed and OCR'd once, form b's are filled concurrently with bounded parallelism
+# and results are streamed back in completion order. A failed item doesn't fail the batch.
+
+
+class BatchOutput(Enum):
+    ZIP = "zip"
+    NDJSON = "ndjson"
+
+
+class BatchItem:
+    def __init__(self, index, filename, pdf=None, error=None):
+        self.index = index
+        self.filename = filename
+        self.pdf = pdf
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def manifest(self):
+        entry = {"index": self.index, "filename": self.filename, "status": "ok" if self.ok else "error"}
+        if self.ok:
+            entry["output"] = output_name(self)
+        else:
+            entry["error"] = self.error
+        return entry
+
+
+def output_name(item: BatchItem):
+    # Zip entry name, the client's filename never adds a directory or climbs out of the archive
+    name = os.path.basename((item.filename or "").replace("\\", "/"))
+    stem = name.rsplit(".", 1)[0].strip(". ") or "form"
+    return f"{item.index:03d}_{stem}.pdf"
+
+
+async def batch_fill(form_a_images, form_b_files, use_gpt4v=False, use_cache=True, concurrency=BATCH_CONCURRENCY):
+    '''
+    Async generator of BatchItem, form_b_files is a list of (filename, bytes).
+    '''
+    form_a = await asyncio.gather(*[preprocess_async(image) for image in form_a_images])
+    form_a_pairs = {}
+    if use_gpt4v:
+        form_a_content = [image.data for image in form_a]
+    else:
+        texts, pairs = await asyncio.gather(
+            asyncio.gather(*[form_a_text_async(image) for image in form_a]),
+            asyncio.gather(*[form_a_pairs_async(image) for image in form_a]),
+        )
+        form_a_content = "\n".join(texts)
+        for image_pairs in pairs:
+            # The first image that has a key wins
+            for key, value in image_pairs.items():
+                form_a_pairs.setdefault(key, value)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fill_one(index, filename, image_bytes):
+        async with semaphore:
+            try:
+                form_b = await preprocess_async(image_bytes)
+                if use_gpt4v:
+                    pdf = await fill_form_b_with_images_async(form_b, form_a_content, use_cache=use_cache)
+                else:
+                    pdf = await fill_form_b_with_text_async(form_b, form_a_content, use_cache=use_cache,
+                                                            form_a_pairs=form_a_pairs)
+                return BatchItem(index, filename, pdf=pdf)
+            except Exception as e:
+                return BatchItem(index, filename, error=f"{type(e).__name__}: {e}")
+
+    tasks = [asyncio.ensure_future(fill_one(i, filename, data)) for i, (filename, data) in enumerate(form_b_files)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # Client went away, don't keep paying for the rest of the batch
+        for task in tasks:
+            task.cancel()
+
+
+class _StreamBuffer(io.RawIOBase):
+    # Unseekable sink for zipfile, drained after every entry so the zip streams out
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+async def stream_zip(items):
+    buffer = _StreamBuffer()
+    manifest = []
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        async for item in items:
+            manifest.append(item.manifest())
+            if item.ok:
+                archive.writestr(output_name(item), item.pdf.getvalue())
+                yield buffer.drain()
+        archive.writestr("manifest.json", json.dumps(sorted(manifest, key=lambda entry: entry["index"]), indent=2))
+    yield buffer.drain()
+
+
+async def stream_ndjson(items):
+    async for item in items:
+        entry = item.manifest()
+        if item.ok:
+            entry["pdf_base64"] = base64.b64encode(item.pdf.getvalue()).decode('utf-8')
+        yield json.dumps(entry) + "\n"
@@ -0,0 +1,519 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from quickfill.telemetry import span
+
+try:
+    import fcntl
+except ImportError:  # Windows, disk caches can't be shared between processes
+    fcntl = None
+
+# Two tier cache used for OCR results (and other expensive results keyed by content hash):
+# - memory: bounded LRU of parsed objects, a hit costs a dict lookup
+# - disk: one file per key, bounded by total bytes and TTL, written atomically
+# Disk tiers can be shared by the processes of a host (uvicorn workers): SharedDiskCache keeps one
+# byte budget for all of them, and TieredCache.compute_shared computes a missing entry in one process only.
+# Caches reported by /cache/stats and /metrics are registered with register_cache.
+
+_caches = {}
+
+
+class CacheStats:
+    # shared_hits: misses another process computed while this one waited, see TieredCache.compute_shared
+    # corrupt: disk entries that couldn't be read back, removed and counted as misses
+    FIELDS = ("memory_hits", "disk_hits", "misses", "shared_hits", "writes", "memory_evictions", "disk_evictions",
+              "expired", "corrupt")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(self.FIELDS, 0)
+
+    def incr(self, field, n=1):
+        with self._lock:
+            self._counts[field] += n
+
+    def as_dict(self):
+        with self._lock:
+            counts = dict(self._counts)
+        lookups = counts["memory_hits"] + counts["disk_hits"] + counts["misses"]
+        hits = lookups - counts["misses"] + counts["shared_hits"]
+        counts["hit_ratio"] = hits / lookups if lookups else 0.0
+        return counts
+
+
+class LRUCache:
+    def __init__(self, max_items, stats=None, ttl=0):
+        # ttl (seconds) of 0 means entries never expire
+        self.max_items = max_items
+        self.stats = stats or CacheStats()
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (time.monotonic() it expires at or None, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            expires_at, value = self._data[key]
+            if expires_at is None or time.monotonic() <= expires_at:
+                return value
+            del self._data[key]
+        self.stats.incr("expired")
+        return default
+
+    def set(self, key, value, expires_at=None):
+        # expires_at (a time.monotonic() value) shortens the entry's ttl, eg: to what is left of a disk entry's
+        if self.max_items <= 0:
+            return
+        if self.ttl > 0:
+            expires_at = min(time.monotonic() + self.ttl, expires_at or float("inf"))
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            evicted = 0
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+                evicted += 1
+        if evicted:
+            self.stats.incr("memory_evictions", evicted)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[1] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def json_dumps(value):
+    return json.dumps(value).encode('utf-8')
+
+
+def json_loads(data):
+    return json.loads(data)
+
+
+class DiskCache:
+    def __init__(self, directory, max_bytes=0, ttl=0, suffix=".json",
+                 dumps=json_dumps, loads=json_loads, open_file=None, stats=None):
+        # max_bytes / ttl (seconds) of 0 mean unbounded
+        # open_file(path) is used instead of reading the whole file and calling loads, eg: to mmap it
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.suffix = suffix
+        self.dumps = dumps
+        self.loads = loads
+        self.open_file = open_file
+        self.stats = stats or CacheStats()
+        self._lock = threading.Lock()
+        self._total_bytes = None  # Lazily computed on first write
+
+    def path_for(self, key):
+        return self.directory / f"{key}{self.suffix}"
+
+    def _expired(self, mtime, now=None):
+        return self.ttl > 0 and (now or time.time()) - mtime > self.ttl
+
+    def get(self, key):
+        return self.get_entry(key)[0]
+
+    def get_entry(self, key):
+        # (value, time.monotonic() the entry expires at or None), (None, None) on a miss
+        path = self.path_for(key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None, None
+        if self._expired(stat.st_mtime):
+            self._remove(path, stat.st_size)
+            self.stats.incr("expired")
+            return None, None
+        try:
+            if self.open_file is not None:
+                value = self.open_file(path)
+            else:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                value = self.loads(data)
+        except FileNotFoundError:
+            # Evicted by another thread between stat and open
+            return None, None
+        except (ValueError, OSError):
+            # Empty, truncated or corrupt (eg: left by a crash), dropped so the caller computes it again
+            self._remove(path, stat.st_size)
+            self.stats.incr("corrupt")
+            return None, None
+        expires_at = time.monotonic() + stat.st_mtime + self.ttl - time.time() if self.ttl > 0 else None
+        return value, expires_at
+
+    def _write_temp(self, data):
+        # Written to a temp file in the same directory then renamed, readers never see a torn file
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-", suffix=self.suffix)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+        except BaseException:
+            _unlink(tmp_path)
+            raise
+        return tmp_path
+
+    def set(self, key, value):
+        data = self.dumps(value)
+        tmp_path = self._write_temp(data)
+        path = self.path_for(key)
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        try:
+            os.replace(tmp_path, path)
+        except BaseException:
+            _unlink(tmp_path)
+            raise
+        self.stats.incr("writes")
+        if self.max_bytes > 0:
+            with self._lock:
+                if self._total_bytes is None:
+                    self._total_bytes = self._scan_size()
+                else:
+                    self._total_bytes += len(data) - replaced
+                over_budget = self._total_bytes > self.max_bytes
+            if over_budget:
+                self.evict()
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(self.suffix) and not entry.name.startswith(".tmp-"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _scan_size(self):
+        if not os.path.isdir(self.directory):
+            return 0
+        return sum(size for _, size, _ in self._entries())
+
+    def _remove(self, path, size):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return False
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes -= size
+        return True
+
+    def evict(self):
+        # Drop expired entries, then the oldest ones until we are under 90% of the budget,
+        # so we don't rescan the directory on every write once the cache is full
+        now = time.time()
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        low_water = self.max_bytes * 0.9 if self.max_bytes > 0 else None
+        evicted = expired = 0
+        for mtime, size, path in entries:
+            if self._expired(mtime, now):
+                expired += 1
+            elif low_water is not None and total > low_water:
+                evicted += 1
+            else:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        with self._lock:
+            self._total_bytes = total
+        self.stats.incr("disk_evictions", evicted)
+        self.stats.incr("expired", expired)
+        return evicted + expired
+
+    def delete(self, key):
+        path = self.path_for(key)
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return
+        self._remove(path, size)
+
+    def size_bytes(self):
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan_size()
+            return self._total_bytes
+
+    @contextmanager
+    def claim(self, key):
+        '''
+        Per key claim across the threads and processes using this directory, never waits: yields True to
+        the one caller holding it and False to the others. flock releases it when a process dies.
+        '''
+        if fcntl is None:
+            yield True
+            return
+        lock_file = self._claim_lock_file(key)
+        if lock_file is None:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            # Removed while still held, a caller that opened it before then finds the entry published
+            _unlink(lock_file.name)
+            lock_file.close()
+
+    def _claim_lock_file(self, key):
+        lock_directory = self.directory / ".locks"
+        os.makedirs(lock_directory, exist_ok=True)
+        path = str(lock_directory / f"{hashlib.md5(key.encode('utf-8')).hexdigest()}.lock")
+        while True:
+            lock_file = open(path, 'ab')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return None
+            # The previous holder may have removed the file between our open and flock, claim the current one
+            try:
+                current = os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                return lock_file
+            lock_file.close()
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+class SharedDiskCache(DiskCache):
+    '''
+    DiskCache whose directory is shared by several processes. A SQLite index (WAL) next to the entries
+    holds their sizes, so max_bytes is one budget for every process, and entries are published, expired
+    and evicted under its write lock. The index is built from the files already there on first use.
+    '''
+    INDEX_NAME = ".index.sqlite3"
+
+    def __init__(self, directory, **kwargs):
+        super().__init__(directory, **kwargs)
+        self._local = threading.local()
+        self._index_ready = False
+
+    def _connect(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            os.makedirs(self.directory, exist_ok=True)
+            connection = sqlite3.connect(self.directory / self.INDEX_NAME, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        if not self._index_ready:
+            with self._transaction(connection):
+                connection.execute("CREATE TABLE IF NOT EXISTS entries "
+                                   "(key TEXT PRIMARY KEY, size INTEGER NOT NULL, created REAL NOT NULL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS entries_created ON entries (created)")
+                connection.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY, bytes INTEGER)")
+                if connection.execute("SELECT bytes FROM totals").fetchone() is None:
+                    entries = [(os.path.basename(path)[:-len(self.suffix)], size, mtime)
+                               for mtime, size, path in self._entries()]
+                    connection.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", entries)
+                    connection.execute("INSERT INTO totals VALUES (1, ?)", (sum(size for _, size, _ in entries),))
+            self._index_ready = True
+        return connection
+
+    @contextmanager
+    def _transaction(self, connection=None):
+        connection = connection or self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _forget(self, connection, key):
+        row = connection.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            connection.execute("UPDATE totals SET bytes = bytes - ?", (row[0],))
+
+    def set(self, key, value):
+        data = self.dumps(value)
+        tmp_path = self._write_temp(data)
+        try:
+            with self._transaction() as connection:
+                os.replace(tmp_path, self.path_for(key))
+                self._forget(connection, key)
+                connection.execute("INSERT INTO entries VALUES (?, ?, ?)", (key, len(data), time.time()))
+                connection.execute("UPDATE totals SET bytes = bytes + ?", (len(data),))
+                if self.max_bytes > 0:
+                    total = connection.execute("SELECT bytes FROM totals").fetchone()[0]
+                    if total > self.max_bytes:
+                        self._evict(connection, total)
+        except BaseException:
+            _unlink(tmp_path)
+            raise
+        self.stats.incr("writes")
+
+    def _evict(self, connection, total):
+        # Expired entries, then the oldest ones until we are under 90% of the budget
+        now = time.time()
+        low_water = self.max_bytes * 0.9 if self.max_bytes > 0 else None
+        evicted = expired = 0
+        for key, size, created in connection.execute("SELECT key, size, created FROM entries ORDER BY created")\
+                .fetchall():
+            if self._expired(created, now):
+                expired += 1
+            elif low_water is not None and total > low_water:
+                evicted += 1
+            else:
+                break
+            _unlink(self.path_for(key))
+            self._forget(connection, key)
+            total -= size
+        self.stats.incr("disk_evictions", evicted)
+        self.stats.incr("expired", expired)
+        return evicted + expired
+
+    def evict(self):
+        with self._transaction() as connection:
+            return self._evict(connection, connection.execute("SELECT bytes FROM totals").fetchone()[0])
+
+    def _remove(self, path, size):
+        key = os.path.basename(path)[:-len(self.suffix)]
+        with self._transaction() as connection:
+            removed = _unlink(path)
+            self._forget(connection, key)
+        return removed
+
+    def size_bytes(self):
+        # Reading the stats of a cache nothing was written to yet doesn't create its index
+        if not self._index_ready and not os.path.exists(self.directory / self.INDEX_NAME):
+            return self._scan_size()
+        return self._connect().execute("SELECT bytes FROM totals").fetchone()[0]
+
+
+class TieredCache:
+    def __init__(self, name, memory_items, disk=None, wait_timeout=300, poll_interval=0.05):
+        # wait_timeout / poll_interval (seconds): see compute_shared
+        self.name = name
+        self.span_name = f"cache.{name}"
+        self.stats = CacheStats()
+        # Memory entries expire with the disk tier's TTL, never outliving the copy on disk
+        self.memory = LRUCache(memory_items, stats=self.stats, ttl=disk.ttl if disk is not None else 0)
+        self.disk = disk
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        if disk is not None:
+            disk.stats = self.stats
+
+    def get(self, key):
+        with span(self.span_name):
+            return self._get(key)
+
+    def _get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self.stats.incr("memory_hits")
+            return value
+        if self.disk is not None:
+            value, expires_at = self.disk.get_entry(key)
+            if value is not None:
+                self.stats.incr("disk_hits")
+                # Expires from memory when the copy on disk does
+                self.memory.set(key, value, expires_at)
+                return value
+        self.stats.incr("misses")
+        return None
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def compute_shared(self, key, compute, *args, **kwargs):
+        '''
+        After a miss: compute(*args, **kwargs), stored and returned. With a disk tier, the first caller claims
+        the key and computes it, callers missing the same key meanwhile (in any process) poll the disk for what
+        it publishes, taking over if its claim is released without a result, and compute it themselves after
+        wait_timeout seconds.
+        '''
+        if self.disk is None:
+            return self._compute_and_set(key, compute, *args, **kwargs)
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            with self.disk.claim(key) as claimed:
+                if claimed:
+                    value = self._get_published(key)
+                    if value is None:
+                        value = self._compute_and_set(key, compute, *args, **kwargs)
+                    return value
+            value = self._get_published(key)
+            if value is not None:
+                return value
+            if time.monotonic() >= deadline:
+                return self._compute_and_set(key, compute, *args, **kwargs)
+            time.sleep(self.poll_interval)
+
+    def _get_published(self, key):
+        value, expires_at = self.disk.get_entry(key)
+        if value is not None:
+            self.stats.incr("shared_hits")
+            self.memory.set(key, value, expires_at)
+        return value
+
+    def _compute_and_set(self, key, compute, *args, **kwargs):
+        value = compute(*args, **kwargs)
+        self.set(key, value)
+        return value
+
+    def delete(self, key):
+        self.memory.pop(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def info(self):
+        info = self.stats.as_dict()
+        info["memory_items"] = len(self.memory)
+        if self.disk is not None:
+            info["disk_bytes"] = self.disk.size_bytes()
+            info["disk_max_bytes"] = self.disk.max_bytes
+        return info
+
+
+def register_cache(cache):
+    # Reported by get_cache_stats, replaces a cache registered under the same name
+    _caches[cache.name] = cache
+    return cache
+
+
+def get_cache_stats():
+    return {name: cache.info() for name, cache in _caches.items()}
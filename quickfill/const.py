@@ -1,6 +1,5 @@
 import os
 import pathlib
-import time
 import uuid
 
 TRUE_CUR_PATH = os.path.dirname(__file__)
@@ -9,8 +8,94 @@ TRUE_CUR_PATH = TRUE_CUR_PATH if TRUE_CUR_PATH != "" else "."
 pl_TRUE_CUR_PATH = pathlib.Path(TRUE_CUR_PATH)
 BASE_PATH = pl_TRUE_CUR_PATH.parent.parent
 DATA_PATH = BASE_PATH / 'data'
-CACHE_PATH = DATA_PATH / 'cache'
-CACHE_PATH.mkdir(parents=True, exist_ok=True)
+CACHE_PATH = DATA_PATH / 'cache'  # Created on the first write, see quickfill/cache.py
+
+# Max form b's filled at once per batch request, see quickfill/batch.py
+BATCH_CONCURRENCY = int(os.environ.get("QUICKFILL_BATCH_CONCURRENCY", 8))
+
+# OCR result cache, see quickfill/cache.py
+# 0 disables the limit
+OCR_CACHE_MEMORY_ITEMS = int(os.environ.get("QUICKFILL_OCR_CACHE_MEMORY_ITEMS", 256))
+OCR_CACHE_MAX_BYTES = int(os.environ.get("QUICKFILL_OCR_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+OCR_CACHE_TTL = int(os.environ.get("QUICKFILL_OCR_CACHE_TTL", 30 * 24 * 3600))
+
+# LLM fill result cache, see quickfill/ai/fill_cache.py
+FILL_CACHE_PATH = DATA_PATH / 'fill_cache'
+FILL_CACHE_MEMORY_ITEMS = int(os.environ.get("QUICKFILL_FILL_CACHE_MEMORY_ITEMS", 1024))
+FILL_CACHE_MAX_BYTES = int(os.environ.get("QUICKFILL_FILL_CACHE_MAX_BYTES", 256 * 1024 ** 2))
+FILL_CACHE_TTL = int(os.environ.get("QUICKFILL_FILL_CACHE_TTL", 7 * 24 * 3600))
+
+# Large form b schemas are filled in chunks of keys, see quickfill/ai/chunked_fill.py
+# TOKENS is the schema token budget and MAX_KEYS the max keys of one LLM call (0 disables the limit),
+# PARALLELISM is the max chunk calls in flight per fill
+LLM_CHUNK_TOKENS = int(os.environ.get("QUICKFILL_LLM_CHUNK_TOKENS", 1500))
+LLM_CHUNK_MAX_KEYS = int(os.environ.get("QUICKFILL_LLM_CHUNK_MAX_KEYS", 40))
+LLM_CHUNK_PARALLELISM = int(os.environ.get("QUICKFILL_LLM_CHUNK_PARALLELISM", 4))
+
+# Many contexts extracted against one schema, see quickfill/ai/batch_extraction.py
+# TOKENS is the budget of one request (schema plus packed contexts), MAX_DOCUMENTS the max contexts per request,
+# PARALLELISM is the max requests in flight per batch
+LLM_BATCH_TOKENS = int(os.environ.get("QUICKFILL_LLM_BATCH_TOKENS", 6000))
+LLM_BATCH_MAX_DOCUMENTS = int(os.environ.get("QUICKFILL_LLM_BATCH_MAX_DOCUMENTS", 8))
+LLM_BATCH_PARALLELISM = int(os.environ.get("QUICKFILL_LLM_BATCH_PARALLELISM", 4))
+
+# Local form a -> form b key matching before the LLM, see quickfill/ai/key_matcher.py
+KEY_MATCH_ENABLED = os.environ.get("QUICKFILL_KEY_MATCH", "1") == "1"
+KEY_MATCH_FUZZY_THRESHOLD = float(os.environ.get("QUICKFILL_KEY_MATCH_FUZZY_THRESHOLD", 0.88))
+
+# Registered blank form b templates, see quickfill/templates.py
+TEMPLATES_PATH = DATA_PATH / 'templates'
+TEMPLATES_ENABLED = os.environ.get("QUICKFILL_TEMPLATES", "1") == "1"
+# Max differing bits (out of 256) between a scan's perceptual hash and its template's
+TEMPLATE_MATCH_MAX_DISTANCE = int(os.environ.get("QUICKFILL_TEMPLATE_MATCH_MAX_DISTANCE", 24))
+
+# Upload preprocessing, see quickfill/preprocess.py. 0 disables resizing / the byte budget
+PREPROCESS_MAX_DIMENSION = int(os.environ.get("QUICKFILL_PREPROCESS_MAX_DIMENSION", 2400))
+PREPROCESS_TARGET_BYTES = int(os.environ.get("QUICKFILL_PREPROCESS_TARGET_BYTES", 1536 * 1024))
+PREPROCESS_GRAYSCALE = os.environ.get("QUICKFILL_PREPROCESS_GRAYSCALE", "0") == "1"
+PREPROCESS_CACHE_ITEMS = int(os.environ.get("QUICKFILL_PREPROCESS_CACHE_ITEMS", 64))
+# GPT-4V image detail: low, high or auto
+GPT4V_IMAGE_DETAIL = os.environ.get("QUICKFILL_GPT4V_IMAGE_DETAIL", "auto")
+
+# Filled field layout, see quickfill/pdf/layout.py. Font sizes are in page units (scan pixels)
+# Values that would shrink below WRAP_SHRINK of the box's font size are wrapped onto several lines instead
+LAYOUT_FONT_NAME = os.environ.get("QUICKFILL_LAYOUT_FONT_NAME", "Helvetica")
+LAYOUT_MAX_FONT_SIZE = float(os.environ.get("QUICKFILL_LAYOUT_MAX_FONT_SIZE", 24))
+LAYOUT_WRAP = os.environ.get("QUICKFILL_LAYOUT_WRAP", "1") == "1"
+LAYOUT_WRAP_SHRINK = float(os.environ.get("QUICKFILL_LAYOUT_WRAP_SHRINK", 0.5))
+
+# Incremental re-fill sessions of /ai_process_form/?session_id=..., see quickfill/refill.py
+# Sessions kept per API process, and seconds one is kept after its last fill
+REFILL_SESSION_ITEMS = int(os.environ.get("QUICKFILL_REFILL_SESSION_ITEMS", 256))
+REFILL_SESSION_TTL = float(os.environ.get("QUICKFILL_REFILL_SESSION_TTL", 1800))
+
+# Uploads, see quickfill/upload.py. Larger uploads are spooled to disk instead of kept in memory,
+# MAX_BYTES is per file and MAX_REQUEST_BYTES per request body, 0 disables a limit
+UPLOAD_SPOOL_BYTES = int(os.environ.get("QUICKFILL_UPLOAD_SPOOL_BYTES", 1024 ** 2))
+UPLOAD_MAX_BYTES = int(os.environ.get("QUICKFILL_UPLOAD_MAX_BYTES", 50 * 1024 ** 2))
+UPLOAD_MAX_REQUEST_BYTES = int(os.environ.get("QUICKFILL_UPLOAD_MAX_REQUEST_BYTES", 256 * 1024 ** 2))
+
+# Asynchronous fill jobs, see quickfill/jobs.py
+JOBS_PATH = DATA_PATH / 'jobs'
+# Worker processes started by each API process. Workers run on their own with `python -m quickfill.jobs`,
+# with several API processes (uvicorn --workers) a value above 0 starts that many per process
+JOB_WORKERS = int(os.environ.get("QUICKFILL_JOB_WORKERS", 0))
+# Jobs in flight per worker process
+JOB_WORKER_CONCURRENCY = int(os.environ.get("QUICKFILL_JOB_WORKER_CONCURRENCY", 4))
+JOB_MAX_ATTEMPTS = int(os.environ.get("QUICKFILL_JOB_MAX_ATTEMPTS", 3))
+# Seconds a claimed job stays hidden from other workers, extended while its worker is alive
+JOB_VISIBILITY_TIMEOUT = float(os.environ.get("QUICKFILL_JOB_VISIBILITY_TIMEOUT", 300))
+# Delay before the first retry, doubled for each one after
+JOB_RETRY_DELAY = float(os.environ.get("QUICKFILL_JOB_RETRY_DELAY", 5))
+# Seconds finished jobs and their PDFs are kept
+JOB_RETENTION = float(os.environ.get("QUICKFILL_JOB_RETENTION", 7 * 24 * 3600))
+# Hosts callback URLs may point to
+JOB_CALLBACK_HOSTS = set(os.environ.get("QUICKFILL_JOB_CALLBACK_HOSTS", "localhost,127.0.0.1,::1").split(","))
+
+# AWS Textract client, match TEXTRACT_TPS to the account's AnalyzeDocument quota
+TEXTRACT_TPS = float(os.environ.get("QUICKFILL_TEXTRACT_TPS", 5))
+TEXTRACT_BURST = float(os.environ.get("QUICKFILL_TEXTRACT_BURST", 5))
+TEXTRACT_MAX_RETRIES = int(os.environ.get("QUICKFILL_TEXTRACT_MAX_RETRIES", 5))
 
 # Check the auto root path is correct
 try:
@@ -21,19 +106,48 @@ except Exception as e:
     print("Exception:", e)
 
 
-def generate_random_id(length=36):
-    return str(uuid.uuid4())[:length]
+# OCR, LLM and vision backends, imported on first use, see quickfill/providers.py
+OCR_PROVIDER = os.environ.get("QUICKFILL_OCR_PROVIDER", "textract")
+LLM_PROVIDER = os.environ.get("QUICKFILL_LLM_PROVIDER", "openai")
+VISION_PROVIDER = os.environ.get("QUICKFILL_VISION_PROVIDER", "openai")
+# Local OCR, see quickfill/ocr/tesseract.py. QUICKFILL_OCR_PROVIDER=tesseract only uses it,
+# =local_first (quickfill/ocr/routing.py) sends an image to OCR_FALLBACK_PROVIDER when the local result's
+# mean word confidence (0-100) is under OCR_LOCAL_MIN_CONFIDENCE, it has under OCR_LOCAL_MIN_WORDS words,
+# or no key value pair when form fields were asked for
+OCR_LOCAL_PROVIDER = os.environ.get("QUICKFILL_OCR_LOCAL_PROVIDER", "tesseract")
+OCR_FALLBACK_PROVIDER = os.environ.get("QUICKFILL_OCR_FALLBACK_PROVIDER", "textract")
+OCR_LOCAL_MIN_CONFIDENCE = float(os.environ.get("QUICKFILL_OCR_LOCAL_MIN_CONFIDENCE", 80))
+OCR_LOCAL_MIN_WORDS = int(os.environ.get("QUICKFILL_OCR_LOCAL_MIN_WORDS", 5))
+TESSERACT_COMMAND = os.environ.get("QUICKFILL_TESSERACT_COMMAND", "tesseract")
+TESSERACT_LANGUAGES = os.environ.get("QUICKFILL_TESSERACT_LANGUAGES", "eng")
+TESSERACT_TIMEOUT = float(os.environ.get("QUICKFILL_TESSERACT_TIMEOUT", 60))
+# Load the configured providers at startup instead of on the first request
+PRELOAD_PROVIDERS = os.environ.get("QUICKFILL_PRELOAD_PROVIDERS", "0") == "1"
 
+# Request tracing and /metrics, see quickfill/telemetry.py
+TELEMETRY_ENABLED = os.environ.get("QUICKFILL_TELEMETRY", "1") == "1"
 
-def time_it(func):
-    # This function shows the execution time of
-    # the function object passed
-    def wrap_func(*args, **kwargs):
-        t1 = time.time()
-        result = func(*args, **kwargs)
-        t2 = time.time()
-        print(f"### Function {func.__name__!r} executed in {(t2 - t1):.4f}s ###")
-        return result
 
-    return wrap_func
+# Execution settings for each pipeline stage, see quickfill/executor.py
+# Network bound stages (Textract, LLM) get more threads than CPU bound ones (image decode, PDF)
+# WORKERS is the pool size, CONCURRENCY is the max number of in-flight calls per stage
+_CPU_COUNT = os.cpu_count() or 2
+STAGE_WORKERS = {
+    "ocr": int(os.environ.get("QUICKFILL_OCR_WORKERS", 16)),
+    "llm": int(os.environ.get("QUICKFILL_LLM_WORKERS", 16)),
+    "image": int(os.environ.get("QUICKFILL_IMAGE_WORKERS", _CPU_COUNT)),
+    "pdf": int(os.environ.get("QUICKFILL_PDF_WORKERS", _CPU_COUNT)),
+}
+STAGE_CONCURRENCY = {
+    "ocr": int(os.environ.get("QUICKFILL_OCR_CONCURRENCY", 16)),
+    "llm": int(os.environ.get("QUICKFILL_LLM_CONCURRENCY", 8)),
+    "image": int(os.environ.get("QUICKFILL_IMAGE_CONCURRENCY", _CPU_COUNT * 2)),
+    "pdf": int(os.environ.get("QUICKFILL_PDF_CONCURRENCY", _CPU_COUNT * 2)),
+}
+# "thread" or "process", only applies to the CPU bound stages
+CPU_STAGE_EXECUTOR = os.environ.get("QUICKFILL_CPU_EXECUTOR", "thread")
+
+
+def generate_random_id(length=36):
+    return str(uuid.uuid4())[:length]
 
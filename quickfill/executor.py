@@ -0,0 +1,260 @@
+import asyncio
+import collections
+import contextvars
+import functools
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from enum import Enum
+
+from quickfill.const import CPU_STAGE_EXECUTOR, STAGE_CONCURRENCY, STAGE_WORKERS
+from quickfill.telemetry import stage_call
+
+
+class Stage(Enum):
+    # Network bound
+    OCR = "ocr"
+    LLM = "llm"
+    # CPU bound
+    IMAGE = "image"
+    PDF = "pdf"
+
+    @property
+    def cpu_bound(self):
+        return self in (Stage.IMAGE, Stage.PDF)
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+class StageLimit:
+    '''
+    At most `limit` calls of a stage in flight in this process. Event loops wait for a slot with acquire(),
+    blocking code already running on a stage's pool borrows extra ones with try_acquire() (see map_in_stage),
+    so both draw from the same budget. A released slot is handed to the oldest waiting coroutine.
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self._waiters = collections.deque()  # (loop, future)
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.in_use < self.limit and not self._waiters:
+                self.in_use += 1
+                return True
+            return False
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.in_use < self.limit and not self._waiters:
+                self.in_use += 1
+                return
+            waiter = loop.create_future()
+            self._waiters.append((loop, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove((loop, waiter))
+                    handed = False
+                except ValueError:
+                    handed = True
+            if handed:
+                # The slot was handed over while we were being cancelled, pass it on
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                loop, waiter = self._waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._hand_over, waiter)
+                    return
+                except RuntimeError:
+                    # Its loop is closed
+                    continue
+            self.in_use -= 1
+
+    def _hand_over(self, waiter):
+        if waiter.cancelled():
+            self.release()
+        else:
+            waiter.set_result(None)
+
+
+_limits = {stage: StageLimit(STAGE_CONCURRENCY[stage.value]) for stage in Stage}
+
+
+def get_executor(stage: Stage):
+    executor = _executors.get(stage)
+    if executor is not None:
+        return executor
+    with _executors_lock:
+        if stage not in _executors:
+            workers = STAGE_WORKERS[stage.value]
+            if stage.cpu_bound and CPU_STAGE_EXECUTOR == "process":
+                _executors[stage] = ProcessPoolExecutor(max_workers=workers)
+            else:
+                _executors[stage] = ThreadPoolExecutor(max_workers=workers,
+                                                       thread_name_prefix=f"quickfill-{stage.value}")
+        return _executors[stage]
+
+
+def _bind_context(executor, func):
+    # Threads see the caller's trace (quickfill/telemetry.py), process pools can't pickle a context
+    if isinstance(executor, ThreadPoolExecutor):
+        return functools.partial(contextvars.copy_context().run, func)
+    return func
+
+
+def _picklable(executor, args):
+    # A memoryview (a spooled upload, quickfill/upload.py) is copied once to cross a process boundary
+    if isinstance(executor, ProcessPoolExecutor):
+        return [bytes(arg) if isinstance(arg, memoryview) else arg for arg in args]
+    return args
+
+
+class _Slot:
+    def __init__(self, stage: Stage):
+        self.limit = _limits[stage]
+
+    async def __aenter__(self):
+        await self.limit.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self.limit.release()
+
+
+async def run_in_stage(stage: Stage, func, *args, **kwargs):
+    '''
+    Run a blocking function on the pool of the given stage and await its result.
+    At most STAGE_CONCURRENCY[stage] calls run at once, the rest wait on the event loop.
+    '''
+    loop = asyncio.get_running_loop()
+    async with _Slot(stage):
+        executor = get_executor(stage)
+        call = functools.partial(func, *_picklable(executor, args), **kwargs)
+        with stage_call(stage.value):
+            return await loop.run_in_executor(executor, _bind_context(executor, call))
+
+
+def map_in_stage(stage: Stage, func, items, parallelism):
+    '''
+    Blocking [func(item) for item in items] for code already running on a stage's pool (eg: the chunks of one
+    LLM fill). The calling thread works through the items with the slot it already holds, and up to
+    parallelism - 1 helpers join it on the stage's pool while the stage has free slots. The stage's
+    concurrency limit and in-flight gauge keep covering every call.
+    '''
+    items = list(items)
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    pending = collections.deque(enumerate(items))
+    running = []
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index, item = pending.popleft()
+                done = threading.Event()
+                running.append(done)
+            try:
+                results[index] = func(item)
+            except BaseException as e:
+                errors[index] = e
+            finally:
+                done.set()
+
+    def helper():
+        try:
+            with stage_call(stage.value):
+                work()
+        finally:
+            limit.release()
+
+    limit = _limits[stage]
+    executor = get_executor(stage)
+    for _ in range(min(parallelism, len(items)) - 1):
+        if not limit.try_acquire():
+            break
+        executor.submit(_bind_context(executor, helper))
+    work()
+    # Helpers that haven't started by now find nothing left to do, only wait for the items in progress
+    for done in list(running):
+        done.wait()
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
+
+
+async def iterate_in_stage(stage: Stage, func, *args, **kwargs):
+    '''
+    Run a blocking generator on the pool of the given stage and yield its items on the event loop.
+    The stage's concurrency slot is held until the generator's thread is done, when the consumer stops early
+    the thread stops at the generator's next item and releases it then.
+    '''
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    stop = threading.Event()
+    finished = object()
+    limit = _limits[stage]
+
+    def put(item, error=None):
+        try:
+            loop.call_soon_threadsafe(items.put_nowait, (item, error))
+        except RuntimeError:
+            # Event loop already closed, nobody is listening anymore
+            stop.set()
+
+    def produce():
+        try:
+            with stage_call(stage.value):
+                generator = func(*args, **kwargs)
+                try:
+                    for item in generator:
+                        if stop.is_set():
+                            return
+                        put(item)
+                finally:
+                    if hasattr(generator, "close"):
+                        generator.close()
+        except BaseException as e:
+            put(finished, e)
+        else:
+            put(finished)
+        finally:
+            limit.release()
+
+    await limit.acquire()
+    try:
+        executor = get_executor(stage)
+        loop.run_in_executor(executor, _bind_context(executor, produce))
+    except BaseException:
+        limit.release()
+        raise
+    try:
+        while True:
+            item, error = await items.get()
+            if item is finished:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def shutdown_executors(wait=True):
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown(wait=wait)
+        _executors.clear()
@@ -0,0 +1,378 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import shutil
+import socket
+import sqlite3
+import time
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+from enum import Enum
+from typing import Optional
+
+from quickfill.const import (JOB_CALLBACK_HOSTS, JOB_MAX_ATTEMPTS,
+                             JOB_RETENTION, JOB_RETRY_DELAY,
+                             JOB_VISIBILITY_TIMEOUT, JOB_WORKER_CONCURRENCY,
+                             JOB_WORKERS, JOBS_PATH, generate_random_id)
+from quickfill.pipeline import (filea_to_fileb_fill_async,
+                                gpt4v_filea_to_fileb_fill_async,
+                                process_image_and_text_async)
+
+# Asynchronous fill jobs, for fills that outlast a load balancer's timeout (GPT-4V) or a worker restart.
+# Jobs are rows of a SQLite database next to their input files and result PDF (JOBS_PATH/<job id>/),
+# and are run by worker processes separate from the API, started on their own:
+#
+#   python -m quickfill.jobs --workers 4
+#
+# or, for a single API process, with it (QUICKFILL_JOB_WORKERS).
+#
+# A worker claims a job for JOB_VISIBILITY_TIMEOUT seconds and extends the claim while it runs it.
+# A job whose worker died becomes visible again once the claim expires. Failed attempts are retried
+# with exponential backoff up to JOB_MAX_ATTEMPTS. Finished jobs are kept JOB_RETENTION seconds.
+
+logger = logging.getLogger("quickfill.jobs")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    callback_url TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    visible_at REAL NOT NULL,
+    worker TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_visible ON jobs (status, visible_at);
+"""
+RESULT_FILE = "result.pdf"
+
+
+class JobKind(Enum):
+    GENERAL_FILL = "general_fill_form_files"
+    GPT4V_FILL = "gpt4v_general_fill_form_files"
+    PROCESS_FORM = "ai_process_form"
+
+
+class JobStatus(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+def validate_callback_url(url):
+    # Callbacks only go to local services, never to a host picked by the client
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme not in ("http", "https") or parsed.hostname not in JOB_CALLBACK_HOSTS:
+        raise ValueError(f"Callback URLs must be http(s) on one of: {', '.join(sorted(JOB_CALLBACK_HOSTS))}")
+    return url
+
+
+class JobStore:
+    def __init__(self, directory, visibility_timeout=JOB_VISIBILITY_TIMEOUT, max_attempts=JOB_MAX_ATTEMPTS,
+                 retry_delay=JOB_RETRY_DELAY, retention=JOB_RETENTION):
+        self.directory = pathlib.Path(directory)
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retention = retention
+        self._initialized = False
+
+    def _connect(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.directory / "jobs.sqlite3", timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        if not self._initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+            self._initialized = True
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers never claim the same job
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def job_path(self, job_id):
+        return self.directory / job_id
+
+    def _info(self, row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        if job["status"] == JobStatus.DONE.value:
+            job["result_url"] = f"/jobs/{job['id']}/result"
+        return job
+
+    def submit(self, kind: JobKind, inputs, params=None, callback_url=None) -> dict:
+        # inputs: name -> bytes-like, stored as files until the job is done
+        job_id = generate_random_id()
+        path = self.job_path(job_id)
+        path.mkdir(parents=True)
+        for name, data in inputs.items():
+            (path / name).write_bytes(data)
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT INTO jobs (id, kind, status, params, callback_url, visible_at, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind.value, JobStatus.QUEUED.value, json.dumps(params or {}), callback_url, now, now, now))
+        return self.get(job_id)
+
+    def get(self, job_id) -> Optional[dict]:
+        connection = self._connect()
+        try:
+            return self._info(connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+        finally:
+            connection.close()
+
+    def claim(self, worker, reaped=None) -> Optional[dict]:
+        '''
+        The oldest visible job, queued or running with an expired claim, now claimed by worker.
+        Jobs whose worker died on their last attempt are failed on the way and appended to reaped (a list).
+        '''
+        lost = []
+        now = time.time()
+        with self._transaction() as connection:
+            while True:
+                row = connection.execute(
+                    "SELECT * FROM jobs WHERE status IN (?, ?) AND visible_at <= ? ORDER BY visible_at LIMIT 1",
+                    (JobStatus.QUEUED.value, JobStatus.RUNNING.value, now)).fetchone()
+                if row is None or row["attempts"] < self.max_attempts:
+                    break
+                # Its worker died on the last attempt
+                connection.execute("UPDATE jobs SET status = ?, error = ?, updated = ?, finished = ? WHERE id = ?",
+                                   (JobStatus.FAILED.value, "Worker lost", now, now, row["id"]))
+                lost.append(row["id"])
+            if reaped is not None:
+                reaped.extend(self._info(connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+                              for job_id in lost)
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, worker = ?, visible_at = ?, updated = ? "
+                "WHERE id = ?",
+                (JobStatus.RUNNING.value, worker, now + self.visibility_timeout, now, row["id"]))
+            row = connection.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+        return self._info(row)
+
+    def extend(self, job_id, worker) -> bool:
+        # False once the claim was lost to another worker
+        now = time.time()
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET visible_at = ?, updated = ? WHERE id = ? AND worker = ? AND status = ?",
+                (now + self.visibility_timeout, now, job_id, worker, JobStatus.RUNNING.value))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, pdf) -> Optional[dict]:
+        path = self.job_path(job_id)
+        partial = path / f"{RESULT_FILE}.{worker.replace(':', '_')}"
+        partial.write_bytes(pdf)
+        now = time.time()
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET status = ?, error = NULL, updated = ?, finished = ? "
+                "WHERE id = ? AND worker = ? AND status = ?",
+                (JobStatus.DONE.value, now, now, job_id, worker, JobStatus.RUNNING.value))
+            if cursor.rowcount != 1:
+                partial.unlink()
+                return None
+            os.replace(partial, path / RESULT_FILE)
+        for name in os.listdir(path):
+            if name != RESULT_FILE:
+                os.unlink(path / name)
+        return self.get(job_id)
+
+    def fail(self, job_id, worker, error) -> Optional[dict]:
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute("SELECT attempts FROM jobs WHERE id = ? AND worker = ? AND status = ?",
+                                     (job_id, worker, JobStatus.RUNNING.value)).fetchone()
+            if row is None:
+                return None
+            if row["attempts"] < self.max_attempts:
+                delay = self.retry_delay * 2 ** (row["attempts"] - 1)
+                connection.execute("UPDATE jobs SET status = ?, error = ?, visible_at = ?, updated = ? WHERE id = ?",
+                                   (JobStatus.QUEUED.value, error, now + delay, now, job_id))
+            else:
+                connection.execute("UPDATE jobs SET status = ?, error = ?, updated = ?, finished = ? WHERE id = ?",
+                                   (JobStatus.FAILED.value, error, now, now, job_id))
+        return self.get(job_id)
+
+    def result_path(self, job_id):
+        return self.job_path(job_id) / RESULT_FILE
+
+    def purge(self) -> int:
+        # Removes jobs finished more than retention seconds ago, with their files
+        cutoff = time.time() - self.retention
+        with self._transaction() as connection:
+            ids = [row["id"] for row in connection.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) AND finished < ?",
+                (JobStatus.DONE.value, JobStatus.FAILED.value, cutoff))]
+            connection.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in ids])
+        for job_id in ids:
+            shutil.rmtree(self.job_path(job_id), ignore_errors=True)
+        return len(ids)
+
+    def info(self):
+        counts = dict.fromkeys((status.value for status in JobStatus), 0)
+        connection = self._connect()
+        try:
+            for row in connection.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status"):
+                counts[row["status"]] = row["count"]
+        finally:
+            connection.close()
+        return counts
+
+
+job_store = JobStore(JOBS_PATH)
+
+
+async def run_job(store: JobStore, job) -> bytes:
+    path = store.job_path(job["id"])
+    params = job["params"]
+    use_cache = params.get("use_cache", True)
+    kind = JobKind(job["kind"])
+    form_b = (path / "form_b").read_bytes()
+    if kind == JobKind.PROCESS_FORM:
+        pdf = await process_image_and_text_async(form_b, params["text_description"], use_cache=use_cache)
+    elif kind == JobKind.GPT4V_FILL:
+        pdf = await gpt4v_filea_to_fileb_fill_async((path / "form_a").read_bytes(), form_b, use_cache=use_cache)
+    else:
+        pdf = await filea_to_fileb_fill_async((path / "form_a").read_bytes(), form_b, use_cache=use_cache)
+    return pdf.getvalue()
+
+
+def notify(job, timeout=10):
+    # POSTs the job's status to its callback URL, a failed callback doesn't fail the job
+    request = urllib.request.Request(job["callback_url"], data=json.dumps(job).encode(), method="POST",
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout):
+            pass
+    except Exception as e:
+        logger.warning("Callback of job %s to %s failed: %s", job["id"], job["callback_url"], e)
+
+
+class JobWorker:
+    def __init__(self, store: JobStore, worker_id=None, concurrency=JOB_WORKER_CONCURRENCY, poll_interval=0.5):
+        self.store = store
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+
+    async def _heartbeat(self, job_id):
+        while True:
+            await asyncio.sleep(self.store.visibility_timeout / 3)
+            if not await asyncio.to_thread(self.store.extend, job_id, self.worker_id):
+                return
+
+    async def _run(self, job):
+        heartbeat = asyncio.ensure_future(self._heartbeat(job["id"]))
+        try:
+            pdf = await run_job(self.store, job)
+        except Exception as e:
+            logger.exception("Job %s failed on attempt %s", job["id"], job["attempts"])
+            job = await asyncio.to_thread(self.store.fail, job["id"], self.worker_id, f"{type(e).__name__}: {e}")
+        else:
+            job = await asyncio.to_thread(self.store.complete, job["id"], self.worker_id, pdf)
+        finally:
+            heartbeat.cancel()
+        if job is not None and job["status"] in (JobStatus.DONE.value, JobStatus.FAILED.value):
+            await self._notify(job)
+        return job
+
+    async def _notify(self, job):
+        if job["callback_url"]:
+            await asyncio.to_thread(notify, job)
+
+    async def _claim(self):
+        # Jobs another worker died running on their last attempt are failed here, their callbacks go out too
+        reaped = []
+        job = await asyncio.to_thread(self.store.claim, self.worker_id, reaped)
+        for lost in reaped:
+            await self._notify(lost)
+        return job
+
+    async def run_once(self) -> Optional[dict]:
+        # Runs the next visible job to the end, None when there is none
+        job = await self._claim()
+        if job is None:
+            return None
+        return await self._run(job)
+
+    async def run(self, purge_interval=600):
+        slots = asyncio.Semaphore(self.concurrency)
+        running = set()
+        last_purge = 0
+        while True:
+            await slots.acquire()
+            if time.monotonic() - last_purge > purge_interval:
+                last_purge = time.monotonic()
+                await asyncio.to_thread(self.store.purge)
+            job = await self._claim()
+            if job is None:
+                slots.release()
+                await asyncio.sleep(self.poll_interval)
+                continue
+            task = asyncio.ensure_future(self._run(job))
+            running.add(task)
+            task.add_done_callback(running.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+
+def _worker_main(directory):
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(JobWorker(JobStore(directory)).run())
+
+
+def start_workers(count=JOB_WORKERS, directory=JOBS_PATH):
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_worker_main, args=(str(directory),), name=f"quickfill-job-worker-{i}",
+                                 daemon=True)
+                 for i in range(count)]
+    for process in processes:
+        process.start()
+    return processes
+
+
+def stop_workers(processes, timeout=5):
+    # Jobs in flight are picked up again once their claim expires
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(timeout)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs fill job workers until interrupted.")
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS or 2)
+    args = parser.parse_args()
+    workers = start_workers(args.workers)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        stop_workers(workers)
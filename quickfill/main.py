@@ -1,15 +1,37 @@
-from fastapi import FastAPI, File, Form, UploadFile
+import asyncio
+import json
+from typing import List, Optional
+
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse  # Corrected import
-from fastapi.responses import HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
-from quickfill.ai.ai_form_filling import (filea_to_fileb_fill,
-                                          gpt4v_filea_to_fileb_fill,
-                                          process_image_and_text)
+from quickfill.ai.batch_extraction import ai_form_filling_batch
 from quickfill.ai.form_filling import ai_form_filling, genearl_form_filling
-from quickfill.ocr.aws_text_extract import OCRReturnType, api_analyze_document
+from quickfill.batch import BatchOutput, batch_fill, stream_ndjson, stream_zip
+from quickfill.cache import get_cache_stats
+from quickfill.executor import Stage, run_in_stage, shutdown_executors
+from quickfill.jobs import (JobKind, JobStatus, job_store, start_workers,
+                            stop_workers, validate_callback_url)
+from quickfill.ocr.aws_text_extract import OCRReturnType
+from quickfill.ocr.textract_client import get_textract_client
+from quickfill.pipeline import (analyze_document_async,
+                                filea_to_fileb_fill_async,
+                                gpt4v_filea_to_fileb_fill_async,
+                                key_value_pairs_async, preprocess_async,
+                                process_image_and_text_async)
+from quickfill.providers import get_provider_info, preload_providers
+from quickfill.refill import refill_async
+from quickfill.singleflight import get_singleflight_stats
+from quickfill.streaming import (MEDIA_TYPES, StreamFormat, encode_events,
+                                 fill_events)
+from quickfill.telemetry import TraceMiddleware, render_metrics
+from quickfill.templates import difference_hash, template_registry
+from quickfill.upload import UploadLimitMiddleware, UploadTooLarge, read_upload
 
 app = FastAPI()
+app.add_middleware(UploadLimitMiddleware)
 
 # TODO: Change this to the actual frontend URL
 allow_origins = ["*"]
@@ -19,44 +41,92 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id", "X-Refilled-Fields"],
 )
+app.add_middleware(TraceMiddleware)
+
+
+@app.exception_handler(UploadTooLarge)
+async def upload_too_large_handler(request: Request, exc: UploadTooLarge):
+    return JSONResponse(status_code=413, content={"detail": str(exc)})
+
+
+def streaming_events_response(events, stream_format: StreamFormat):
+    # Progress events instead of the PDF, the last "result" event carries the PDF
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(encode_events(events, stream_format), media_type=MEDIA_TYPES[stream_format],
+                             headers=headers)
+
+@app.on_event("startup")
+def load_providers():
+    # Only with QUICKFILL_PRELOAD_PROVIDERS=1, otherwise each backend is imported on first use
+    preload_providers()
+
+@app.on_event("startup")
+def start_job_workers():
+    # None by default, workers run on their own (python -m quickfill.jobs). QUICKFILL_JOB_WORKERS starts them
+    # with a single API process, every uvicorn worker process would start its own
+    app.state.job_workers = start_workers()
+
+@app.on_event("shutdown")
+def shutdown_stage_pools():
+    shutdown_executors(wait=False)
+    stop_workers(getattr(app.state, "job_workers", []))
 
 @app.post("/ai_process_form/")
-async def ai_process_form(file: UploadFile = File(...), text_description: str = Form(...)):
+async def ai_process_form(file: UploadFile = File(...), text_description: str = Form(...), use_cache: bool = True,
+                          stream: Optional[StreamFormat] = None, session_id: Optional[str] = None):
     # Save the uploaded image
-    image_bytes = await file.read()
+    image_bytes = await read_upload(file)
 
-    # Call the function to process the image and text
-    pdf_file = process_image_and_text(image_bytes, text_description)
-   # Set the content to be downloadable as a PDF file
+    if stream is not None:
+        events = fill_events(image_bytes, form_a_text=text_description, use_cache=use_cache)
+        return streaming_events_response(events, stream)
+
+    # Set the content to be downloadable as a PDF file
     headers = {
         "Content-Disposition": "attachment; filename=form_output.pdf"
     }
+    if session_id:
+        # Edits of the same form in a session only refill the fields they touch, see quickfill/refill.py
+        pdf_file, refilled = await refill_async(session_id, image_bytes, text_description, use_cache=use_cache)
+        headers["X-Refilled-Fields"] = str(len(refilled))
+        return StreamingResponse(pdf_file, media_type="application/pdf", headers=headers)
+
+    # Call the function to process the image and text
+    pdf_file = await process_image_and_text_async(image_bytes, text_description, use_cache=use_cache)
 
     return StreamingResponse(pdf_file, media_type="application/pdf", headers=headers)
 
 
 @app.post("/analyze_identity_documents")
 async def analyze_document_route(file: UploadFile, return_type: OCRReturnType = OCRReturnType.TEXT):
-    file_bytes = await file.read()
-    ocr_result = api_analyze_document(file_bytes, return_type)
+    file_bytes = await read_upload(file)
+    document = await preprocess_async(file_bytes)
+    ocr_result = await analyze_document_async(document.data, return_type, document.data_hash,
+                                              document.original_hash)
     return ocr_result
 
 @app.post("/general_fill_form")
-async def general_fill_form_route(form_a_text:str, form_b_text:str) -> dict:
-    fill_result = genearl_form_filling(form_a_text, form_b_text)
+async def general_fill_form_route(form_a_text:str, form_b_text:str, use_cache: bool = True) -> dict:
+    fill_result = await run_in_stage(Stage.LLM, genearl_form_filling, form_a_text, form_b_text, use_cache=use_cache)
     return fill_result
 
 
 @app.post("/gpt4v_general_fill_form_files")
-async def general_fill_form_files_route(form_a_file:UploadFile, form_b_file:UploadFile) -> dict:
+async def general_fill_form_files_route(form_a_file:UploadFile, form_b_file:UploadFile, use_cache: bool = True,
+                                        stream: Optional[StreamFormat] = None) -> dict:
 
     # Save the uploaded image
-    image_bytes_filea = await form_a_file.read()
-    image_bytes_fileb = await form_b_file.read()
+    image_bytes_filea = await read_upload(form_a_file)
+    image_bytes_fileb = await read_upload(form_b_file)
+
+    if stream is not None:
+        events = fill_events(image_bytes_fileb, form_a_bytes=image_bytes_filea, use_gpt4v=True, use_cache=use_cache)
+        return streaming_events_response(events, stream)
 
     # Call the function to process the image and text
-    pdf_file = gpt4v_filea_to_fileb_fill(image_bytes_filea, image_bytes_fileb)
+    pdf_file = await gpt4v_filea_to_fileb_fill_async(image_bytes_filea, image_bytes_fileb, use_cache=use_cache)
    # Set the content to be downloadable as a PDF file
     headers = {
         "Content-Disposition": "attachment; filename=form_output.pdf"
@@ -66,27 +136,194 @@ async def general_fill_form_files_route(form_a_file:UploadFile, form_b_file:Uplo
 
 
 @app.post("/general_fill_form_files")
-async def general_fill_form_files_route(form_a_file:UploadFile, form_b_file:UploadFile) -> dict:
+async def general_fill_form_files_route(form_a_file:UploadFile, form_b_file:UploadFile, use_cache: bool = True,
+                                        stream: Optional[StreamFormat] = None) -> dict:
 
     # Save the uploaded image
-    image_bytes_filea = await form_a_file.read()
-    image_bytes_fileb = await form_b_file.read()
+    image_bytes_filea = await read_upload(form_a_file)
+    image_bytes_fileb = await read_upload(form_b_file)
+
+    if stream is not None:
+        events = fill_events(image_bytes_fileb, form_a_bytes=image_bytes_filea, use_cache=use_cache)
+        return streaming_events_response(events, stream)
 
     # Call the function to process the image and text
-    pdf_file = filea_to_fileb_fill(image_bytes_filea, image_bytes_fileb)
+    pdf_file = await filea_to_fileb_fill_async(image_bytes_filea, image_bytes_fileb, use_cache=use_cache)
     # Set the content to be downloadable as a PDF file
     headers = {
         "Content-Disposition": "attachment; filename=form_output.pdf"
     }
     return StreamingResponse(pdf_file, media_type="application/pdf", headers=headers)
 
+@app.post("/batch_fill_form_files")
+async def batch_fill_form_files_route(form_a_files: List[UploadFile], form_b_files: List[UploadFile],
+                                      use_gpt4v: bool = False, output: BatchOutput = BatchOutput.ZIP,
+                                      use_cache: bool = True):
+    form_a_images = [await read_upload(file) for file in form_a_files]
+    form_b_images = [(file.filename, await read_upload(file)) for file in form_b_files]
+
+    # Filled PDFs are streamed back as soon as each one is ready
+    items = batch_fill(form_a_images, form_b_images, use_gpt4v=use_gpt4v, use_cache=use_cache)
+    if output == BatchOutput.NDJSON:
+        return StreamingResponse(stream_ndjson(items), media_type="application/x-ndjson")
+    headers = {
+        "Content-Disposition": "attachment; filename=filled_forms.zip"
+    }
+    return StreamingResponse(stream_zip(items), media_type="application/zip", headers=headers)
+
 @app.post("/ai_fill_form_template")
-async def ai_fill_form_template(file:UploadFile, form_b_schema:str) -> dict:
+async def ai_fill_form_template(file:UploadFile, form_b_schema:str, use_cache: bool = True) -> dict:
+    target_json = _parse_schema(form_b_schema)
     ocr_result = await analyze_document_route(file)
-    fill_result = ai_form_filling(ocr_result, form_b_schema)
+    fill_result = await run_in_stage(Stage.LLM, ai_form_filling, ocr_result, target_json, use_cache=use_cache)
     return fill_result
 
 
+@app.post("/ai_fill_form_template/batch")
+async def ai_fill_form_template_batch(files: List[UploadFile], form_b_schema: str = Form(...),
+                                      use_cache: bool = True) -> list:
+    # One schema for every file: the extraction chain is built once and several documents share a request
+    target_json = _parse_schema(form_b_schema)
+    contexts = await asyncio.gather(*[analyze_document_route(file) for file in files])
+    items = await run_in_stage(Stage.LLM, ai_form_filling_batch, contexts, target_json, use_cache=use_cache)
+    return [{"filename": file.filename, **item.to_dict()} for file, item in zip(files, items)]
+
+
+def _parse_schema(form_b_schema: str) -> dict:
+    try:
+        target_json = json.loads(form_b_schema)
+    except json.JSONDecodeError:
+        target_json = None
+    if not isinstance(target_json, dict):
+        raise HTTPException(status_code=400, detail="form_b_schema must be a JSON object")
+    return target_json
+
+
+def _parse_template_fields(key_value_pairs_obj: str) -> dict:
+    # {key: {"BoundingBox": {"Width", "Height", "Left", "Top"}}}, as OCR returns them, fields are drawn from it
+    try:
+        kv_obj = json.loads(key_value_pairs_obj)
+    except json.JSONDecodeError:
+        kv_obj = None
+    if not isinstance(kv_obj, dict):
+        raise HTTPException(status_code=400, detail="key_value_pairs_obj must be a JSON object")
+    fields = {}
+    for key, field in kv_obj.items():
+        box = field.get("BoundingBox") if isinstance(field, dict) else None
+        if not isinstance(box, dict) or not all(isinstance(box.get(name), (int, float))
+                                                and not isinstance(box.get(name), bool)
+                                                for name in ("Width", "Height", "Left", "Top")):
+            raise HTTPException(status_code=400, detail=f"Field {key!r} of key_value_pairs_obj needs a BoundingBox "
+                                                        "with numeric Width, Height, Left and Top")
+        fields[key] = {**field, "Value": field.get("Value", "")}
+    return fields
+
+
+@app.post("/templates")
+async def register_template_route(file: UploadFile, name: str = Form(...),
+                                  key_value_pairs_obj: Optional[str] = Form(None)) -> dict:
+    # Registers a blank form b. Its fields come from OCR unless key_value_pairs_obj (JSON) is given
+    kv_obj = _parse_template_fields(key_value_pairs_obj) if key_value_pairs_obj else None
+    form_b = await preprocess_async(await read_upload(file))
+    if form_b.is_document:
+        raise HTTPException(status_code=400, detail="Templates are single page images")
+    if kv_obj is not None:
+        kv_pairs = {key: "" for key in kv_obj}
+    else:
+        kv_pairs, kv_obj = await key_value_pairs_async(form_b)
+    phash, size = await run_in_stage(Stage.IMAGE, difference_hash, form_b.data)
+    template = template_registry.register_hash(name, phash, size, kv_pairs, kv_obj)
+    return template.info()
+
+
+@app.get("/templates")
+async def list_templates_route() -> list:
+    return [template.info() for template in template_registry.list()]
+
+
+@app.get("/templates/{template_id}")
+async def get_template_route(template_id: str) -> dict:
+    template = template_registry.get(template_id)
+    if template is None:
+        raise HTTPException(status_code=404, detail="Template not found")
+    return template.to_dict()
+
+
+@app.delete("/templates/{template_id}")
+async def delete_template_route(template_id: str) -> dict:
+    if not template_registry.delete(template_id):
+        raise HTTPException(status_code=404, detail="Template not found")
+    return {"deleted": template_id}
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job_route(form_b_file: UploadFile, kind: JobKind = JobKind.GENERAL_FILL,
+                           form_a_file: Optional[UploadFile] = None, text_description: Optional[str] = Form(None),
+                           use_cache: bool = True, callback_url: Optional[str] = None) -> dict:
+    # Queues a fill and returns its job right away, poll GET /jobs/{job_id} or pass a callback_url
+    if kind == JobKind.PROCESS_FORM and not text_description:
+        raise HTTPException(status_code=400, detail="text_description is required")
+    if kind != JobKind.PROCESS_FORM and form_a_file is None:
+        raise HTTPException(status_code=400, detail="form_a_file is required")
+    if callback_url:
+        try:
+            validate_callback_url(callback_url)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    inputs = {"form_b": (await read_upload(form_b_file)).data}
+    if form_a_file is not None and kind != JobKind.PROCESS_FORM:
+        inputs["form_a"] = (await read_upload(form_a_file)).data
+    params = {"use_cache": use_cache, "text_description": text_description}
+    return await asyncio.to_thread(job_store.submit, kind, inputs, params, callback_url)
+
+
+@app.get("/jobs")
+async def jobs_stats_route() -> dict:
+    return await asyncio.to_thread(job_store.info)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job_route(job_id: str) -> dict:
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result_route(job_id: str):
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] != JobStatus.DONE.value:
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    return FileResponse(job_store.result_path(job_id), media_type="application/pdf", filename="form_output.pdf")
+
+
+@app.get("/cache/stats")
+async def cache_stats_route() -> dict:
+    stats = get_cache_stats()
+    stats["singleflight"] = get_singleflight_stats()
+    stats["templates"] = template_registry.info()
+    return stats
+
+
+@app.get("/textract/stats")
+async def textract_stats_route() -> dict:
+    return get_textract_client().metrics.info()
+
+
+@app.get("/providers")
+async def providers_route() -> dict:
+    return get_provider_info()
+
+
+@app.get("/metrics")
+async def metrics_route():
+    # Prometheus text exposition format
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/ping")
 async def root():
     return {"message": "Hello QuickFill!"}
@@ -3,143 +3,108 @@ import json
 import os
 from enum import Enum
 
-import boto3
-from quickfill.const import CACHE_PATH
+from quickfill.cache import SharedDiskCache, TieredCache, register_cache
+from quickfill.const import (CACHE_PATH, OCR_CACHE_MAX_BYTES,
+                             OCR_CACHE_MEMORY_ITEMS, OCR_CACHE_TTL,
+                             OCR_FALLBACK_PROVIDER, OCR_PROVIDER)
+from quickfill.ocr.columnar import ColumnarDocument, encode_response
+from quickfill.ocr.document import TextractDocument
+from quickfill.providers import get_provider
+from quickfill.singleflight import ocr_flight
+
+# Parsed documents per image hash: TextractDocument for fresh responses in memory,
+# and the compact columnar format on disk (mmap'd and lazily decoded on a disk hit)
+ocr_cache = register_cache(TieredCache(
+    "ocr",
+    memory_items=OCR_CACHE_MEMORY_ITEMS,
+    disk=SharedDiskCache(CACHE_PATH, max_bytes=OCR_CACHE_MAX_BYTES, ttl=OCR_CACHE_TTL, suffix=".qfb",
+                         dumps=lambda document: encode_response(document.response),
+                         open_file=ColumnarDocument.open),
+))
 
 
 def analyze_document(image_bytes, use_cache=True):
-    # Initialize cache_path to None
-    cache_path = None
-    
-    if use_cache:
-        # Only calculate the hash and define cache_path if use_cache is True
-        image_hash = hashlib.md5(image_bytes).hexdigest()
-        cache_path = CACHE_PATH / f"{image_hash}.json"
-
-        # Check if the OCR result is already in the cache on disk
-        if os.path.exists(cache_path):
-            print("Cache hit")
-            with open(cache_path, 'r') as cache_file:
-                return json.load(cache_file)
-
-    # Otherwise, send a request to AWS Textract
-    textract = boto3.client("textract")
-    response = textract.analyze_document(
-        Document={'Bytes': image_bytes},
-        FeatureTypes=["TABLES", "FORMS"]
-    )
-
-    # If caching is enabled, store the OCR result in the cache on disk
     if use_cache:
-        # Ensure the cache directory exists
-        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-        # Store the OCR result in the cache on disk
-        with open(cache_path, 'w') as cache_file:
-            json.dump(response, cache_file)
-
-    return response
+        return get_document(image_bytes).response
+    return textract_analyze_document(image_bytes)
+
+
+def get_document(image_bytes, use_cache=True, image_hash=None, source_hash=None):
+    # source_hash: md5 of the upload image_bytes was preprocessed from, see _analyze
+    if not use_cache:
+        return TextractDocument(textract_analyze_document(image_bytes))
+
+    image_hash = image_hash or hashlib.md5(image_bytes).hexdigest()
+    key = ocr_cache_key(image_hash)
+
+    # Check if the OCR result is already in memory or in the cache on disk
+    document = ocr_cache.get(key)
+    if document is not None:
+        return document
+
+    # Concurrent requests for the same image share one Textract call
+    return ocr_flight.do(key, _analyze_and_cache, image_bytes, image_hash, key, source_hash)
+
+
+def ocr_cache_key(image_hash, provider=OCR_PROVIDER):
+    # Textract results keep the bare image hash, other OCR providers' results are cached apart from them
+    if provider == "textract":
+        return image_hash
+    return f"{provider}-{image_hash}"
+
+
+def _analyze_and_cache(image_bytes, image_hash, key, source_hash=None):
+    # A previous flight may have finished between our cache miss and now
+    document = ocr_cache.memory.get(key)
+    if document is not None:
+        return document
+    # Other workers on this host share the disk cache, the first one to miss calls Textract for all of them
+    return ocr_cache.compute_shared(key, _analyze, image_bytes, image_hash, source_hash)
+
+
+def _analyze(image_bytes, image_hash, source_hash=None):
+    # Cache entries written before the columnar format are migrated on first use. They were keyed by the
+    # upload's hash (source_hash), before uploads were preprocessed (quickfill/preprocess.py)
+    legacy_paths = [CACHE_PATH / f"{legacy_hash}.json" for legacy_hash in dict.fromkeys((source_hash, image_hash))
+                    if legacy_hash]
+    response = next((response for response in map(_load_legacy_json, legacy_paths) if response is not None), None)
+    if response is None:
+        response = textract_analyze_document(image_bytes)
+    for legacy_path in legacy_paths:
+        if os.path.exists(legacy_path):
+            os.unlink(legacy_path)
+    return TextractDocument(response)
+
+
+def _load_legacy_json(legacy_path):
+    try:
+        with open(legacy_path, 'r') as cache_file:
+            return json.load(cache_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def textract_analyze_document(image_bytes):
+    # Send a request to the OCR provider: AWS Textract's shared rate limited client by default,
+    # or a local engine (see quickfill/ocr/tesseract.py and quickfill/ocr/routing.py)
+    provider = get_provider("ocr")
+    if bytes(image_bytes[:4]) == b"%PDF" and not getattr(provider, "reads_pdf", True):
+        # PDF pages of a document (quickfill/pdf/pages.py) go to the fallback provider, local engines read images
+        provider = get_provider("ocr", OCR_FALLBACK_PROVIDER)
+    return provider.analyze_document(image_bytes, feature_types=["TABLES", "FORMS"])
 
 # Plain text
 def get_text_from_response(response):
-    blocks = response["Blocks"]
-    text = ""
-    for block in blocks:
-        if block["BlockType"] == "LINE":
-            text += block["Text"] + "\n"
-    return text
+    return TextractDocument(response).text()
 
 
 def extract_key_value_pairs(blocks):
-    key_map = {}
-    value_map = {}
-    block_map = {}
-    key_value_pairs = {}
-    key_value_pairs_obj = {}  # New object for storing coordinates
-
-    for block in blocks:
-        block_id = block['Id']
-        block_map[block_id] = block
-        if block['BlockType'] == "KEY_VALUE_SET":
-            if 'KEY' in block['EntityTypes']:
-                key_map[block_id] = block
-            else:
-                value_map[block_id] = block
-
-    for block_id, key_block in key_map.items():
-        value_block = find_value_block(key_block, value_map, block_map)
-        key = get_text(key_block, block_map)
-        val = get_text(value_block, block_map)
-        key_value_pairs[key] = val
-
-        # Extract and store coordinates of the value block
-        if value_block:
-            coordinates = value_block.get('Geometry', {}).get('BoundingBox', {})
-            key_value_pairs_obj[key] = {}
-            key_value_pairs_obj[key]['BoundingBox'] = coordinates
-            key_value_pairs_obj[key]['Value'] = "" # TODO: add default value?
-
-
-    return key_value_pairs, key_value_pairs_obj
-
-def find_value_block(key_block, value_map, block_map):
-    for relationship in key_block['Relationships']:
-        if relationship['Type'] == 'VALUE':
-            for value_id in relationship['Ids']:
-                value_block = value_map.get(value_id)
-                if value_block:
-                    return value_block
-    return None
-
-def get_text(block, block_map):
-    text = ''
-    if 'Relationships' in block:
-        for relationship in block['Relationships']:
-            if relationship['Type'] == 'CHILD':
-                for child_id in relationship['Ids']:
-                    word = block_map[child_id]
-                    if word['BlockType'] == 'WORD':
-                        text += word['Text'] + ' '
-                    if word['BlockType'] == 'SELECTION_ELEMENT':
-                        if word['SelectionStatus'] == 'SELECTED':
-                            text += 'X '
-    return text.strip()
-
-# TODO: Table content and key-value pair logic is written by ChatGPT, sometimes it doesn't work, which will throw error, 
-# We should process the error properly
+    return TextractDocument({"Blocks": blocks}).key_value_pairs()
+
+
 # Table content
 def extract_table_content(blocks):
-    tables = []
-    for block in blocks:
-        if block['BlockType'] == 'TABLE':
-            table = []
-            for relationship in block['Relationships']:
-                if relationship['Type'] == 'CHILD':
-                    row = []
-                    for cell_id in relationship['Ids']:
-                        cell_block = find_block_by_id(cell_id, blocks)
-                        cell_text = get_text_from_block(cell_block)
-                        row.append(cell_text)
-                    table.append(row)
-            tables.append(table)
-    return tables
-
-def find_block_by_id(block_id, blocks):
-    for block in blocks:
-        if block['Id'] == block_id:
-            return block
-    return None
-
-def get_text_from_block(block):
-    text = ''
-    if 'Text' in block:
-        return block['Text']
-    if 'Relationships' in block:
-        for relationship in block['Relationships']:
-            if relationship['Type'] == 'CHILD':
-                for child_id in relationship['Ids']:
-                    child_block = find_block_by_id(child_id, blocks)
-                    text += get_text_from_block(child_block) + ' '
-    return text.strip()
+    return TextractDocument({"Blocks": blocks}).tables()
 
 # Helper functions
 def quick_analyze_document(file_path):
@@ -156,25 +121,26 @@ class OCRReturnType(Enum):
     TABLE_CONTENT = "table_content"
     
 
-def api_analyze_document(image_bytes, return_type: OCRReturnType = OCRReturnType.TEXT):
+def api_analyze_document(image_bytes, return_type: OCRReturnType = OCRReturnType.TEXT, image_hash=None,
+                         source_hash=None):
     '''
-    Calls analyze_document and optionally uses get_text_from_response,
-    extract_key_value_pairs, extract_table_content to return results in different formats.
+    Calls analyze_document and returns a view of the parsed TextractDocument in different formats.
     Users can decide which return_type they want to get, they can get either text, key_value_pairs or table_content.
+    image_hash is the md5 of image_bytes when the caller already has it (quickfill/preprocess.py),
+    source_hash the md5 of the upload image_bytes was preprocessed from.
     '''
-    # Get the OCR result
-    ocr_result_response = analyze_document(image_bytes)
+    # Get the OCR result, parsed and indexed once per image
+    document = get_document(image_bytes, image_hash=image_hash, source_hash=source_hash)
 
     # Process the OCR result based on the return_type
     if return_type == OCRReturnType.TEXT:
-        result = get_text_from_response(ocr_result_response)
-    # TODO, 'Block' might be redundant
+        result = document.text()
     elif return_type == OCRReturnType.KEY_VALUE_PAIRS:
-        result = extract_key_value_pairs(ocr_result_response['Blocks'])
+        result = document.key_value_pairs()
     elif return_type == OCRReturnType.TABLE_CONTENT:
-        result = extract_table_content(ocr_result_response['Blocks'])
+        result = document.tables()
     elif return_type == OCRReturnType.RAW:
-        result = ocr_result_response
+        result = document.response
     else:
         raise ValueError(f"Unsupported return_type: {return_type}")
 
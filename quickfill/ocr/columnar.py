@@ -0,0 +1,384 @@
+import json
+import math
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+
+# Compact columnar file format for cached Textract responses (*.qfb).
+#
+#   b"QFB1" | uint32 header size | header json | column data ...
+#
+# Every block field is stored as one array over all blocks (block types, ids, texts, bounding boxes,
+# relationship ids as block indices, ...), each column zlib compressed when it pays off.
+# Files are opened with mmap and a column is only decoded the first time it is used, so TEXT only
+# touches block_type and text, while RAW rebuilds the full response.
+# Geometry and confidence are stored as float32.
+# Each column's stored bytes carry a CRC32, checked when the file is opened: a corrupt file fails to open
+# (ValueError, the disk cache drops it) instead of failing later, when one of its columns is decoded.
+
+MAGIC = b"QFB1"
+VERSION = 1
+
+KNOWN_BLOCK_KEYS = ("BlockType", "Confidence", "Text", "TextType", "RowIndex", "ColumnIndex", "RowSpan",
+                    "ColumnSpan", "Geometry", "Id", "Relationships", "EntityTypes", "SelectionStatus", "Page")
+INT_FIELDS = ("RowIndex", "ColumnIndex", "RowSpan", "ColumnSpan", "Page")
+BBOX_FIELDS = ("Width", "Height", "Left", "Top")
+NAN = float("nan")
+
+
+class _Vocab:
+    # Maps strings to small integer codes, 0 is reserved for "absent"
+    def __init__(self):
+        self.names = []
+        self._codes = {}
+
+    def code(self, name):
+        if name is None:
+            return 0
+        code = self._codes.get(name)
+        if code is None:
+            self.names.append(name)
+            code = self._codes[name] = len(self.names)
+        return code
+
+
+def _string_column(values):
+    offsets = array('I', [0])
+    blob = bytearray()
+    for value in values:
+        if value:
+            blob += value.encode('utf-8')
+        offsets.append(len(blob))
+    return offsets, bytes(blob)
+
+
+def encode_response(response) -> bytes:
+    blocks = response["Blocks"]
+    index = {block['Id']: i for i, block in enumerate(blocks)}
+    vocabs = {name: _Vocab() for name in ("block_type", "text_type", "selection_status", "rel_type", "entity_types")}
+
+    block_type = array('B')
+    text_type = array('B')
+    selection_status = array('B')
+    entity_types = array('H')
+    text_present = array('B')
+    confidence = array('f')
+    bbox = array('f')
+    polygon_offsets = array('I', [0])
+    polygon = array('f')
+    rel_offsets = array('I', [0])
+    rel_type = array('B')
+    rel_id_offsets = array('I', [0])
+    rel_ids = array('i')
+    ints = {field: array('H') for field in INT_FIELDS}
+    extras = {}
+
+    for i, block in enumerate(blocks):
+        extra = {key: value for key, value in block.items() if key not in KNOWN_BLOCK_KEYS}
+
+        block_type.append(vocabs["block_type"].code(block['BlockType']))
+        text_type.append(vocabs["text_type"].code(block.get('TextType')))
+        selection_status.append(vocabs["selection_status"].code(block.get('SelectionStatus')))
+        text_present.append('Text' in block)
+        confidence.append(block.get('Confidence', NAN))
+        for field in INT_FIELDS:
+            value = block.get(field)
+            if value is None or not 0 < value < 0xFFFF:
+                value = 0
+                if field in block:
+                    extra[field] = block[field]
+            ints[field].append(value)
+
+        mask = 0
+        for name in block.get('EntityTypes', ()):
+            bit = vocabs["entity_types"].code(name) - 1
+            if bit >= 16:
+                extra['EntityTypes'] = block['EntityTypes']
+                mask = 0
+                break
+            mask |= 1 << bit
+        entity_types.append(mask)
+
+        geometry = block.get('Geometry', {})
+        box = geometry.get('BoundingBox')
+        bbox.extend([box[field] for field in BBOX_FIELDS] if box else [NAN] * 4)
+        for point in geometry.get('Polygon', ()):
+            polygon.extend((point['X'], point['Y']))
+        polygon_offsets.append(len(polygon) // 2)
+        other_geometry = {key: value for key, value in geometry.items() if key not in ('BoundingBox', 'Polygon')}
+        if other_geometry:
+            extra['Geometry'] = other_geometry
+
+        relationships = block.get('Relationships', [])
+        if all(child_id in index for relationship in relationships for child_id in relationship['Ids']):
+            for relationship in relationships:
+                rel_type.append(vocabs["rel_type"].code(relationship['Type']))
+                rel_ids.extend(index[child_id] for child_id in relationship['Ids'])
+                rel_id_offsets.append(len(rel_ids))
+        else:
+            extra['Relationships'] = relationships
+        rel_offsets.append(len(rel_type))
+
+        if extra:
+            extras[i] = extra
+
+    id_offsets, ids = _string_column(block['Id'] for block in blocks)
+    text_offsets, texts = _string_column(block.get('Text') for block in blocks)
+    meta = {key: value for key, value in response.items() if key != "Blocks"}
+
+    columns = {
+        "block_type": block_type, "text_type": text_type, "selection_status": selection_status,
+        "entity_types": entity_types, "text_present": text_present, "confidence": confidence,
+        "bbox": bbox, "polygon_offsets": polygon_offsets, "polygon": polygon,
+        "rel_offsets": rel_offsets, "rel_type": rel_type, "rel_id_offsets": rel_id_offsets, "rel_ids": rel_ids,
+        "id_offsets": id_offsets, "id": ids, "text_offsets": text_offsets, "text": texts,
+        "extras": json.dumps({"blocks": extras, "response": meta}).encode('utf-8'),
+    }
+    for field in INT_FIELDS:
+        columns[field] = ints[field]
+
+    header = {
+        "version": VERSION,
+        "byteorder": sys.byteorder,
+        "count": len(blocks),
+        "vocabs": {name: vocab.names for name, vocab in vocabs.items()},
+        "columns": {},
+    }
+    chunks = []
+    offset = 0
+    for name, column in columns.items():
+        typecode = column.typecode if isinstance(column, array) else 'B'
+        raw = column.tobytes() if isinstance(column, array) else column
+        packed = zlib.compress(raw, 6)
+        codec = "zlib" if len(packed) < len(raw) * 0.8 else "raw"
+        data = packed if codec == "zlib" else raw
+        header["columns"][name] = {"offset": offset, "size": len(data), "codec": codec, "typecode": typecode,
+                                   "crc32": zlib.crc32(data)}
+        chunks.append(data)
+        offset += len(data)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    return b"".join([MAGIC, struct.pack("<I", len(header_bytes)), header_bytes] + chunks)
+
+
+class ColumnarDocument:
+    '''
+    Lazily decoded view over an encoded response, with the same extractors as TextractDocument.
+    '''
+
+    def __init__(self, buffer):
+        if len(buffer) < 8 or bytes(buffer[:4]) != MAGIC:
+            raise ValueError("Not a quickfill columnar OCR file")
+        (header_size,) = struct.unpack("<I", buffer[4:8])
+        self.header = json.loads(bytes(buffer[8:8 + header_size]))
+        data_size = max((spec["offset"] + spec["size"] for spec in self.header["columns"].values()), default=0)
+        if len(buffer) < 8 + header_size + data_size:
+            raise ValueError("Truncated quickfill columnar OCR file")
+        for name, spec in self.header["columns"].items():
+            start = 8 + header_size + spec["offset"]
+            # Files written before checksums were added have none
+            if "crc32" in spec and zlib.crc32(buffer[start:start + spec["size"]]) != spec["crc32"]:
+                raise ValueError(f"Corrupt column {name} in quickfill columnar OCR file")
+        self.count = self.header["count"]
+        self.vocabs = self.header["vocabs"]
+        self._buffer = buffer
+        self._data_offset = 8 + header_size
+        self._columns = {}
+        self._extras = None
+        self._response = None
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(memoryview(buffer))
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(memoryview(data))
+
+    def column(self, name):
+        column = self._columns.get(name)
+        if column is None:
+            spec = self.header["columns"][name]
+            start = self._data_offset + spec["offset"]
+            data = self._buffer[start:start + spec["size"]]
+            if spec["codec"] == "zlib":
+                try:
+                    data = memoryview(zlib.decompress(data))
+                except zlib.error as e:
+                    raise ValueError(f"Corrupt column {name} in quickfill columnar OCR file") from e
+            if spec["typecode"] != 'B' and self.header["byteorder"] != sys.byteorder:
+                swapped = array(spec["typecode"], data)
+                swapped.byteswap()
+                data = memoryview(swapped.tobytes())
+            column = self._columns[name] = data.cast(spec["typecode"])
+        return column
+
+    def _code(self, vocab, name):
+        names = self.vocabs[vocab]
+        return names.index(name) + 1 if name in names else -1
+
+    def _name(self, vocab, code):
+        return self.vocabs[vocab][code - 1] if code else None
+
+    def _string(self, name, i):
+        offsets = self.column(f"{name}_offsets")
+        return bytes(self.column(name)[offsets[i]:offsets[i + 1]]).decode('utf-8')
+
+    def _indices_of_type(self, block_type):
+        code = self._code("block_type", block_type)
+        return [i for i, value in enumerate(self.column("block_type")) if value == code]
+
+    def _relationships(self, i):
+        rel_offsets = self.column("rel_offsets")
+        rel_id_offsets = self.column("rel_id_offsets")
+        rel_ids = self.column("rel_ids")
+        rel_type = self.column("rel_type")
+        for r in range(rel_offsets[i], rel_offsets[i + 1]):
+            yield self._name("rel_type", rel_type[r]), rel_ids[rel_id_offsets[r]:rel_id_offsets[r + 1]]
+
+    def _related(self, i, relationship_type):
+        return [j for rel, ids in self._relationships(i) if rel == relationship_type for j in ids]
+
+    def _text(self, i):
+        return self._string("text", i) if self.column("text_present")[i] else None
+
+    def _bounding_box(self, i):
+        values = self.column("bbox")[i * 4:i * 4 + 4]
+        if math.isnan(values[0]):
+            return {}
+        return dict(zip(BBOX_FIELDS, values))
+
+    # Plain text
+    def text(self):
+        return "".join(self._string("text", i) + "\n" for i in self._indices_of_type("LINE"))
+
+    def words_text(self, i):
+        word = self._code("block_type", "WORD")
+        selection = self._code("block_type", "SELECTION_ELEMENT")
+        selected = self._code("selection_status", "SELECTED")
+        block_type = self.column("block_type")
+        words = []
+        for j in self._related(i, 'CHILD'):
+            if block_type[j] == word:
+                words.append(self._string("text", j))
+            elif block_type[j] == selection and self.column("selection_status")[j] == selected:
+                words.append('X')
+        return ' '.join(words)
+
+    # Key value pairs
+    def key_value_pairs(self):
+        key_bit = self._code("entity_types", "KEY")
+        key_mask = 1 << (key_bit - 1) if key_bit > 0 else 0
+        kv_code = self._code("block_type", "KEY_VALUE_SET")
+        block_type = self.column("block_type")
+        entity_types = self.column("entity_types")
+        key_value_pairs = {}
+        key_value_pairs_obj = {}
+
+        for i in self._indices_of_type("KEY_VALUE_SET"):
+            if not entity_types[i] & key_mask:
+                continue
+            value = next((j for j in self._related(i, 'VALUE')
+                          if block_type[j] == kv_code and not entity_types[j] & key_mask), None)
+            key = self.words_text(i)
+            key_value_pairs[key] = self.words_text(value) if value is not None else ''
+            if value is not None:
+                key_value_pairs_obj[key] = {'BoundingBox': self._bounding_box(value), 'Value': ""}
+
+        return key_value_pairs, key_value_pairs_obj
+
+    # Table content
+    def tables(self):
+        cell = self._code("block_type", "CELL")
+        block_type = self.column("block_type")
+        row_index = self.column("RowIndex")
+        column_index = self.column("ColumnIndex")
+        tables = []
+        for i in self._indices_of_type("TABLE"):
+            rows = {}
+            for j in self._related(i, 'CHILD'):
+                if block_type[j] != cell:
+                    continue
+                row = rows.setdefault(row_index[j] or 1, {})
+                text = self._text(j)
+                row[column_index[j] or len(row) + 1] = text if text is not None else self.words_text(j)
+            tables.append([[row[col] for col in sorted(row)] for _, row in sorted(rows.items())])
+        return tables
+
+    # Full response, only built when RAW is requested
+    @property
+    def extras(self):
+        if self._extras is None:
+            self._extras = json.loads(bytes(self.column("extras")))
+        return self._extras
+
+    @property
+    def response(self):
+        if self._response is None:
+            self._response = self._build_response()
+        return self._response
+
+    def _build_response(self):
+        ids = [self._string("id", i) for i in range(self.count)]
+        block_extras = self.extras["blocks"]
+        confidence = self.column("confidence")
+        polygon_offsets = self.column("polygon_offsets")
+        polygon = self.column("polygon")
+        entity_names = self.vocabs["entity_types"]
+        blocks = []
+        for i in range(self.count):
+            extra = dict(block_extras.get(str(i), {}))
+            block = {"BlockType": self._name("block_type", self.column("block_type")[i])}
+            if not math.isnan(confidence[i]):
+                block["Confidence"] = confidence[i]
+            text = self._text(i)
+            if text is not None:
+                block["Text"] = text
+            text_type = self._name("text_type", self.column("text_type")[i])
+            if text_type:
+                block["TextType"] = text_type
+            for field in INT_FIELDS[:-1]:
+                value = self.column(field)[i]
+                if value:
+                    block[field] = value
+                elif field in extra:
+                    block[field] = extra.pop(field)
+
+            geometry = {}
+            bounding_box = self._bounding_box(i)
+            if bounding_box:
+                geometry["BoundingBox"] = bounding_box
+            points = polygon[polygon_offsets[i] * 2:polygon_offsets[i + 1] * 2]
+            if len(points):
+                geometry["Polygon"] = [{"X": points[k], "Y": points[k + 1]} for k in range(0, len(points), 2)]
+            geometry.update(extra.pop("Geometry", {}))
+            if geometry:
+                block["Geometry"] = geometry
+
+            block["Id"] = ids[i]
+            relationships = [{"Type": rel, "Ids": [ids[j] for j in rel_ids]} for rel, rel_ids in self._relationships(i)]
+            relationships = extra.pop("Relationships", relationships)
+            if relationships:
+                block["Relationships"] = relationships
+            mask = self.column("entity_types")[i]
+            entity_types = extra.pop("EntityTypes", [name for bit, name in enumerate(entity_names) if mask >> bit & 1])
+            if entity_types:
+                block["EntityTypes"] = entity_types
+            selection_status = self._name("selection_status", self.column("selection_status")[i])
+            if selection_status:
+                block["SelectionStatus"] = selection_status
+            page = self.column("Page")[i]
+            if page:
+                block["Page"] = page
+            elif "Page" in extra:
+                block["Page"] = extra.pop("Page")
+            block.update(extra)
+            blocks.append(block)
+
+        response = dict(self.extras["response"])
+        response["Blocks"] = blocks
+        return response
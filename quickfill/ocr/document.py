@@ -0,0 +1,95 @@
+from collections import defaultdict
+
+
+class TextractDocument:
+    '''
+    Indexed view over one Textract AnalyzeDocument response.
+    Built once per response in a single pass over the blocks: an id index, CHILD/VALUE adjacency
+    and the blocks grouped by BlockType. Every extractor below is linear in the number of blocks.
+    '''
+
+    def __init__(self, response):
+        self.response = response
+        self.blocks = response["Blocks"]
+        self.by_id = {}
+        self.children = {}
+        self.values = {}
+        self.by_type = defaultdict(list)
+
+        for block in self.blocks:
+            block_id = block['Id']
+            self.by_id[block_id] = block
+            self.by_type[block['BlockType']].append(block)
+            for relationship in block.get('Relationships', ()):
+                if relationship['Type'] == 'CHILD':
+                    self.children.setdefault(block_id, []).extend(relationship['Ids'])
+                elif relationship['Type'] == 'VALUE':
+                    self.values.setdefault(block_id, []).extend(relationship['Ids'])
+
+    def blocks_of_type(self, block_type):
+        return self.by_type.get(block_type, [])
+
+    def child_blocks(self, block):
+        by_id = self.by_id
+        return [by_id[child_id] for child_id in self.children.get(block['Id'], ()) if child_id in by_id]
+
+    # Plain text
+    def text(self):
+        return "".join(block["Text"] + "\n" for block in self.blocks_of_type("LINE"))
+
+    def words_text(self, block):
+        # Text of WORD children, selected checkboxes are rendered as X
+        words = []
+        for child in self.child_blocks(block):
+            if child['BlockType'] == 'WORD':
+                words.append(child['Text'])
+            elif child['BlockType'] == 'SELECTION_ELEMENT' and child['SelectionStatus'] == 'SELECTED':
+                words.append('X')
+        return ' '.join(words)
+
+    # Key value pairs
+    def value_block(self, key_block):
+        for value_id in self.values.get(key_block['Id'], ()):
+            value_block = self.by_id.get(value_id)
+            if value_block is not None and 'KEY' not in value_block.get('EntityTypes', ()):
+                return value_block
+        return None
+
+    def key_value_pairs(self):
+        key_value_pairs = {}
+        key_value_pairs_obj = {}  # New object for storing coordinates
+
+        for key_block in self.blocks_of_type("KEY_VALUE_SET"):
+            if 'KEY' not in key_block['EntityTypes']:
+                continue
+            value_block = self.value_block(key_block)
+            key = self.words_text(key_block)
+            key_value_pairs[key] = self.words_text(value_block) if value_block else ''
+
+            # Store coordinates of the value block
+            if value_block:
+                coordinates = value_block.get('Geometry', {}).get('BoundingBox', {})
+                key_value_pairs_obj[key] = {
+                    'BoundingBox': coordinates,
+                    'Value': "",  # TODO: add default value?
+                }
+
+        return key_value_pairs, key_value_pairs_obj
+
+    # Table content
+    def cell_text(self, cell_block):
+        if 'Text' in cell_block:
+            return cell_block['Text']
+        return self.words_text(cell_block)
+
+    def tables(self):
+        tables = []
+        for table_block in self.blocks_of_type("TABLE"):
+            rows = {}
+            for child in self.child_blocks(table_block):
+                if child['BlockType'] != 'CELL':
+                    continue
+                row = rows.setdefault(child.get('RowIndex', 1), {})
+                row[child.get('ColumnIndex', len(row) + 1)] = self.cell_text(child)
+            tables.append([[row[col] for col in sorted(row)] for _, row in sorted(rows.items())])
+        return tables
@@ -0,0 +1,79 @@
+import logging
+import threading
+
+from quickfill.const import (OCR_FALLBACK_PROVIDER, OCR_LOCAL_MIN_CONFIDENCE,
+                             OCR_LOCAL_MIN_WORDS, OCR_LOCAL_PROVIDER)
+from quickfill.providers import get_provider
+from quickfill.telemetry import record_ocr_route
+
+# "local_first" OCR provider: every image goes to the local engine (tesseract, seconds cheaper than a
+# Textract round trip and free), and only the ones it reads poorly are sent to the fallback (Textract).
+# Routes: "local" kept the local result, "low_confidence", "few_words", "no_fields" and "error" fell back,
+# "pdf" went straight to the fallback: the local engine doesn't read PDF pages.
+
+logger = logging.getLogger("quickfill.ocr")
+
+
+def document_confidence(response):
+    '''
+    Mean WORD confidence (0-100) weighted by word length, and the number of words
+    '''
+    total = weight = count = 0
+    for block in response["Blocks"]:
+        if block["BlockType"] != "WORD":
+            continue
+        length = len(block.get("Text", ""))
+        total += block.get("Confidence", 0.0) * length
+        weight += length
+        count += 1
+    return (total / weight if weight else 0.0), count
+
+
+def has_key_value_pairs(response):
+    return any(block["BlockType"] == "KEY_VALUE_SET" and "KEY" in block.get("EntityTypes", ())
+               for block in response["Blocks"])
+
+
+class LocalFirstOCR:
+    def __init__(self, local=OCR_LOCAL_PROVIDER, fallback=OCR_FALLBACK_PROVIDER,
+                 min_confidence=OCR_LOCAL_MIN_CONFIDENCE, min_words=OCR_LOCAL_MIN_WORDS):
+        self.local = local
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+        self.min_words = min_words
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def route(self, response, feature_types):
+        confidence, words = document_confidence(response)
+        if words < self.min_words:
+            return "few_words"
+        if confidence < self.min_confidence:
+            return "low_confidence"
+        if "FORMS" in feature_types and not has_key_value_pairs(response):
+            return "no_fields"
+        return "local"
+
+    def analyze_document(self, image_bytes, feature_types=("TABLES", "FORMS")):
+        if bytes(image_bytes[:4]) == b"%PDF" and not getattr(get_provider("ocr", self.local), "reads_pdf", True):
+            self._count("pdf")
+            return get_provider("ocr", self.fallback).analyze_document(image_bytes, feature_types=feature_types)
+        try:
+            response = get_provider("ocr", self.local).analyze_document(image_bytes, feature_types=feature_types)
+            route = self.route(response, feature_types)
+        except Exception as e:
+            logger.warning("Local OCR (%s) failed, using %s: %s", self.local, self.fallback, e)
+            route = "error"
+        self._count(route)
+        if route == "local":
+            return response
+        return get_provider("ocr", self.fallback).analyze_document(image_bytes, feature_types=feature_types)
+
+    def _count(self, route):
+        with self._lock:
+            self.routes[route] = self.routes.get(route, 0) + 1
+        record_ocr_route(route)
+
+    def info(self):
+        with self._lock:
+            return dict(self.routes)
@@ -0,0 +1,171 @@
+import re
+import subprocess
+
+from quickfill.const import (TESSERACT_COMMAND, TESSERACT_LANGUAGES,
+                             TESSERACT_TIMEOUT)
+from quickfill.telemetry import span
+
+# Local OCR with the tesseract command line (https://github.com/tesseract-ocr/tesseract), no Python binding needed.
+# Its TSV output is turned into a Textract style AnalyzeDocument response, so TextractDocument and every
+# extractor keep working: a PAGE, LINE and WORD blocks with geometry and confidence, and KEY_VALUE_SET pairs
+# for "Key: value" lines. There are no TABLE or SELECTION_ELEMENT blocks.
+
+ENGINE = "tesseract"
+TSV_COLUMNS = ("level", "page_num", "block_num", "par_num", "line_num", "word_num",
+               "left", "top", "width", "height", "conf", "text")
+WORD_LEVEL = 5
+# Underscores and dots of blank fields ("Name: ________") give the value's geometry but no text
+BLANK = re.compile(r"^[_.…]+$")
+# Width of a blank value with nothing drawn after its key, as a ratio of the page
+BLANK_VALUE_WIDTH = 0.25
+BLANK_VALUE_GAP = 0.01
+
+
+class TesseractError(Exception):
+    pass
+
+
+class TesseractOCR:
+    '''
+    OCR provider running the tesseract command on every image, see quickfill/providers.py
+    '''
+    # Tesseract reads images only, PDF pages are sent to OCR_FALLBACK_PROVIDER (quickfill/ocr/aws_text_extract.py)
+    reads_pdf = False
+
+    def __init__(self, command=TESSERACT_COMMAND, languages=TESSERACT_LANGUAGES, timeout=TESSERACT_TIMEOUT):
+        self.command = command
+        self.languages = languages
+        self.timeout = timeout
+
+    def analyze_document(self, image_bytes, feature_types=("TABLES", "FORMS")):
+        with span("tesseract.analyze_document"):
+            tsv = self._run(bytes(image_bytes))
+        return tsv_to_response(tsv, forms="FORMS" in feature_types)
+
+    def _run(self, image_bytes):
+        try:
+            result = subprocess.run([self.command, "stdin", "stdout", "-l", self.languages, "tsv"],
+                                    input=image_bytes, capture_output=True, timeout=self.timeout)
+        except FileNotFoundError:
+            raise TesseractError(f"{self.command} not found, install tesseract or set QUICKFILL_TESSERACT_COMMAND") \
+                from None
+        except subprocess.TimeoutExpired:
+            raise TesseractError(f"tesseract took more than {self.timeout}s") from None
+        if result.returncode != 0:
+            raise TesseractError(result.stderr.decode("utf-8", "replace").strip() or
+                                 f"tesseract exited with {result.returncode}")
+        return result.stdout.decode("utf-8", "replace")
+
+
+def parse_tsv(tsv):
+    '''
+    Returns the page size in pixels and the recognized words as dicts of TSV_COLUMNS
+    '''
+    page_size = None
+    words = []
+    for row in tsv.splitlines()[1:]:
+        fields = row.split("\t")
+        if len(fields) < len(TSV_COLUMNS) - 1:
+            continue
+        fields += [""] * (len(TSV_COLUMNS) - len(fields))
+        word = dict(zip(TSV_COLUMNS, fields))
+        for name in TSV_COLUMNS[:-2]:
+            word[name] = int(word[name])
+        word["conf"] = float(word["conf"])
+        if word["level"] == 1 and page_size is None:
+            page_size = (word["width"], word["height"])
+        elif word["level"] == WORD_LEVEL and word["text"].strip():
+            words.append(word)
+    return page_size, words
+
+
+def tsv_to_response(tsv, forms=True):
+    page_size, words = parse_tsv(tsv)
+    blocks = []
+    page = {"Id": "page-1", "BlockType": "PAGE", "Page": 1, "Geometry": _geometry(0, 0, 1, 1)}
+    blocks.append(page)
+    if page_size is None or not words:
+        return _response(blocks)
+    page_width, page_height = page_size
+
+    lines = {}
+    for word in words:
+        lines.setdefault((word["block_num"], word["par_num"], word["line_num"]), []).append(word)
+
+    line_ids = []
+    key_value_blocks = []
+    for line_number, line_words in enumerate(lines.values(), start=1):
+        word_blocks = []
+        for word_number, word in enumerate(line_words, start=1):
+            word_blocks.append({
+                "Id": f"word-{line_number}-{word_number}", "BlockType": "WORD", "Page": 1, "TextType": "PRINTED",
+                "Text": word["text"], "Confidence": max(word["conf"], 0.0),
+                "Geometry": _geometry(word["left"] / page_width, word["top"] / page_height,
+                                      word["width"] / page_width, word["height"] / page_height),
+            })
+        line_id = f"line-{line_number}"
+        line_ids.append(line_id)
+        blocks.append({
+            "Id": line_id, "BlockType": "LINE", "Page": 1, "Text": " ".join(word["Text"] for word in word_blocks),
+            "Confidence": _mean_confidence(word_blocks), "Geometry": _union(word_blocks),
+            "Relationships": [{"Type": "CHILD", "Ids": [word["Id"] for word in word_blocks]}],
+        })
+        blocks.extend(word_blocks)
+        if forms:
+            key_value_blocks.extend(_key_value_set(line_number, word_blocks))
+
+    page["Relationships"] = [{"Type": "CHILD", "Ids": line_ids}]
+    blocks.extend(key_value_blocks)
+    return _response(blocks)
+
+
+def _key_value_set(line_number, word_blocks):
+    # One pair per line, split after its first word ending with ":"
+    split = next((i for i, word in enumerate(word_blocks) if word["Text"].endswith(":")), None)
+    if split is None:
+        return []
+    key_words, value_words = word_blocks[:split + 1], word_blocks[split + 1:]
+    key_geometry = _union(key_words)
+    if value_words:
+        value_geometry = _union(value_words)
+    else:
+        key_box = key_geometry["BoundingBox"]
+        left = key_box["Left"] + key_box["Width"] + BLANK_VALUE_GAP
+        value_geometry = _geometry(left, key_box["Top"], max(0.0, min(BLANK_VALUE_WIDTH, 1 - left)),
+                                   key_box["Height"])
+    key_id, value_id = f"key-{line_number}", f"value-{line_number}"
+    value_children = [word["Id"] for word in value_words if not BLANK.match(word["Text"])]
+    key = {"Id": key_id, "BlockType": "KEY_VALUE_SET", "EntityTypes": ["KEY"], "Page": 1,
+           "Confidence": _mean_confidence(key_words), "Geometry": key_geometry,
+           "Relationships": [{"Type": "VALUE", "Ids": [value_id]},
+                             {"Type": "CHILD", "Ids": [word["Id"] for word in key_words]}]}
+    value = {"Id": value_id, "BlockType": "KEY_VALUE_SET", "EntityTypes": ["VALUE"], "Page": 1,
+             "Confidence": _mean_confidence(value_words or key_words), "Geometry": value_geometry}
+    if value_children:
+        value["Relationships"] = [{"Type": "CHILD", "Ids": value_children}]
+    return [key, value]
+
+
+def _response(blocks):
+    return {"DocumentMetadata": {"Pages": 1}, "OCREngine": ENGINE, "Blocks": blocks}
+
+
+def _geometry(left, top, width, height):
+    return {
+        "BoundingBox": {"Width": width, "Height": height, "Left": left, "Top": top},
+        "Polygon": [{"X": left, "Y": top}, {"X": left + width, "Y": top},
+                    {"X": left + width, "Y": top + height}, {"X": left, "Y": top + height}],
+    }
+
+
+def _union(blocks):
+    boxes = [block["Geometry"]["BoundingBox"] for block in blocks]
+    left = min(box["Left"] for box in boxes)
+    top = min(box["Top"] for box in boxes)
+    right = max(box["Left"] + box["Width"] for box in boxes)
+    bottom = max(box["Top"] + box["Height"] for box in boxes)
+    return _geometry(left, top, right - left, bottom - top)
+
+
+def _mean_confidence(blocks):
+    return sum(block["Confidence"] for block in blocks) / len(blocks)
@@ -0,0 +1,180 @@
+import functools
+import random
+import threading
+import time
+from collections import deque
+
+from quickfill.const import (STAGE_WORKERS, TEXTRACT_BURST,
+                             TEXTRACT_MAX_RETRIES, TEXTRACT_TPS)
+from quickfill.executor import Stage, run_in_stage
+from quickfill.telemetry import span
+
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException",
+    "ProvisionedThroughputExceededException",
+    "LimitExceededException",
+}
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {"InternalServerError", "ServiceUnavailableException"}
+
+
+class TokenBucket:
+    # Blocking token bucket, `rate` tokens per second and at most `burst` saved up
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class TextractMetrics:
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self.waiting = 0  # Calls queued for a rate limit token
+        self.in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.errors = 0
+
+    def add(self, field, n=1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + n)
+
+    def observe(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def info(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            info = {
+                "waiting": self.waiting,
+                "in_flight": self.in_flight,
+                "requests": self.requests,
+                "retries": self.retries,
+                "throttled": self.throttled,
+                "errors": self.errors,
+            }
+        if latencies:
+            info["latency_p50"] = latencies[len(latencies) // 2]
+            info["latency_p95"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            info["latency_max"] = latencies[-1]
+        return info
+
+
+def _default_client_factory(max_pool_connections=None):
+    # boto3 takes ~150ms to import, only paid by the first Textract call
+    import boto3
+    from botocore.config import Config
+
+    # A session of our own, boto3's default one isn't thread safe.
+    # Retries are handled by TextractClient so throttling goes through our backoff and metrics
+    return boto3.session.Session().client("textract", config=Config(
+        retries={"max_attempts": 1, "mode": "standard"},
+        max_pool_connections=max_pool_connections or STAGE_WORKERS[Stage.OCR.value]))
+
+
+class TextractClient:
+    '''
+    One long lived Textract client shared by every thread (botocore clients are thread safe and pool their
+    connections, pool_size of them), with a TPS rate limiter and jittered exponential backoff.
+    '''
+
+    def __init__(self, pool_size=None, tps=TEXTRACT_TPS, burst=TEXTRACT_BURST, max_retries=TEXTRACT_MAX_RETRIES,
+                 base_delay=0.5, max_delay=20.0, client_factory=None):
+        self.pool_size = pool_size or STAGE_WORKERS[Stage.OCR.value]
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate_limiter = TokenBucket(tps, burst)
+        self.metrics = TextractMetrics()
+        self._client_factory = client_factory or functools.partial(_default_client_factory, self.pool_size)
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._client_factory()
+        return self._client
+
+    def _backoff(self, attempt):
+        # "Full jitter": uniform between 0 and the exponential cap
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _call(self, operation, **kwargs):
+        # Imported with the first call, like boto3 in _default_client_factory, so the app starts without botocore
+        from botocore.exceptions import (ClientError, ConnectionError,
+                                         ReadTimeoutError)
+
+        attempt = 0
+        while True:
+            self.metrics.add("waiting")
+            try:
+                self.rate_limiter.acquire()
+                client = self._get_client()
+            finally:
+                self.metrics.add("waiting", -1)
+
+            self.metrics.add("in_flight")
+            self.metrics.add("requests")
+            start = time.monotonic()
+            try:
+                with span(f"textract.{operation}"):
+                    return getattr(client, operation)(**kwargs)
+            except ClientError as e:
+                code = e.response.get("Error", {}).get("Code")
+                if code not in RETRYABLE_ERROR_CODES or attempt >= self.max_retries:
+                    self.metrics.add("errors")
+                    raise
+                if code in THROTTLING_ERROR_CODES:
+                    self.metrics.add("throttled")
+            except (ConnectionError, ReadTimeoutError):
+                if attempt >= self.max_retries:
+                    self.metrics.add("errors")
+                    raise
+            finally:
+                self.metrics.observe(time.monotonic() - start)
+                self.metrics.add("in_flight", -1)
+
+            self.metrics.add("retries")
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+
+    def analyze_document(self, image_bytes, feature_types=("TABLES", "FORMS")):
+        if not isinstance(image_bytes, (bytes, bytearray)):
+            image_bytes = bytes(image_bytes)  # botocore rejects a memoryview of a spooled upload
+        return self._call("analyze_document", Document={'Bytes': image_bytes}, FeatureTypes=list(feature_types))
+
+    async def analyze_document_async(self, image_bytes, feature_types=("TABLES", "FORMS")):
+        return await run_in_stage(Stage.OCR, self.analyze_document, image_bytes, feature_types)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_textract_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = TextractClient()
+    return _client
@@ -0,0 +1,161 @@
+import re
+
+from PIL import Image
+from reportlab.lib.rl_accel import escapePDF, fp_str
+from reportlab.pdfbase.acroform import AcroForm
+from reportlab.pdfbase.pdfdoc import NoEncryption, PDFString
+from quickfill.const import LAYOUT_FONT_NAME
+from quickfill.pdf.layout import BORDER_WIDTH, LINE_HEIGHT, layout_fields
+from quickfill.pdf.render import render_filled_pdf
+from quickfill.preprocess import TRANSPOSED_ORIENTATIONS
+from quickfill.upload import open_buffer
+
+# Filled form b PDFs whose field values can be changed without rendering the page again.
+# The first render is the usual single pass one (quickfill/pdf/render.py). Changing values appends a PDF
+# incremental update to it: a new widget dictionary and appearance stream per changed field, an xref
+# section for them and a trailer pointing back at the previous one. The scan and every other field are
+# left as they are, so the cost is in the number of changed fields, not the size of the page.
+
+XREF_ENTRY = re.compile(rb"(\d{10}) (\d{5}) ([nf])")
+REFERENCE = rb"(\d+) 0 R"
+# Resource name of the layout font in the AcroForm's /DR, as reportlab registered it (Helvetica -> Helv)
+FONT_RESOURCE = AcroForm.formFontNames[LAYOUT_FONT_NAME]
+
+
+class _Document:
+    # What PDFString.format needs from a reportlab document
+    encrypt = NoEncryption()
+
+
+def pdf_string(text) -> bytes:
+    return PDFString(text).format(_Document())
+
+
+class FilledPDF:
+    '''
+    A single page filled form b (render_filled_pdf output) and the objects of its fields.
+    with_values returns a new FilledPDF, the previous one stays valid.
+    '''
+
+    def __init__(self, data, page_size, offsets, size, trailer, startxref, widgets):
+        self.data = data
+        self.page_size = page_size
+        self.offsets = offsets  # object number -> offset of its latest version
+        self.size = size  # Next free object number
+        self.trailer = trailer  # Root / Info / ID entries, copied to every update
+        self.startxref = startxref
+        self.widgets = widgets  # field key -> widget object number
+
+    @classmethod
+    def render(cls, image_bytes, key_value_pairs_obj, page_size=None, orientation=1):
+        if page_size is None:
+            with Image.open(open_buffer(image_bytes)) as image:
+                page_size = image.size[::-1] if orientation in TRANSPOSED_ORIENTATIONS else image.size
+        output = render_filled_pdf(image_bytes, key_value_pairs_obj, page_size, orientation=orientation)
+        return cls.parse(output.getvalue(), page_size, list(key_value_pairs_obj))
+
+    @classmethod
+    def parse(cls, data, page_size, keys):
+        # keys: the fields in drawing order, which is the order of the AcroForm's /Fields
+        startxref = int(data[data.rindex(b"startxref") + len(b"startxref"):].split()[0])
+        offsets = {}
+        position = startxref + len(b"xref")
+        while True:
+            header = re.compile(rb"\s*(\d+) (\d+)\s*\n").match(data, position)
+            if header is None:
+                break
+            first, count = int(header.group(1)), int(header.group(2))
+            entries = XREF_ENTRY.findall(data, header.end(), header.end() + 20 * count)
+            for number, (offset, _, kind) in enumerate(entries, start=first):
+                if kind == b"n":
+                    offsets[number] = int(offset)
+            position = header.end() + 20 * count
+        trailer_start = data.index(b"trailer", position)
+        trailer = data[trailer_start:data.index(b"startxref", trailer_start)]
+        size = int(re.search(rb"/Size (\d+)", trailer).group(1))
+        entries = {name: re.search(pattern, trailer).group(0) for name, pattern in
+                   (("Root", rb"/Root " + REFERENCE), ("Info", rb"/Info " + REFERENCE), ("ID", rb"/ID\s*\[[^\]]*\]"))
+                   if re.search(pattern, trailer)}
+
+        pdf = cls(data, page_size, offsets, size, entries, startxref, {})
+        root = pdf.object_source(int(re.search(REFERENCE, entries["Root"]).group(1)))
+        acro_form = pdf.object_source(int(re.search(rb"/AcroForm " + REFERENCE, root).group(1)))
+        fields = re.search(rb"/Fields \[([^\]]*)\]", acro_form).group(1)
+        pdf.widgets = dict(zip(keys, (int(number) for number in re.findall(REFERENCE, fields))))
+        return pdf
+
+    def object_source(self, number) -> bytes:
+        # The object's body, between "N 0 obj" and "endobj"
+        start = self.offsets[number]
+        start = self.data.index(b"obj", start) + len(b"obj")
+        return self.data[start:self.data.index(b"endobj", start)].strip()
+
+    def with_values(self, key_value_pairs_obj) -> "FilledPDF":
+        '''
+        key_value_pairs_obj: the changed fields only, with their BoundingBox and new Value
+        '''
+        changed = {key: field for key, field in key_value_pairs_obj.items() if key in self.widgets}
+        if not changed:
+            return self
+        layout = layout_fields(changed, self.page_size)
+        objects = []
+        number = self.size
+        for key, text, _, _, width, height, font_size, multiline in layout:
+            widget_number = self.widgets[key]
+            widget = self.object_source(widget_number)
+            appearance_number = int(re.search(rb"/AP <<\s*/N " + REFERENCE, widget).group(1))
+            objects.append((number, _appearance_stream(self.object_source(appearance_number), text, font_size,
+                                                       width, height)))
+            objects.append((widget_number, _widget(widget, number, text, font_size, multiline)))
+            number += 1
+        return self._append(objects, number)
+
+    def _append(self, objects, size):
+        update = bytearray(b"\n")
+        offsets = dict(self.offsets)
+        base = len(self.data)
+        for number, body in objects:
+            offsets[number] = base + len(update)
+            update += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+        xref = base + len(update)
+        update += b"xref\n0 1\n0000000000 65535 f \n"
+        for number, _ in sorted(objects):
+            update += b"%d 1\n%010d 00000 n \n" % (number, offsets[number])
+        update += b"trailer\n<<\n%s\n/Prev %d\n/Size %d\n>>\nstartxref\n%d\n%%%%EOF\n" % (
+            b"\n".join(self.trailer.values()), self.startxref, size, xref)
+        return FilledPDF(self.data + bytes(update), self.page_size, offsets, size, self.trailer, xref, self.widgets)
+
+
+def _widget(source, appearance_number, text, font_size, multiline):
+    value = pdf_string(text)
+    source = re.sub(rb"/AP <<\s*/N " + REFERENCE + rb"\s*>>", b"/AP << /N %d 0 R >>" % appearance_number, source)
+    default_appearance = f"/DA (/{FONT_RESOURCE} {fp_str(font_size)} Tf 0 0 0 rg)".encode()
+    source = re.sub(rb"/DA \((?:\\.|[^\\)])*\)", lambda m: default_appearance, source)
+    source = re.sub(rb"/Ff \d+", b"/Ff %d" % (4096 if multiline else 0), source)
+    for name in (rb"/V", rb"/DV"):
+        source = re.sub(name + rb" (?:\((?:\\.|[^\\)])*\)|<[0-9A-Fa-f]*>)", lambda m: name + b" " + value, source)
+    return source
+
+
+def _appearance_stream(source, text, font_size, width, height):
+    # Same drawing as reportlab's acroform text field: white box, underline, text clipped to the box
+    dictionary = source[:source.index(b"stream")].strip()
+    dictionary = re.sub(rb"/Filter \[[^\]]*\]\s*", b"", dictionary)
+    leading = LINE_HEIGHT * font_size
+    inset = 2 * BORDER_WIDTH
+    lines = ["1 1 1 rg", f"0 0 {fp_str(width)} {fp_str(height)} re", "f",
+             f"0 0 0 RG {BORDER_WIDTH} w 0 {fp_str(BORDER_WIDTH / 2)} m {fp_str(width)} {fp_str(BORDER_WIDTH / 2)} l s",
+             "/Tx BMC", "q", f"{inset} {inset} {fp_str(width - 2 * inset)} {fp_str(height - 2 * inset)} re", "W", "n",
+             "0 g", "0 G"]
+    if text:
+        lines += ["BT", f"/{FONT_RESOURCE} {fp_str(font_size)} Tf", "0 0 0 rg",
+                  f"1 0 0 1 {2 * inset} {fp_str(height - font_size - inset)} Tm"]
+        for i, line in enumerate(text.split("\n")):
+            if i:
+                lines.append(f"0 {fp_str(-leading)} Td")
+            lines.append(f"({escapePDF(line)}) Tj")
+        lines.append("ET")
+    lines += ["Q", "EMC"]
+    content = "\n".join(lines).encode("latin-1", "replace")
+    dictionary = re.sub(rb"/Length \d+", b"/Length %d" % len(content), dictionary)
+    return b"%s\nstream\n%s\nendstream" % (dictionary, content)
@@ -0,0 +1,135 @@
+import functools
+
+import numpy as np
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from quickfill.const import (LAYOUT_FONT_NAME, LAYOUT_MAX_FONT_SIZE,
+                             LAYOUT_WRAP, LAYOUT_WRAP_SHRINK)
+
+# Geometry and font sizes of the filled fields of a page, for all the fields at once.
+# Textract bounding boxes (ratios of the page, from the top) become page coordinates in one numpy pass,
+# and every value gets the largest font size its box fits, measured with the font's glyph widths.
+# Values too long for one line are wrapped when that gives them a larger font, the size then comes
+# from a binary search since the line count changes with it.
+
+# Font size of a one line box, as a ratio of its height
+HEIGHT_RATIO = 0.7
+# reportlab's acroform text fields: 1.2 line leading, text inset by 4 border widths and clipped 2 before the right edge
+LINE_HEIGHT = 1.2
+BORDER_WIDTH = 1
+# Binary search precision of a wrapped value's font size, in page units
+FIT_TOLERANCE = 0.25
+
+
+@functools.lru_cache(maxsize=None)
+def width_table(font_name=LAYOUT_FONT_NAME):
+    # Advance of code points 0-255 at font size 1, other characters are measured as "?"
+    return np.array([stringWidth(chr(code), font_name, 1) for code in range(256)])
+
+
+def text_widths(texts, font_name=LAYOUT_FONT_NAME):
+    '''
+    Widths of texts at font size 1, as an array
+    '''
+    encoded = [text.encode("latin-1", "replace") for text in texts]
+    lengths = np.fromiter(map(len, encoded), dtype=np.intp, count=len(encoded))
+    codes = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    totals = np.concatenate(([0.0], np.cumsum(width_table(font_name)[codes])))
+    ends = np.cumsum(lengths)
+    return totals[ends] - totals[ends - lengths]
+
+
+class PageLayout:
+    def __init__(self, keys, values, x, y, width, height, font_size, multiline):
+        self.keys = keys
+        self.values = values
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.font_size = font_size
+        self.multiline = multiline
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        # (key, value, x, y, width, height, font size, multiline) of every field, as plain floats
+        return zip(self.keys, self.values, *(np.round(column, 2).tolist() for column in
+                                             (self.x, self.y, self.width, self.height, self.font_size)),
+                   self.multiline.tolist())
+
+
+def layout_fields(key_value_pairs_obj, page_size, page=None, origin=(0, 0), font_name=LAYOUT_FONT_NAME,
+                  max_font_size=LAYOUT_MAX_FONT_SIZE, wrap=LAYOUT_WRAP, wrap_shrink=LAYOUT_WRAP_SHRINK):
+    '''
+    Lays out the fields of key_value_pairs_obj on a page of page_size. page: only the fields of that page
+    (fields without a 'Page' are on page 1), origin: the page's offset in the canvas.
+    '''
+    fields = [(key, field) for key, field in key_value_pairs_obj.items()
+              if page is None or field.get('Page', 1) == page]
+    keys = [key for key, _ in fields]
+    values = [_text(field.get('Value', 'Hello World')) for _, field in fields]
+    boxes = np.array([[field['BoundingBox'][name] for name in ('Left', 'Top', 'Width', 'Height')]
+                      for _, field in fields], dtype=float).reshape(-1, 4)
+
+    page_width, page_height = page_size
+    left, top, width, height = boxes.T
+    x = origin[0] + left * page_width
+    y = origin[1] + (1 - top - height) * page_height
+    width = width * page_width
+    height = height * page_height
+
+    # One line: the box's font size, shrunk until the value fits its width
+    line_width = np.maximum(width - 6 * BORDER_WIDTH, 0)
+    font_size = np.minimum(height * HEIGHT_RATIO, max_font_size)
+    unit_widths = text_widths(values, font_name)
+    fit = np.minimum(font_size, line_width / np.where(unit_widths > 0, unit_widths, np.inf))
+
+    multiline = np.zeros(len(values), dtype=bool)
+    if wrap:
+        for i in np.flatnonzero(fit < font_size * wrap_shrink):
+            if ' ' not in values[i].strip():
+                continue
+            size, lines = fit_wrapped(values[i], line_width[i], height[i] - 2 * BORDER_WIDTH, fit[i], font_size[i],
+                                      font_name)
+            if len(lines) > 1:
+                fit[i], values[i], multiline[i] = size, "\n".join(lines), True
+    return PageLayout(keys, values, x, y, width, height, fit, multiline)
+
+
+def fit_wrapped(text, line_width, height, low, high, font_name=LAYOUT_FONT_NAME):
+    '''
+    Largest font size in [low, high] at which text, wrapped on words, fits line_width x height.
+    Returns (font size, lines), lines is [text] when nothing larger than low fits.
+    '''
+    words = text.split()
+    word_widths = text_widths(words, font_name).tolist()
+    space_width = width_table(font_name)[ord(' ')]
+    best = [text]
+    while high - low > FIT_TOLERANCE:
+        size = (low + high) / 2
+        lines, widest = wrap_words(words, word_widths, space_width, line_width / size)
+        if widest * size <= line_width and len(lines) * LINE_HEIGHT * size <= height:
+            low, best = size, lines
+        else:
+            high = size
+    return low, best
+
+
+def wrap_words(words, word_widths, space_width, max_width):
+    # Greedy wrap, widths at font size 1. Returns the lines and the widest one's width
+    lines, line, line_width, widest = [], [], 0.0, 0.0
+    for word, width in zip(words, word_widths):
+        if line and line_width + space_width + width > max_width:
+            lines.append(" ".join(line))
+            widest = max(widest, line_width)
+            line, line_width = [], 0.0
+        line_width += width + (space_width if line else 0.0)
+        line.append(word)
+    lines.append(" ".join(line))
+    return lines, max(widest, line_width)
+
+
+def _text(value):
+    # LLMs answer numbers and nulls too
+    return "" if value is None else str(value)
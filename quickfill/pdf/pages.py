@@ -0,0 +1,81 @@
+import io
+
+from PIL import Image
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from quickfill.preprocess import detect_mime, preprocess_image
+from quickfill.upload import open_buffer
+
+# Multi-page intake documents (PDF and multi-frame TIFF) are split into pages, every page is OCR'd
+# on its own (so it gets its own cache entry) and the key value geometry remembers the page number.
+# PDF pages are sent to Textract as single page PDFs, TIFF frames as preprocessed JPEGs and the filled PDF
+# is drawn on the full size frames.
+
+
+class DocumentPage:
+    def __init__(self, number, data, mime, size, origin=(0, 0), original=None, orientation=1):
+        self.number = number  # 1 based, like Textract's Block.Page
+        self.data = data  # Sent to OCR
+        self.mime = mime
+        self.size = size  # (width, height), points for PDF pages, pixels of the original for images
+        self.origin = origin  # Lower left corner of the PDF page's MediaBox
+        self.original = data if original is None else original  # Drawn in the filled PDF
+        self.orientation = orientation  # EXIF orientation of original
+
+
+def split_pdf(data):
+    reader = PdfFileReader(open_buffer(data), strict=False)
+    pages = []
+    for i in range(reader.getNumPages()):
+        page = reader.getPage(i)
+        writer = PdfFileWriter()
+        writer.addPage(page)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        box = page.mediaBox
+        pages.append(DocumentPage(i + 1, buffer.getvalue(), "application/pdf",
+                                  (float(box.getWidth()), float(box.getHeight())),
+                                  (float(box.getLowerLeft_x()), float(box.getLowerLeft_y()))))
+    return pages
+
+
+def split_tiff(data):
+    pages = []
+    with Image.open(open_buffer(data)) as image:
+        for i in range(getattr(image, "n_frames", 1)):
+            image.seek(i)
+            buffer = io.BytesIO()
+            image.convert("RGB").save(buffer, format="PNG", compress_level=1)
+            page = preprocess_image(buffer.getvalue())
+            pages.append(DocumentPage(i + 1, page.data, page.mime, page.page_size, original=page.original))
+    return pages
+
+
+def split_pages(data):
+    mime = detect_mime(data)
+    if mime == "application/pdf":
+        return split_pdf(data)
+    if mime == "image/tiff":
+        return split_tiff(data)
+    page = preprocess_image(data)
+    return [DocumentPage(1, page.data, page.mime, page.page_size, original=page.original,
+                         orientation=page.orientation)]
+
+
+def merge_key_value_pairs(pages, results):
+    '''
+    Merges the (key_value_pairs, key_value_pairs_obj) OCR'd from every page.
+    Each field records its page, keys found again on a later page get a " (page n)" suffix.
+    '''
+    key_value_pairs = {}
+    key_value_pairs_obj = {}
+    for page, (page_pairs, page_obj) in zip(pages, results):
+        for key, value in page_pairs.items():
+            name = key if key not in key_value_pairs else f"{key} (page {page.number})"
+            key_value_pairs[name] = value
+            if key in page_obj:
+                key_value_pairs_obj[name] = {**page_obj[key], 'Page': page.number}
+    return key_value_pairs, key_value_pairs_obj
+
+
+def join_text(results):
+    return "".join(results)
@@ -0,0 +1,183 @@
+import io
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import ArrayObject, DictionaryObject, NameObject
+from reportlab import rl_config
+from reportlab.lib import colors
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+from quickfill.const import LAYOUT_FONT_NAME
+from quickfill.pdf.layout import BORDER_WIDTH, layout_fields
+from quickfill.preprocess import TRANSPOSED_ORIENTATIONS
+from quickfill.upload import open_buffer
+
+# Single pass renderer for the filled form b: the scan is the page background and the AcroForm
+# fields are drawn on top of it in the same canvas. JPEG scans are embedded as they are
+# (DCTDecode, no decode or re-encode), other formats go through reportlab's own image loader.
+# Scans with an EXIF orientation are turned upright by the page's transformation matrix, not re-encoded.
+# Replaces the overlay + image to PDF + PyPDF2 merge of export_pdf_through_json.
+# PDF inputs still need a merge, their pages are kept as they are and get a fields overlay.
+
+# Binary image streams, ASCII85 would grow every embedded scan by a quarter
+rl_config.useA85 = 0
+
+
+def draw_form_fields(can: canvas.Canvas, key_value_pairs_obj, page_size, page=None, origin=(0, 0)):
+    # page: only draw the fields of that page (fields without a 'Page' are on page 1)
+    # Positions and font sizes come from quickfill/pdf/layout.py
+    form = can.acroForm
+    layout = layout_fields(key_value_pairs_obj, page_size, page=page, origin=origin)
+    for key, text, x, y, width, height, font_size, multiline in layout:
+        form.textfield(name=key, tooltip=key, x=x, y=y, width=width, height=height,
+                       borderColor=colors.black, fillColor=colors.white,
+                       textColor=colors.black, borderWidth=BORDER_WIDTH, fontName=LAYOUT_FONT_NAME,
+                       fontSize=font_size, fieldFlags='multiline' if multiline else '',
+                       borderStyle='underlined', forceBorder=True,
+                       value=text)
+
+
+# Upright (x, y) of the stored image's pixel (x, y), per EXIF orientation, y pointing down
+_UPRIGHT = {
+    1: lambda x, y, w, h: (x, y),
+    2: lambda x, y, w, h: (w - x, y),
+    3: lambda x, y, w, h: (w - x, h - y),
+    4: lambda x, y, w, h: (x, h - y),
+    5: lambda x, y, w, h: (y, x),
+    6: lambda x, y, w, h: (h - y, x),
+    7: lambda x, y, w, h: (h - y, w - x),
+    8: lambda x, y, w, h: (y, w - x),
+}
+
+
+def orientation_matrix(orientation, image_size, page_size):
+    '''
+    PDF transformation (a, b, c, d, e, f) drawing an image of image_size stored with an EXIF orientation
+    upright on a page of page_size
+    '''
+    upright = _UPRIGHT.get(orientation, _UPRIGHT[1])
+    width, height = image_size
+    scale_x, scale_y = page_size[0] / width, page_size[1] / height
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        scale_x, scale_y = page_size[0] / height, page_size[1] / width
+
+    def page_point(x, y):
+        # PDF y points up, the stored image is drawn on (0, 0, width, height)
+        upright_x, upright_y = upright(x, height - y, width, height)
+        return upright_x * scale_x, page_size[1] - upright_y * scale_y
+
+    e, f = page_point(0, 0)
+    a, b = (value - origin for value, origin in zip(page_point(1, 0), (e, f)))
+    c, d = (value - origin for value, origin in zip(page_point(0, 1), (e, f)))
+    return a, b, c, d, e, f
+
+
+def draw_scan(can: canvas.Canvas, image, page_size, orientation=1):
+    if orientation == 1:
+        can.drawImage(image, 0, 0, width=page_size[0], height=page_size[1])
+        return
+    image_size = image.getSize()
+    can.saveState()
+    can.transform(*orientation_matrix(orientation, image_size, page_size))
+    can.drawImage(image, 0, 0, width=image_size[0], height=image_size[1])
+    can.restoreState()
+
+
+class _ScanReader(ImageReader):
+    # drawImage names an image by a digest of getRGBData(), which would decode the whole scan.
+    # JPEGs are embedded from their file handle, so the encoded bytes are digested instead.
+    def __init__(self, image_bytes):
+        super().__init__(open_buffer(image_bytes))
+        self._source = image_bytes
+
+    def getRGBData(self):
+        if self.jpeg_fh() is None:
+            return super().getRGBData()
+        self._dataA = None
+        return self._source
+
+
+def render_filled_pdf(image_bytes, key_value_pairs_obj, page_size=None, output=None, orientation=1):
+    '''
+    Writes the filled form b into output (a writable binary file, BytesIO by default) and returns it,
+    rewound when it is seekable. page_size is the upright image size in pixels, read from the header if not given.
+    orientation: EXIF orientation of image_bytes
+    '''
+    image = _ScanReader(image_bytes)
+    if page_size is None:
+        width, height = image.getSize()
+        page_size = (height, width) if orientation in TRANSPOSED_ORIENTATIONS else (width, height)
+    if output is None:
+        output = io.BytesIO()
+
+    can = canvas.Canvas(output, pagesize=page_size)
+    draw_scan(can, image, page_size, orientation)
+    draw_form_fields(can, key_value_pairs_obj, page_size)
+    can.showPage()
+    can.save()
+
+    if output.seekable():
+        output.seek(0)
+    return output
+
+
+def render_filled_pages(pages, key_value_pairs_obj, output=None):
+    '''
+    Multi-page variant of render_filled_pdf for split image documents (eg: TIFF),
+    pages is a list of quickfill.pdf.pages.DocumentPage. Every field goes on its own page.
+    '''
+    if output is None:
+        output = io.BytesIO()
+
+    can = canvas.Canvas(output)
+    for page in pages:
+        can.setPageSize(page.size)
+        draw_scan(can, _ScanReader(page.original), page.size, page.orientation)
+        draw_form_fields(can, key_value_pairs_obj, page.size, page=page.number)
+        can.showPage()
+    can.save()
+
+    if output.seekable():
+        output.seek(0)
+    return output
+
+
+def render_filled_pdf_document(pdf_bytes, pages, key_value_pairs_obj, output=None):
+    '''
+    Fills a PDF form b: its pages are kept as they are (vector content included) and the fields
+    of every page are stamped on it from one overlay document.
+    '''
+    overlay = io.BytesIO()
+    can = canvas.Canvas(overlay)
+    for page in pages:
+        can.setPageSize(page.size)
+        draw_form_fields(can, key_value_pairs_obj, page.size, page=page.number, origin=page.origin)
+        can.showPage()
+    can.save()
+
+    source = PdfFileReader(open_buffer(pdf_bytes), strict=False)
+    fields_pdf = PdfFileReader(overlay)
+    writer = PdfFileWriter()
+    fields = ArrayObject()
+    for i in range(source.getNumPages()):
+        page = source.getPage(i)
+        if i < fields_pdf.getNumPages():
+            page.mergePage(fields_pdf.getPage(i))
+        writer.addPage(page)
+        fields.extend(page.get('/Annots', ()))
+
+    # mergePage carries the widgets over but not the document's AcroForm, rebuild it around them
+    root = fields_pdf.trailer['/Root']
+    if '/AcroForm' in root:
+        acro_form = root['/AcroForm']
+        form = DictionaryObject({NameObject('/Fields'): fields})
+        for name in ('/DA', '/DR'):
+            if name in acro_form:
+                form[NameObject(name)] = acro_form.raw_get(name)
+        writer._root_object[NameObject('/AcroForm')] = form
+
+    if output is None:
+        output = io.BytesIO()
+    writer.write(output)
+    if output.seekable():
+        output.seek(0)
+    return output
@@ -0,0 +1,132 @@
+import asyncio
+
+from quickfill.ai.ai_form_filling import (chunked_form_filling,
+                                          export_pdf_through_json,
+                                          update_nested_dict)
+from quickfill.ai.key_matcher import LLM_ENGINE, fill_locally, llm_updates
+from quickfill.ai.multimodal_form_filling import process_text_with_images_gpt4v
+from quickfill.const import TEMPLATES_ENABLED
+from quickfill.executor import Stage, run_in_stage
+from quickfill.ocr.aws_text_extract import OCRReturnType, api_analyze_document
+from quickfill.pdf.pages import join_text, merge_key_value_pairs, split_pages
+from quickfill.pdf.render import render_filled_pages, render_filled_pdf_document
+from quickfill.preprocess import PreprocessedImage, preprocess_image
+from quickfill.templates import difference_hash, template_registry
+from quickfill.upload import Upload
+
+# Async versions of the fill flows in quickfill/ai/ai_form_filling.py.
+# Every blocking call is awaited on the pool of its stage, so the event loop stays free,
+# and independent stages (eg: OCR of form a and form b) overlap.
+# Uploads are preprocessed once (quickfill/preprocess.py) and the result feeds OCR, the LLM and the PDF.
+# Multi-page documents are split into pages, which are OCR'd concurrently (quickfill/pdf/pages.py).
+
+
+async def analyze_document_async(image_bytes, return_type: OCRReturnType = OCRReturnType.TEXT, image_hash=None,
+                                 source_hash=None):
+    return await run_in_stage(Stage.OCR, api_analyze_document, image_bytes, return_type, image_hash=image_hash,
+                              source_hash=source_hash)
+
+
+async def preprocess_async(image_bytes) -> PreprocessedImage:
+    # image_bytes is bytes or an Upload (quickfill/upload.py), which was hashed while it was read
+    if isinstance(image_bytes, Upload):
+        return await run_in_stage(Stage.IMAGE, preprocess_image, image_bytes.data, image_hash=image_bytes.hash)
+    return await run_in_stage(Stage.IMAGE, preprocess_image, image_bytes)
+
+
+async def document_pages_async(form: PreprocessedImage):
+    if form.pages is None:
+        form.pages = await run_in_stage(Stage.IMAGE, split_pages, form.data)
+    return form.pages
+
+
+async def analyze_pages_async(form: PreprocessedImage, return_type: OCRReturnType):
+    pages = await document_pages_async(form)
+    results = await asyncio.gather(*[analyze_document_async(page.data, return_type) for page in pages])
+    return pages, results
+
+
+async def key_value_pairs_async(form_b: PreprocessedImage):
+    if not form_b.is_document:
+        return await analyze_document_async(form_b.data, OCRReturnType.KEY_VALUE_PAIRS, form_b.data_hash,
+                                            form_b.original_hash)
+    pages, results = await analyze_pages_async(form_b, OCRReturnType.KEY_VALUE_PAIRS)
+    return merge_key_value_pairs(pages, results)
+
+
+async def form_b_fields_async(form_b: PreprocessedImage):
+    # Known blank forms reuse their registered geometry without an OCR call, see quickfill/templates.py
+    if TEMPLATES_ENABLED and not form_b.is_document and template_registry.list():
+        phash, size = await run_in_stage(Stage.IMAGE, difference_hash, form_b.data)
+        template = template_registry.match_hash(phash, size)
+        if template is not None:
+            return template.fields()
+    return await key_value_pairs_async(form_b)
+
+
+async def render_pdf_async(form_b: PreprocessedImage, key_value_pairs_obj):
+    if not form_b.is_document:
+        # Drawn on the upload, not on the downscaled copy OCR got
+        return await run_in_stage(Stage.PDF, export_pdf_through_json, form_b.original, key_value_pairs_obj,
+                                  form_b.page_size, orientation=form_b.orientation)
+    pages = await document_pages_async(form_b)
+    if form_b.mime == "application/pdf":
+        return await run_in_stage(Stage.PDF, render_filled_pdf_document, form_b.data, pages, key_value_pairs_obj)
+    return await run_in_stage(Stage.PDF, render_filled_pages, pages, key_value_pairs_obj)
+
+
+async def fill_form_b_with_text_async(form_b: PreprocessedImage, text_input, use_cache=True, form_a_pairs=None,
+                                      form_b_fields=None):
+    # form_b_fields: form_b_fields_async(form_b)'s result when the caller already has it
+    kv_pairs_result, key_value_pairs_obj = form_b_fields or await form_b_fields_async(form_b)
+    # Fields matching form a's key value pairs are filled locally, the LLM only gets the rest
+    matches, remaining = fill_locally(form_a_pairs, kv_pairs_result, key_value_pairs_obj)
+    json_res = {}
+    if remaining:
+        json_res = await run_in_stage(Stage.LLM, chunked_form_filling, text_input, remaining, use_cache=use_cache)
+    update_nested_dict(key_value_pairs_obj, llm_updates(json_res, matches), engine=LLM_ENGINE)
+    return await render_pdf_async(form_b, key_value_pairs_obj)
+
+
+async def fill_form_b_with_images_async(form_b: PreprocessedImage, form_a_images, use_cache=True):
+    kv_pairs_result, key_value_pairs_obj = await form_b_fields_async(form_b)
+    json_res = await run_in_stage(Stage.LLM, process_text_with_images_gpt4v,
+                                  image_paths=form_a_images, expected_keys=kv_pairs_result, from_bytes=True,
+                                  use_cache=use_cache)
+    update_nested_dict(key_value_pairs_obj, json_res, engine=LLM_ENGINE)
+    return await render_pdf_async(form_b, key_value_pairs_obj)
+
+
+async def process_image_and_text_async(image_bytes, text_input, use_cache=True):
+    form_b = await preprocess_async(image_bytes)
+    return await fill_form_b_with_text_async(form_b, text_input, use_cache=use_cache)
+
+
+async def form_a_text_async(form_a: PreprocessedImage):
+    if not form_a.is_document:
+        return await analyze_document_async(form_a.data, OCRReturnType.TEXT, form_a.data_hash, form_a.original_hash)
+    _, results = await analyze_pages_async(form_a, OCRReturnType.TEXT)
+    return join_text(results)
+
+
+async def form_a_pairs_async(form_a: PreprocessedImage):
+    # Same cached OCR document as form_a_text_async
+    form_a_pairs, _ = await key_value_pairs_async(form_a)
+    return form_a_pairs
+
+
+async def filea_to_fileb_fill_async(filea_img_bytes, fileb_img_bytes, use_cache=True):
+    form_a, form_b = await asyncio.gather(preprocess_async(filea_img_bytes), preprocess_async(fileb_img_bytes))
+    # Form a text is only needed by the LLM step, form b's OCR runs at the same time
+    text_res, form_a_pairs, form_b_fields = await asyncio.gather(
+        form_a_text_async(form_a),
+        form_a_pairs_async(form_a),
+        form_b_fields_async(form_b),
+    )
+    return await fill_form_b_with_text_async(form_b, text_res, use_cache=use_cache, form_a_pairs=form_a_pairs,
+                                             form_b_fields=form_b_fields)
+
+
+async def gpt4v_filea_to_fileb_fill_async(filea_img_bytes, fileb_img_bytes, use_cache=True):
+    form_a, form_b = await asyncio.gather(preprocess_async(filea_img_bytes), preprocess_async(fileb_img_bytes))
+    return await fill_form_b_with_images_async(form_b, [form_a.data], use_cache=use_cache)
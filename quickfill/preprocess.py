@@ -0,0 +1,133 @@
+import copy
+import hashlib
+import io
+
+from PIL import Image, ImageOps
+from quickfill.cache import TieredCache, register_cache
+from quickfill.const import (PREPROCESS_CACHE_ITEMS, PREPROCESS_GRAYSCALE,
+                             PREPROCESS_MAX_DIMENSION,
+                             PREPROCESS_TARGET_BYTES)
+from quickfill.upload import open_buffer
+
+# Runs once per upload before OCR and GPT-4V:
+# EXIF orientation fix, downscale to a max dimension, optional grayscale and JPEG recompression
+# under a byte budget. Results are cached by the upload's content hash.
+# The filled PDF is drawn on the original upload at its own size, OCR geometry is relative to the page
+# so it applies to both. Originals are not cached, they are attached to the result of every call.
+
+preprocess_cache = register_cache(TieredCache("preprocess", memory_items=PREPROCESS_CACHE_ITEMS))
+
+_MAGIC_NUMBERS = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"%PDF", "application/pdf"),
+    (b"BM", "image/bmp"),
+)
+# Formats both Textract and GPT-4V accept as is
+PASSTHROUGH_MIME_TYPES = {"image/jpeg", "image/png"}
+EXIF_ORIENTATION = 0x0112
+# EXIF orientations whose upright image is the stored one turned by 90 degrees
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def detect_mime(data):
+    head = bytes(data[:12])
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for magic, mime in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return mime
+    return "application/octet-stream"
+
+
+class PreprocessedImage:
+    def __init__(self, data, mime, size, original_hash, original_size, orientation=1, data_hash=None):
+        self.data = data  # Sent to OCR and GPT-4V
+        self.data_hash = data_hash  # md5 of data, the OCR cache's key
+        self.mime = mime
+        self.size = size  # (width, height) after preprocessing
+        self.original_hash = original_hash
+        self.original_size = original_size  # (width, height) of the upload as stored, before its EXIF orientation
+        self.orientation = orientation  # EXIF orientation of the upload
+        self.original = None  # The upload's bytes, the filled PDF is drawn on them
+        self.pages = None  # DocumentPage's of a document, set once it has been split
+
+    @property
+    def is_document(self):
+        # PDFs and multi-page TIFFs are kept as they are and split into pages downstream
+        return self.size is None
+
+    @property
+    def page_size(self):
+        # Size of the filled PDF's page: the upright original
+        if self.original_size is None:
+            return None
+        width, height = self.original_size
+        return (height, width) if self.orientation in TRANSPOSED_ORIENTATIONS else (width, height)
+
+
+def _encode_jpeg(image, target_bytes):
+    # Binary search the highest quality that fits in the budget
+    low, high = 40, 90
+    best = None
+    while low <= high:
+        quality = (low + high) // 2
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+        if buffer.tell() <= target_bytes or best is None:
+            best = buffer.getvalue()
+        if buffer.tell() <= target_bytes:
+            low = quality + 1
+        else:
+            high = quality - 1
+    return best
+
+
+def _preprocess(image_bytes, max_dimension, target_bytes, grayscale):
+    mime = detect_mime(image_bytes)
+    with Image.open(open_buffer(image_bytes)) as image:
+        original_size = image.size
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+        needs_resize = max_dimension > 0 and max(original_size) > max_dimension
+        if (mime in PASSTHROUGH_MIME_TYPES and orientation == 1 and not needs_resize and not grayscale
+                and (target_bytes <= 0 or len(image_bytes) <= target_bytes)):
+            return image_bytes, mime, original_size, original_size, orientation
+
+        if mime == "image/tiff" and getattr(image, "n_frames", 1) > 1:
+            return image_bytes, mime, None, original_size, 1
+        # Other multi-frame images (GIF, WebP) are one page forms, their first frame is the form
+        image = ImageOps.exif_transpose(image)
+        if needs_resize:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        image = image.convert("L" if grayscale else "RGB")
+        data = _encode_jpeg(image, target_bytes if target_bytes > 0 else float("inf"))
+        return data, "image/jpeg", image.size, original_size, orientation
+
+
+def preprocess_image(image_bytes, max_dimension=PREPROCESS_MAX_DIMENSION, target_bytes=PREPROCESS_TARGET_BYTES,
+                     grayscale=PREPROCESS_GRAYSCALE, image_hash=None) -> PreprocessedImage:
+    # image_hash is the md5 of image_bytes when the caller already has it (quickfill/upload.py)
+    image_hash = image_hash or hashlib.md5(image_bytes).hexdigest()
+    key = f"{image_hash}:{max_dimension}:{target_bytes}:{int(grayscale)}"
+    result = preprocess_cache.get(key)
+    if result is None:
+        if detect_mime(image_bytes) == "application/pdf":
+            # Documents are sent to OCR as they are
+            result = PreprocessedImage(image_bytes, "application/pdf", None, image_hash, None, data_hash=image_hash)
+        else:
+            data, mime, size, original_size, orientation = _preprocess(image_bytes, max_dimension, target_bytes,
+                                                                       grayscale)
+            # An upload passed through keeps its hash, a new encoding is hashed once here rather than per OCR call
+            data_hash = image_hash if data is image_bytes else hashlib.md5(data).hexdigest()
+            result = PreprocessedImage(data, mime, size, image_hash, original_size, orientation, data_hash)
+        if result.data is image_bytes:
+            result.original = image_bytes
+        preprocess_cache.set(key, result)
+    if result.original is None:
+        result = copy.copy(result)
+        result.original = image_bytes
+    return result
@@ -0,0 +1,76 @@
+import importlib
+import threading
+
+from quickfill.const import (LLM_PROVIDER, OCR_PROVIDER, PRELOAD_PROVIDERS,
+                             VISION_PROVIDER)
+
+# Registry of the OCR, LLM and vision backends. A backend is imported and created on first use:
+# langchain, vertexai and boto3 take seconds to import and a deployment uses one of each kind at most.
+# QUICKFILL_PRELOAD_PROVIDERS=1 loads the configured ones at startup instead of on the first request.
+#
+#   get_provider("ocr").analyze_document(image_bytes, feature_types) -> Textract AnalyzeDocument style response
+#   get_provider("llm").complete(prompt_template, variables, model, temperature), stream(...), extract(...),
+#                       compile_extraction(schema, model, temperature) -> run(context_str)
+#   get_provider("vision").complete_with_images(text, images, model, temperature, detail), stream_with_images(...)
+
+# kind -> name -> "module:attribute", called once to create the provider
+PROVIDERS = {
+    "ocr": {
+        "textract": "quickfill.ocr.textract_client:get_textract_client",
+        "tesseract": "quickfill.ocr.tesseract:TesseractOCR",
+        "local_first": "quickfill.ocr.routing:LocalFirstOCR",
+    },
+    "llm": {
+        "openai": "quickfill.ai.openai_provider:OpenAIProvider",
+    },
+    "vision": {
+        "openai": "quickfill.ai.openai_provider:OpenAIProvider",
+        "gemini": "quickfill.ai.gemini_provider:GeminiProvider",
+    },
+}
+CONFIGURED = {"ocr": OCR_PROVIDER, "llm": LLM_PROVIDER, "vision": VISION_PROVIDER}
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+def register_provider(kind, name, target):
+    # target is "module:attribute" or a callable creating the provider, a loaded provider of that name is replaced
+    with _lock:
+        PROVIDERS.setdefault(kind, {})[name] = target
+        _loaded.pop((kind, name), None)
+
+
+def get_provider(kind, name=None):
+    name = name or CONFIGURED[kind]
+    provider = _loaded.get((kind, name))
+    if provider is not None:
+        return provider
+    with _lock:
+        if (kind, name) not in _loaded:
+            try:
+                target = PROVIDERS[kind][name]
+            except KeyError:
+                raise ValueError(f"Unknown {kind} provider: {name}") from None
+            if isinstance(target, str):
+                module, attribute = target.split(":")
+                target = getattr(importlib.import_module(module), attribute)
+            _loaded[(kind, name)] = target()
+        return _loaded[(kind, name)]
+
+
+def loaded_provider(kind, name=None):
+    # The provider if it was already created, never loads it
+    return _loaded.get((kind, name or CONFIGURED[kind]))
+
+
+def preload_providers(force=False):
+    if not (PRELOAD_PROVIDERS or force):
+        return
+    for kind in CONFIGURED:
+        get_provider(kind)
+
+
+def get_provider_info():
+    return {kind: {"configured": name, "loaded": sorted(loaded for k, loaded in _loaded if k == kind)}
+            for kind, name in CONFIGURED.items()}
@@ -0,0 +1,204 @@
+import asyncio
+import contextlib
+import copy
+import difflib
+import hashlib
+import io
+import re
+import time
+
+from quickfill.ai.ai_form_filling import (chunked_form_filling,
+                                          update_nested_dict)
+from quickfill.ai.key_matcher import LLM_ENGINE, llm_updates
+from quickfill.cache import LRUCache
+from quickfill.const import REFILL_SESSION_ITEMS, REFILL_SESSION_TTL
+from quickfill.executor import Stage, run_in_stage
+from quickfill.pdf.incremental import FilledPDF
+from quickfill.pipeline import (form_b_fields_async, preprocess_async,
+                                render_pdf_async)
+from quickfill.upload import Upload
+
+# Incremental re-fill of /ai_process_form/ within a session: a user fixes a line of their form a text and
+# submits again. The session remembers, per form b, the form a lines and the filled values. A new submission
+# is diffed line by line against them and only the keys whose evidence changed go back to the LLM:
+# - keys whose value came from a removed or edited line
+# - keys named in a new or edited line
+# - keys with no line backing their value (the LLM inferred it), on any change
+# - blank keys, when a line was added
+# The PDF is not rendered again: the changed values are appended to the previous one (quickfill/pdf/incremental.py).
+# Sessions live in this process' memory, a session hitting another worker starts over with a full fill.
+
+TOKEN = re.compile(r"[a-z0-9]+")
+# An edited line is at least this similar to the line it replaces, below that it is a removed and a new line
+EDIT_SIMILARITY = 0.6
+
+
+class FillSession:
+    def __init__(self, fields, blank, key_value_pairs_obj, lines, pdf, form_b=None):
+        self.fields = fields  # form b schema, key -> ""
+        self.blank = blank  # form b's own values, which a key the LLM drops goes back to
+        self.key_value_pairs_obj = key_value_pairs_obj  # Geometry and current values
+        self.lines = lines  # form a lines of the last fill
+        self.pdf = pdf  # FilledPDF of a single page form b, None for documents
+        self.form_b = form_b  # PreprocessedImage of a document form b, re-rendered in full
+
+    def values(self):
+        return {key: field.get('Value', '') for key, field in self.key_value_pairs_obj.items()}
+
+
+def split_lines(text):
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def tokens(text):
+    return set(TOKEN.findall(text.lower()))
+
+
+def diff_lines(old_lines, new_lines):
+    '''
+    Returns (indices of old lines removed or edited, new lines added or edited, whether a line is new)
+    '''
+    removed, added, new = set(), [], False
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        removed.update(range(i1, i2))
+        added.extend(new_lines[j1:j2])
+        if tag == "insert" or (tag == "replace" and (i2 - i1 < j2 - j1 or difflib.SequenceMatcher(
+                None, " ".join(old_lines[i1:i2]), " ".join(new_lines[j1:j2])).ratio() < EDIT_SIMILARITY)):
+            new = True
+    return removed, added, new
+
+
+def evidence(key, value, lines):
+    # Lines containing the value, or naming the key when there is no value
+    value_tokens = tokens(str(value)) if value else set()
+    key_tokens = {token for token in tokens(key) if len(token) > 2} or tokens(key)
+    supporting = set()
+    for i, line in enumerate(lines):
+        line_tokens = tokens(line)
+        if (value_tokens and value_tokens <= line_tokens) or (key_tokens and key_tokens <= line_tokens):
+            supporting.add(i)
+    return supporting
+
+
+def affected_keys(session: FillSession, new_lines):
+    removed, added, new = diff_lines(session.lines, new_lines)
+    if not removed and not added:
+        return []
+    added_tokens = [tokens(line) for line in added]
+    affected = []
+    for key, value in session.values().items():
+        key_tokens = {token for token in tokens(key) if len(token) > 2} or tokens(key)
+        supporting = evidence(key, value, session.lines)
+        if (supporting & removed
+                or any(key_tokens and key_tokens <= line for line in added_tokens)
+                or (value and not supporting)
+                or (new and not value)):
+            affected.append(key)
+    return affected
+
+
+class SessionStore:
+    def __init__(self, max_items=REFILL_SESSION_ITEMS, ttl=REFILL_SESSION_TTL):
+        self.ttl = ttl
+        self._sessions = LRUCache(max_items)
+        self._locks = {}  # key -> [asyncio.Lock, holders and waiters], dropped with the last of them
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key):
+        # Submissions of one session run one after the other, each one diffs against what the last one stored
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def get(self, key):
+        entry = self._sessions.get(key)
+        if entry is None:
+            return None
+        expires, session = entry
+        if expires < time.monotonic():
+            self._sessions.pop(key)
+            return None
+        return session
+
+    def set(self, key, session):
+        self._sessions.set(key, (time.monotonic() + self.ttl, session))
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+fill_sessions = SessionStore()
+
+
+def _form_b_hash(image_bytes):
+    if isinstance(image_bytes, Upload):
+        return image_bytes.hash
+    return hashlib.md5(image_bytes).hexdigest()
+
+
+async def refill_async(session_id, image_bytes, text_input, use_cache=True):
+    '''
+    process_image_and_text_async within a session. Returns (PDF file, keys sent to the LLM).
+    '''
+    key = (session_id, _form_b_hash(image_bytes))
+    lines = split_lines(text_input)
+    async with fill_sessions.lock(key):
+        session = fill_sessions.get(key)
+        if session is None:
+            session, refilled = await _first_fill(image_bytes, text_input, lines, use_cache)
+        else:
+            session, refilled = await _refill(session, text_input, lines, use_cache)
+        fill_sessions.set(key, session)
+        if session.pdf is None:
+            return await render_pdf_async(session.form_b, session.key_value_pairs_obj), refilled
+        return io.BytesIO(session.pdf.data), refilled
+
+
+async def _llm_values(text_input, fields, use_cache):
+    if not fields:
+        return {}
+    json_res = await run_in_stage(Stage.LLM, chunked_form_filling, text_input, fields, use_cache=use_cache)
+    # A single chunk's answer is the model's JSON as is, which may not be an object
+    return llm_updates(json_res, {})
+
+
+async def _first_fill(image_bytes, text_input, lines, use_cache):
+    # Same fill as process_image_and_text_async, keeping what a refill needs
+    form_b = await preprocess_async(image_bytes)
+    fields, key_value_pairs_obj = await form_b_fields_async(form_b)
+    key_value_pairs_obj = copy.deepcopy(key_value_pairs_obj)
+    blank = {key: field.get('Value', '') for key, field in key_value_pairs_obj.items()}
+    json_res = await _llm_values(text_input, fields, use_cache)
+    update_nested_dict(key_value_pairs_obj, json_res, engine=LLM_ENGINE)
+    if form_b.is_document:
+        return FillSession(fields, blank, key_value_pairs_obj, lines, None, form_b=form_b), list(fields)
+    pdf = await run_in_stage(Stage.PDF, FilledPDF.render, form_b.original, key_value_pairs_obj, form_b.page_size,
+                             form_b.orientation)
+    return FillSession(fields, blank, key_value_pairs_obj, lines, pdf), list(fields)
+
+
+async def _refill(session: FillSession, text_input, lines, use_cache):
+    affected = affected_keys(session, lines)
+    json_res = await _llm_values(text_input, {key: session.fields.get(key, '') for key in affected}, use_cache)
+    previous = session.values()
+    values = {key: json_res.get(key, session.blank.get(key, '')) for key in affected}
+    changed = {key: value for key, value in values.items() if value != previous.get(key)}
+    key_value_pairs_obj = copy.deepcopy(session.key_value_pairs_obj)
+    update_nested_dict(key_value_pairs_obj, changed, engine=LLM_ENGINE)
+    pdf = session.pdf
+    if pdf is not None and changed:
+        pdf = await run_in_stage(Stage.PDF, pdf.with_values,
+                                 {key: key_value_pairs_obj[key] for key in changed if key in key_value_pairs_obj})
+    session = FillSession(session.fields, session.blank, key_value_pairs_obj, lines, pdf, form_b=session.form_b)
+    return session, affected
@@ -0,0 +1,103 @@
+import functools
+import hashlib
+import json
+import pathlib
+import threading
+
+# Coalesce concurrent identical calls: the first caller for a key runs the function,
+# callers arriving while it is in flight wait for it and get the same result (or exception).
+# The blocking work runs on executor threads (see quickfill/executor.py), so this is thread based.
+# Results are shared between callers, treat them as read-only.
+
+_groups = {}
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.shared = 0
+        _groups[name] = self
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.shared += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def info(self):
+        return {"executed": self.executed, "shared": self.shared, "in_flight": self.in_flight()}
+
+
+def _normalize(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"md5": hashlib.md5(value).hexdigest()}
+    if isinstance(value, pathlib.PurePath):
+        return str(value)
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def make_key(*parts):
+    # Stable digest of arbitrary call inputs, bytes are hashed instead of serialized
+    data = json.dumps(_normalize(parts), sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def single_flight(group: SingleFlight):
+    # Decorator, the key is the function's qualified name plus all call arguments
+    def decorator(func):
+        prefix = f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return group.do(make_key(prefix, args, kwargs), func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Shared groups, keyed by content hash (OCR) or prompt inputs (LLM)
+ocr_flight = SingleFlight("ocr")
+llm_flight = SingleFlight("llm")
+
+
+def get_singleflight_stats():
+    return {name: group.info() for name, group in _groups.items()}
@@ -0,0 +1,152 @@
+import asyncio
+import base64
+import json
+from enum import Enum
+
+from quickfill.ai.ai_form_filling import (stream_genearl_form_filling,
+                                          update_nested_dict)
+from quickfill.ai.chunked_fill import chunk_schema, merge_chunk_results
+from quickfill.ai.key_matcher import LLM_ENGINE, fill_locally, llm_updates
+from quickfill.ai.multimodal_form_filling import stream_text_with_images_gpt4v
+from quickfill.const import LLM_CHUNK_PARALLELISM
+from quickfill.executor import Stage, iterate_in_stage
+from quickfill.pipeline import (form_a_pairs_async, form_a_text_async,
+                                form_b_fields_async, preprocess_async,
+                                render_pdf_async)
+
+# Streaming mode of the fill endpoints: per stage progress events, LLM tokens and filled fields
+# as they arrive, and finally the PDF, sent as server-sent events or NDJSON.
+#
+#   stage  {"stage": "preprocess" | "ocr" | "llm" | "pdf"}
+#   token  {"text": "..."}, plus "chunk": n when a large form b schema is filled in several chunks at once
+#   field  {"key": "...", "value": "...", "engine": "exact" | "synonym" | "fuzzy" | "llm"}
+#   result {"filename": "form_output.pdf", "pdf_base64": "..."}
+#   error  {"error": "..."}
+
+
+class StreamFormat(Enum):
+    SSE = "sse"
+    NDJSON = "ndjson"
+
+
+MEDIA_TYPES = {
+    StreamFormat.SSE: "text/event-stream",
+    StreamFormat.NDJSON: "application/x-ndjson",
+}
+
+
+def format_event(stream_format: StreamFormat, event, data):
+    if stream_format == StreamFormat.SSE:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return json.dumps({"event": event, **data}) + "\n"
+
+
+async def fill_events(form_b_bytes, form_a_text=None, form_a_bytes=None, use_gpt4v=False, use_cache=True,
+                      send_tokens=True):
+    '''
+    Async generator of (event, data) for one fill.
+    Form a is given either as text or as an image (OCR'd for text fills, sent as is for GPT-4V fills).
+    '''
+    try:
+        form_b = await preprocess_async(form_b_bytes)
+        form_a = await preprocess_async(form_a_bytes) if form_a_bytes is not None else None
+        yield "stage", {"stage": "preprocess"}
+
+        form_a_pairs = None
+        if form_a is not None and not use_gpt4v:
+            form_a_text, form_a_pairs = await asyncio.gather(form_a_text_async(form_a), form_a_pairs_async(form_a))
+        kv_pairs_result, key_value_pairs_obj = await form_b_fields_async(form_b)
+        yield "stage", {"stage": "ocr", "keys": list(kv_pairs_result)}
+
+        matches, remaining = fill_locally(form_a_pairs, kv_pairs_result, key_value_pairs_obj)
+        for key, match in matches.items():
+            yield "field", {"key": key, "value": match.value, "engine": match.engine}
+
+        if use_gpt4v:
+            llm_events = iterate_in_stage(Stage.LLM, stream_text_with_images_gpt4v, [form_a.data],
+                                          expected_keys=kv_pairs_result, use_cache=use_cache)
+        elif remaining:
+            llm_events = _chunk_events(form_a_text, chunk_schema(remaining), use_cache)
+        else:
+            llm_events = _no_events()
+        json_res = {}
+        async for kind, payload in llm_events:
+            if kind == "token":
+                if send_tokens:
+                    yield "token", payload if isinstance(payload, dict) else {"text": payload}
+            elif kind == "field":
+                key, value = payload
+                if key not in matches:
+                    yield "field", {"key": key, "value": value, "engine": LLM_ENGINE}
+            else:
+                json_res = payload
+        yield "stage", {"stage": "llm"}
+
+        update_nested_dict(key_value_pairs_obj, llm_updates(json_res, matches), engine=LLM_ENGINE)
+        pdf = await render_pdf_async(form_b, key_value_pairs_obj)
+        yield "stage", {"stage": "pdf"}
+        yield "result", {"filename": "form_output.pdf",
+                         "pdf_base64": base64.b64encode(pdf.getvalue()).decode('utf-8')}
+    except Exception as e:
+        yield "error", {"error": f"{type(e).__name__}: {e}"}
+
+
+async def _chunk_events(form_a_text, chunks, use_cache, parallelism=LLM_CHUNK_PARALLELISM):
+    '''
+    Streamed counterpart of chunked_form_filling (quickfill/ai/chunked_fill.py): every chunk of the schema is
+    its own streamed LLM call, up to parallelism at once. Yields the chunks' tokens and their own keys' fields
+    as they arrive, then ("result", merged dict). A single chunk streams exactly as the whole schema did.
+    '''
+    several = len(chunks) > 1
+    events = asyncio.Queue()
+    results = [{} for _ in chunks]
+    slots = asyncio.Semaphore(max(1, parallelism))
+
+    async def run(index, chunk):
+        error = None
+        try:
+            async with slots:
+                stream = iterate_in_stage(Stage.LLM, stream_genearl_form_filling, form_a_text, json.dumps(chunk),
+                                          use_cache=use_cache)
+                try:
+                    async for kind, payload in stream:
+                        if kind == "result":
+                            results[index] = payload if isinstance(payload, dict) else {}
+                        elif kind == "token" and several:
+                            events.put_nowait((kind, {"text": payload, "chunk": index}))
+                        elif kind == "token" or not several or payload[0] in chunk:
+                            events.put_nowait((kind, payload))
+                finally:
+                    await stream.aclose()
+        except Exception as e:
+            error = e
+        finally:
+            events.put_nowait((None, error))
+
+    tasks = [asyncio.ensure_future(run(index, chunk)) for index, chunk in enumerate(chunks)]
+    try:
+        running = len(tasks)
+        while running:
+            kind, payload = await events.get()
+            if kind is not None:
+                yield kind, payload
+                continue
+            running -= 1
+            if payload is not None:
+                raise payload
+    finally:
+        # The client went away or a chunk failed, don't keep paying for the others
+        for task in tasks:
+            task.cancel()
+    yield "result", results[0] if not several else merge_chunk_results(chunks, results)
+
+
+async def _no_events():
+    # Every field was filled locally
+    return
+    yield
+
+
+async def encode_events(events, stream_format: StreamFormat):
+    async for event, data in events:
+        yield format_event(stream_format, event, data)
@@ -0,0 +1,312 @@
+import bisect
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from quickfill.const import TELEMETRY_ENABLED, generate_random_id
+
+# Request tracing and Prometheus metrics.
+# Every request gets a trace id (X-Trace-Id response header, or the caller's X-Request-ID) and
+# a list of spans: upload read, pipeline stages (ocr, llm, image, pdf), cache lookups, ...
+# Spans feed the latency histograms, and the finished trace is logged as one JSON line
+# on the "quickfill.trace" logger. /metrics renders the registry in the Prometheus text format.
+# With QUICKFILL_TELEMETRY=0, span() hands out a shared no-op and nothing is recorded.
+
+logger = logging.getLogger("quickfill.trace")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_text(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, *label_values, value):
+        # Counters too, for counts kept elsewhere and read at scrape time
+        with self._lock:
+            self._values[label_values] = value
+
+    def _samples(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        for label_values, value in self._samples():
+            lines.append(f"{self.name}{_labels_text(self.labels, label_values)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, *label_values, n=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + n
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def inc(self, *label_values, n=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + n
+
+    def dec(self, *label_values, n=1):
+        self.inc(*label_values, n=-n)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *label_values, value):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # Per bucket counts (last one is +Inf), then sum
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def _samples(self):
+        with self._lock:
+            return sorted((label_values, list(counts)) for label_values, counts in self._values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        for label_values, counts in self._samples():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _labels_text(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels_text(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {counts[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []  # Called at scrape time, for stats kept elsewhere (caches, Textract client)
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for collect in self.collectors:
+            collect()
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+span_seconds = registry.add(Histogram("quickfill_span_seconds", "Duration of traced spans.", ["span"]))
+stage_in_flight = registry.add(Gauge("quickfill_stage_in_flight", "Calls running on each stage's pool.", ["stage"]))
+request_seconds = registry.add(Histogram("quickfill_request_seconds", "HTTP request latency.", ["route", "status"]))
+requests_in_flight = registry.add(Gauge("quickfill_requests_in_flight", "HTTP requests being served."))
+llm_tokens = registry.add(Counter("quickfill_llm_tokens_total", "LLM tokens used.", ["model", "kind"]))
+cache_lookups = registry.add(Counter("quickfill_cache_lookups_total", "Cache lookups.", ["cache", "result"]))
+cache_hit_ratio = registry.add(Gauge("quickfill_cache_hit_ratio", "Cache hit ratio since start.", ["cache"]))
+textract_calls = registry.add(Counter("quickfill_textract_calls_total", "Textract API calls.", ["result"]))
+textract_queue = registry.add(Gauge("quickfill_textract_calls_in_flight", "Textract calls in flight or waiting.",
+                                    ["state"]))
+ocr_routes = registry.add(Counter("quickfill_ocr_routes_total", "Images kept from local OCR or sent to the fallback.",
+                                  ["route"]))
+
+
+def _collect_caches():
+    from quickfill.cache import get_cache_stats
+
+    for name, stats in get_cache_stats().items():
+        for result in ("memory_hits", "disk_hits", "misses", "shared_hits"):
+            cache_lookups.set(name, result, value=stats[result])
+        cache_hit_ratio.set(name, value=stats["hit_ratio"])
+
+
+def _collect_textract():
+    from quickfill.ocr import textract_client
+
+    if textract_client._client is None:
+        return  # Not used yet, don't create it for a scrape
+    info = textract_client._client.metrics.info()
+    for result in ("requests", "retries", "throttled", "errors"):
+        textract_calls.set(result, value=info[result])
+    for state in ("waiting", "in_flight"):
+        textract_queue.set(state, value=info[state])
+
+
+registry.collectors += [_collect_caches, _collect_textract]
+
+
+class Trace:
+    def __init__(self, trace_id, name):
+        self.id = trace_id
+        self.name = name
+        self.start = time.perf_counter()
+        self.spans = []  # Appended from executor threads too, list.append is atomic
+
+    def as_dict(self, status=None):
+        return {"trace_id": self.id, "name": self.name, "status": status,
+                "ms": round((time.perf_counter() - self.start) * 1000, 3), "spans": self.spans}
+
+
+_current_trace = contextvars.ContextVar("quickfill_trace", default=None)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        seconds = time.perf_counter() - self.start
+        span_seconds.observe(self.name, value=seconds)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans.append({"name": self.name, "start_ms": round((self.start - trace.start) * 1000, 3),
+                                "ms": round(seconds * 1000, 3), "ok": error_type is None})
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name):
+    # with span("ocr"): ... records the block's duration in the current trace and the span histogram
+    if not TELEMETRY_ENABLED:
+        return _NOOP_SPAN
+    return _Span(name)
+
+
+def traced(name):
+    # Decorator version of span()
+    def decorator(func):
+        if not TELEMETRY_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def stage_call(stage_name):
+    # Span plus in-flight gauge around one call on a stage's pool
+    if not TELEMETRY_ENABLED:
+        yield
+        return
+    stage_in_flight.inc(stage_name)
+    try:
+        with _Span(stage_name):
+            yield
+    finally:
+        stage_in_flight.dec(stage_name)
+
+
+def record_llm_tokens(model, prompt_tokens=0, completion_tokens=0):
+    if not TELEMETRY_ENABLED:
+        return
+    if prompt_tokens:
+        llm_tokens.inc(model, "prompt", n=prompt_tokens)
+    if completion_tokens:
+        llm_tokens.inc(model, "completion", n=completion_tokens)
+
+
+def record_ocr_route(route):
+    if TELEMETRY_ENABLED:
+        ocr_routes.inc(route)
+
+
+class TraceMiddleware:
+    '''
+    ASGI middleware: one trace per HTTP request, request latency and in-flight metrics.
+    The trace ends when the response body is fully sent, streamed responses included.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TELEMETRY_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        trace_id = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or generate_random_id()
+        trace = Trace(trace_id, f"{scope['method']} {scope['path']}")
+        token = _current_trace.set(trace)
+        status = 500
+
+        async def send_with_trace_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": list(message.get("headers", [])) + [
+                    (b"x-trace-id", trace_id.encode("latin-1"))]}
+            await send(message)
+
+        requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            requests_in_flight.dec()
+            _current_trace.reset(token)
+            # Matched route template, not the raw path, to keep the label set bounded
+            route = getattr(scope.get("route"), "path", None) or "other"
+            request_seconds.observe(route, status, value=time.perf_counter() - trace.start)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(json.dumps(trace.as_dict(status)))
+
+
+def render_metrics():
+    return registry.render()
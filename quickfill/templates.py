@@ -0,0 +1,172 @@
+import copy
+import os
+import tempfile
+import threading
+import time
+
+from PIL import Image
+from quickfill.cache import DiskCache, json_dumps, json_loads
+from quickfill.const import (TEMPLATE_MATCH_MAX_DISTANCE, TEMPLATES_PATH,
+                             generate_random_id)
+from quickfill.upload import open_buffer
+
+# Registry of known blank form b's. A template stores the form's keys and value bounding boxes
+# (what Textract's key value pairs would give) with a perceptual hash of the page.
+# Rescans of a registered form match its template by hash distance, and the stored geometry
+# is used instead of calling OCR.
+# Every API process keeps the templates in memory. A change (register, delete) rewrites the GENERATION
+# file of the templates directory, and the other processes reload when they see a new generation.
+
+HASH_SIZE = 16  # 16x16 difference hash, 256 bits
+MAX_ASPECT_DIFFERENCE = 0.03
+GENERATION_NAME = "GENERATION"
+
+
+def difference_hash(image_bytes, hash_size=HASH_SIZE):
+    '''
+    dHash of the page: brightness gradients of a tiny grayscale thumbnail,
+    stable across rescans, JPEG quality and small shifts in exposure.
+    Returns (hash as int, (width, height)).
+    '''
+    with Image.open(open_buffer(image_bytes)) as image:
+        size = image.size
+        image.draft("L", (hash_size * 8, hash_size * 8))  # JPEGs are decoded at reduced scale
+        pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.BOX).getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value, size
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class FormTemplate:
+    def __init__(self, template_id, name, phash, size, key_value_pairs, key_value_pairs_obj, created=None):
+        self.id = template_id
+        self.name = name
+        self.phash = phash
+        self.size = tuple(size)
+        self.key_value_pairs = key_value_pairs
+        self.key_value_pairs_obj = key_value_pairs_obj
+        self.created = created or time.time()
+
+    def fields(self):
+        # Fresh copies, fills write their values into key_value_pairs_obj
+        return copy.deepcopy(self.key_value_pairs), copy.deepcopy(self.key_value_pairs_obj)
+
+    def info(self):
+        return {"id": self.id, "name": self.name, "keys": list(self.key_value_pairs), "created": self.created}
+
+    def to_dict(self):
+        return {"id": self.id, "name": self.name, "phash": f"{self.phash:x}", "size": list(self.size),
+                "key_value_pairs": self.key_value_pairs, "key_value_pairs_obj": self.key_value_pairs_obj,
+                "created": self.created}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["id"], data["name"], int(data["phash"], 16), data["size"], data["key_value_pairs"],
+                   data["key_value_pairs_obj"], data["created"])
+
+
+class TemplateRegistry:
+    def __init__(self, directory, max_distance=TEMPLATE_MATCH_MAX_DISTANCE):
+        self.store = DiskCache(directory, dumps=lambda template: json_dumps(template.to_dict()),
+                               loads=lambda data: FormTemplate.from_dict(json_loads(data)))
+        self.max_distance = max_distance
+        self.hits = 0
+        self.misses = 0
+        self._templates = None  # Loaded from disk on first use, and again when the generation changes
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def _read_generation(self):
+        try:
+            return (self.store.directory / GENERATION_NAME).read_text()
+        except FileNotFoundError:
+            return None
+
+    def _bump_generation(self):
+        # A new random id, atomically replaced, so concurrent changes never read as the same generation
+        self.store.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.store.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(generate_random_id())
+            os.replace(tmp_path, self.store.directory / GENERATION_NAME)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _all(self):
+        # Read before loading: a change made while loading is picked up by the next call
+        generation = self._read_generation()
+        with self._lock:
+            if self._templates is None or generation != self._generation:
+                templates = {}
+                if self.store.directory.is_dir():
+                    for path in self.store.directory.glob(f"*{self.store.suffix}"):
+                        if path.name.startswith(".tmp-"):
+                            continue
+                        template = self.store.get(path.stem)
+                        if template is not None:
+                            templates[template.id] = template
+                self._templates = templates
+                self._generation = generation
+            return list(self._templates.values())
+
+    def register(self, name, image_bytes, key_value_pairs, key_value_pairs_obj) -> FormTemplate:
+        phash, size = difference_hash(image_bytes)
+        return self.register_hash(name, phash, size, key_value_pairs, key_value_pairs_obj)
+
+    def register_hash(self, name, phash, size, key_value_pairs, key_value_pairs_obj) -> FormTemplate:
+        key_value_pairs_obj = {key: {**value, "Value": ""} for key, value in key_value_pairs_obj.items()}
+        template = FormTemplate(generate_random_id(), name, phash, size, key_value_pairs, key_value_pairs_obj)
+        self.store.set(template.id, template)
+        self._bump_generation()
+        return template
+
+    def get(self, template_id):
+        return next((template for template in self._all() if template.id == template_id), None)
+
+    def list(self):
+        return sorted(self._all(), key=lambda template: template.created)
+
+    def delete(self, template_id):
+        if self.get(template_id) is None:
+            return False
+        self.store.delete(template_id)
+        self._bump_generation()
+        return True
+
+    def match(self, image_bytes):
+        return self.match_hash(*difference_hash(image_bytes))
+
+    def match_hash(self, phash, size):
+        # Nearest template within max_distance with the same page proportions, or None
+        width, height = size
+        best, best_distance = None, self.max_distance + 1
+        for template in self._all():
+            template_width, template_height = template.size
+            if abs(width / height - template_width / template_height) > MAX_ASPECT_DIFFERENCE * width / height:
+                continue
+            distance = hamming_distance(phash, template.phash)
+            if distance < best_distance:
+                best, best_distance = template, distance
+        with self._lock:
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return best
+
+    def info(self):
+        return {"templates": len(self._all()), "hits": self.hits, "misses": self.misses,
+                "max_distance": self.max_distance}
+
+
+template_registry = TemplateRegistry(TEMPLATES_PATH)
+
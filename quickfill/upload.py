@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import io
+import json
+import mmap
+import tempfile
+
+from quickfill.const import (UPLOAD_MAX_BYTES, UPLOAD_MAX_REQUEST_BYTES,
+                             UPLOAD_SPOOL_BYTES)
+from quickfill.telemetry import span
+
+# Upload ingestion. Uploads are hashed once (the md5 the preprocess, OCR and fill caches key on), kept in memory
+# up to UPLOAD_SPOOL_BYTES and memory mapped from a temporary file above. Starlette has already spooled an
+# UploadFile's body to UploadFile.file, that file is mapped and hashed in place instead of being copied.
+# Other readers are read in chunks, hashed on the way and spooled to a temporary file of our own.
+# Later stages get the bytes or a read-only memoryview of the mapping, never another full copy:
+# open_buffer() gives PIL / PyPDF2 a file over either one without copying it like io.BytesIO does.
+# UploadLimitMiddleware rejects request bodies over UPLOAD_MAX_REQUEST_BYTES before they are parsed.
+
+UPLOAD_CHUNK_BYTES = 256 * 1024
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, filename, max_bytes):
+        super().__init__(f"{filename or 'Upload'} is larger than {max_bytes} bytes")
+        self.filename = filename
+        self.max_bytes = max_bytes
+
+
+class Upload:
+    def __init__(self, data, hash, filename=None, content_type=None):
+        # bytes, or a read-only memoryview of a spooled upload. The mapping is released with the last view,
+        # a passthrough PreprocessedImage in the preprocess cache keeps it alive until evicted.
+        self.data = data
+        self.hash = hash  # md5 hex digest of data
+        self.filename = filename
+        self.content_type = content_type
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    @property
+    def spooled(self):
+        return isinstance(self.data, memoryview)
+
+
+def _map_spool(spool):
+    spool.flush()
+    mapping = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+    # The mapping outlives the file, which is deleted on close
+    spool.close()
+    return memoryview(mapping)
+
+
+def _read_spooled(spooled, filename, max_bytes, spool_bytes):
+    spooled.seek(0, io.SEEK_END)
+    size = spooled.tell()
+    if 0 < max_bytes < size:
+        raise UploadTooLarge(filename, max_bytes)
+    spooled.seek(0)
+    if size <= spool_bytes:
+        data = spooled.read()
+        return data, hashlib.md5(data).hexdigest()
+    # Rolls a body Starlette kept in memory over to its temporary file, once, the mapping outlives the file
+    fileno = spooled.fileno()
+    spooled.flush()
+    data = memoryview(mmap.mmap(fileno, 0, access=mmap.ACCESS_READ))
+    digest = hashlib.md5()
+    for start in range(0, size, UPLOAD_CHUNK_BYTES):
+        digest.update(data[start:start + UPLOAD_CHUNK_BYTES])
+    return data, digest.hexdigest()
+
+
+async def read_upload(file, max_bytes=UPLOAD_MAX_BYTES, spool_bytes=UPLOAD_SPOOL_BYTES) -> Upload:
+    '''
+    Reads an UploadFile from its spooled file, or any object with an async read(size) in chunks.
+    Raises UploadTooLarge when it is over max_bytes (0 disables the limit).
+    '''
+    filename = getattr(file, "filename", None)
+    spooled = getattr(file, "file", None)
+    if spooled is not None:
+        with span("upload_read"):
+            data, hash = await asyncio.to_thread(_read_spooled, spooled, filename, max_bytes, spool_bytes)
+        return Upload(data, hash, filename, getattr(file, "content_type", None))
+
+    digest = hashlib.md5()
+    chunks, size, spool = [], 0, None
+    try:
+        with span("upload_read"):
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if 0 < max_bytes < size:
+                    raise UploadTooLarge(filename, max_bytes)
+                digest.update(chunk)
+                if spool is None and size > spool_bytes:
+                    spool = tempfile.TemporaryFile(prefix="quickfill-upload-")
+                    for buffered in chunks:
+                        spool.write(buffered)
+                    chunks = []
+                if spool is None:
+                    chunks.append(chunk)
+                else:
+                    await asyncio.to_thread(spool.write, chunk)
+            data = b"".join(chunks) if spool is None else await asyncio.to_thread(_map_spool, spool)
+    except BaseException:
+        if spool is not None:
+            spool.close()
+        raise
+    return Upload(data, digest.hexdigest(), filename, getattr(file, "content_type", None))
+
+
+class BufferReader(io.RawIOBase):
+    # Seekable read-only file over a bytes-like object, without the copy io.BytesIO makes of a memoryview
+    def __init__(self, data):
+        self._view = memoryview(data).cast("B")
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        start = min(self._position, len(self._view))
+        count = min(len(buffer), len(self._view) - start)
+        buffer[:count] = self._view[start:start + count]
+        self._position = start + count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+
+def open_buffer(data):
+    # io.BytesIO shares a bytes object's buffer, anything else is read in place
+    if isinstance(data, bytes):
+        return io.BytesIO(data)
+    return io.BufferedReader(BufferReader(data))
+
+
+class UploadLimitMiddleware:
+    # Pure ASGI, a 413 is sent on the Content-Length header alone, or as soon as the body goes over the limit
+    def __init__(self, app, max_bytes=UPLOAD_MAX_REQUEST_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": f"Request body is larger than {self.max_bytes} bytes"}).encode()
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.max_bytes <= 0:
+            return await self.app(scope, receive, send)
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            return await self._reject(send)
+
+        received, rejected, started = 0, False, False
+
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # Starlette stops parsing on a disconnect
+                    rejected = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            nonlocal started
+            if rejected and not started:
+                # The app's error for the cut off body is replaced by the 413
+                return
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not rejected:
+                raise
+        if rejected and not started:
+            await self._reject(send)
@@ -1,47 +1,88 @@
-# TODO Make this script work
+import json
+import pathlib
+
+import pytest
+from quickfill.ai import fill_cache, form_filling
+from quickfill.ai.form_filling import ai_form_filling
+from quickfill.cache import TieredCache
+from quickfill.ocr import aws_text_extract
 from quickfill.ocr.aws_text_extract import quick_analyze_document
 
+# Recorded Textract response of a driver license and the extraction the LLM gave for it
+FIXTURES_PATH = pathlib.Path(__file__).parent.parent / "benchmarks" / "fixtures"
+
+# Define the target schema
+TARGET_SCHEMA = {
+    "properties": {
+        "license_type": {"type": "string"},
+        "state": {"type": "string"},
+        "license_number": {"type": "string"},
+        "class": {"type": "string"},
+        "dob": {"type": "string"},
+        "exp_date": {"type": "string"},
+        "first_name": {"type": "string"},
+        "last_name": {"type": "string"},
+        "address": {"type": "string"},
+        "city": {"type": "string"},
+        "state_address": {"type": "string"},
+        "zip": {"type": "string"},
+        "endorsements": {"type": "string"},
+        "restrictions": {"type": "string"},
+        "issue_date": {"type": "string"},
+        "sex": {"type": "string"},
+        "height": {"type": "string"},
+        "eye_color": {"type": "string"},
+        "weight": {"type": "string"},
+        "hair_color": {"type": "string"}
+    },
+    "required": ["license_type", "state", "license_number", "first_name", "last_name"]
+}
+
+
+def load_fixture(name):
+    with open(FIXTURES_PATH / name) as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    # Stand-ins for Textract and the extraction chain, the LLM answers from the recorded completion
+    schemas = []
+    extraction = load_fixture("llm_completions.json")["extraction"]
+
+    def ai_form_filling_stub(context_str, schema):
+        assert "JOBS, STEVEN PAUL" in context_str
+        schemas.append(schema)
+        return {key: extraction[key] for key in schema["properties"] if key in extraction}
+
+    monkeypatch.setattr(aws_text_extract, "textract_analyze_document",
+                        lambda image_bytes: load_fixture("textract_form_a.json"))
+    monkeypatch.setattr(aws_text_extract, "ocr_cache", TieredCache("ocr_form_filling_test", memory_items=4))
+    monkeypatch.setattr(fill_cache, "fill_cache", TieredCache("llm_fill_form_filling_test", memory_items=4))
+    monkeypatch.setattr(form_filling, "_ai_form_filling", ai_form_filling_stub)
+    return schemas
+
 
-def test_ocr_and_form_filling():
-    
-    res = quick_analyze_document("./data/driver_license/US/Alabama's.jpg")
-    print(res)
-
-    # Define the target schema
-    target_schema = {
-        "properties": {
-            "license_type": {"type": "string"},
-            "state": {"type": "string"},
-            "license_number": {"type": "string"},
-            "class": {"type": "string"},
-            "dob": {"type": "string"},
-            "exp_date": {"type": "string"},
-            "first_name": {"type": "string"},
-            "last_name": {"type": "string"},
-            "address": {"type": "string"},
-            "city": {"type": "string"},
-            "state_address": {"type": "string"},
-            "zip": {"type": "string"},
-            "endorsements": {"type": "string"},
-            "restrictions": {"type": "string"},
-            "issue_date": {"type": "string"},
-            "sex": {"type": "string"},
-            "height": {"type": "string"},
-            "eye_color": {"type": "string"},
-            "weight": {"type": "string"},
-            "hair_color": {"type": "string"}
-        },
-        "required": ["license_type", "state", "license_number", "first_name", "last_name"]
-    }
+def test_ocr_and_form_filling(offline, tmp_path):
+    image_path = tmp_path / "license.jpg"
+    image_path.write_bytes(b"not decoded, only hashed")
+    ocr_result_text = quick_analyze_document(str(image_path))
+    assert ocr_result_text.startswith("NAME:\nJOBS, STEVEN PAUL\n")
 
     # Call the ai_form_filling function with auto set to False (since we have a defined schema)
-    output = ai_form_filling(ocr_result_text, target_schema)
+    output = ai_form_filling(ocr_result_text, TARGET_SCHEMA, auto=False, use_cache=False)
+    assert output["first_name"] == "Steven"
+    assert output["license_number"] == "D1234567"
+    assert "license_type" not in output
 
-    # Print the output
-    print(json.dumps(output, indent=4))
+    # One chunk per call, each keeps only its own required keys
+    assert sorted(key for schema in offline for key in schema["properties"]) == sorted(TARGET_SCHEMA["properties"])
+    for schema in offline:
+        assert set(schema["required"]) <= set(schema["properties"])
 
 
-# Run the test
-if __name__ == "__main__":
-    # test_ai_form_filling()
-    test_ocr_and_form_filling()
+def test_auto_schema_flattens_nested_keys(offline):
+    target = {"driver": {"first_name": "", "last_name": ""}, "license": {"number": ""}}
+    ai_form_filling("NAME:\nJOBS, STEVEN PAUL\n", target, use_cache=False)
+    assert list(offline[0]["properties"]) == ["driver$$first_name", "driver$$last_name", "license$$number"]
+    assert offline[0]["required"] == []
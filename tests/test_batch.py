@@ -0,0 +1,77 @@
+import asyncio
+import io
+import json
+import zipfile
+
+import pytest
+from quickfill import batch
+from quickfill.preprocess import PreprocessedImage
+
+
+@pytest.fixture(autouse=True)
+def fake_pipeline(monkeypatch):
+    calls = {"form_a_ocr": 0, "running": 0, "peak": 0}
+
+    async def preprocess_async(image_bytes):
+        return PreprocessedImage(image_bytes, "image/png", (10, 10), "hash", (10, 10))
+
+    async def form_a_text_async(form_a):
+        calls["form_a_ocr"] += 1
+        return form_a.data.decode()
+
+    async def form_a_pairs_async(form_a):
+        return {"Name": form_a.data.decode()}
+
+    async def fill_form_b_with_text_async(form_b, text_input, use_cache=True, form_a_pairs=None):
+        assert form_a_pairs["Name"] == text_input.split("\n")[0]
+        calls["running"] += 1
+        calls["peak"] = max(calls["peak"], calls["running"])
+        await asyncio.sleep(0.01 * len(form_b.data))
+        calls["running"] -= 1
+        if form_b.data == b"broken":
+            raise ValueError("no key value pairs")
+        return io.BytesIO(f"{text_input}->{form_b.data.decode()}".encode())
+
+    monkeypatch.setattr(batch, "preprocess_async", preprocess_async)
+    monkeypatch.setattr(batch, "form_a_text_async", form_a_text_async)
+    monkeypatch.setattr(batch, "form_a_pairs_async", form_a_pairs_async)
+    monkeypatch.setattr(batch, "fill_form_b_with_text_async", fill_form_b_with_text_async)
+    return calls
+
+
+async def _collect(stream):
+    return [chunk async for chunk in stream]
+
+
+FORM_B_FILES = [("long.png", b"xxxxxxxxxx"), ("broken.png", b"broken"), ("short.png", b"x")]
+
+
+def test_batch_streams_in_completion_order_and_isolates_failures(fake_pipeline):
+    items = asyncio.run(_collect(batch.batch_fill([b"Bob", b"Smith"], FORM_B_FILES, concurrency=2)))
+    # short.png only starts once broken.png frees a slot, long.png is still running
+    assert [item.filename for item in items] == ["broken.png", "short.png", "long.png"]
+    assert items[0].error == "ValueError: no key value pairs"
+    assert items[1].pdf.getvalue() == b"Bob\nSmith->x"
+    assert fake_pipeline["form_a_ocr"] == 2
+    assert fake_pipeline["peak"] == 2
+
+
+def test_zip_output_contains_pdfs_and_manifest():
+    chunks = asyncio.run(_collect(batch.stream_zip(batch.batch_fill([b"Bob"], FORM_B_FILES))))
+    archive = zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+    assert sorted(archive.namelist()) == ["000_long.pdf", "002_short.pdf", "manifest.json"]
+    manifest = json.loads(archive.read("manifest.json"))
+    assert [entry["status"] for entry in manifest] == ["ok", "error", "ok"]
+
+
+def test_output_names_stay_inside_the_archive():
+    names = ["../../x.jpg", "a/b.jpg", "..\\..\\evil.png", "..", None]
+    assert [batch.output_name(batch.BatchItem(i, name)) for i, name in enumerate(names)] == [
+        "000_x.pdf", "001_b.pdf", "002_evil.pdf", "003_form.pdf", "004_form.pdf"]
+
+
+def test_ndjson_output():
+    lines = asyncio.run(_collect(batch.stream_ndjson(batch.batch_fill([b"Bob"], FORM_B_FILES))))
+    entries = [json.loads(line) for line in lines]
+    assert len(entries) == 3
+    assert all("pdf_base64" in entry for entry in entries if entry["status"] == "ok")
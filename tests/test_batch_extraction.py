@@ -0,0 +1,151 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from quickfill.ai import batch_extraction
+from quickfill.ai import fill_cache as fill_cache_module
+from quickfill.ai.batch_extraction import (ai_form_filling_batch,
+                                           pack_contexts, unpack_entities)
+from quickfill.cache import DiskCache, TieredCache
+from quickfill.const import STAGE_CONCURRENCY
+from quickfill.executor import Stage, run_in_stage
+
+TARGET = {"Name": "", "City": ""}
+
+
+@pytest.fixture(autouse=True)
+def temp_fill_cache(tmp_path, monkeypatch):
+    cache = TieredCache("test-llm-fill", memory_items=16, disk=DiskCache(tmp_path))
+    monkeypatch.setattr(fill_cache_module, "fill_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def model(monkeypatch):
+    # Answers every "### Document <n>" section with the section's first line, Name only
+    state = {"compiled": 0, "requests": [], "fail": None}
+    lock = threading.Lock()
+
+    def compile_extraction(schema):
+        state["compiled"] += 1
+        assert "document_number" in schema["required"]
+
+        def extract(text):
+            sections = text.split("### Document ")[1:]
+            with lock:
+                state["requests"].append(len(sections))
+            if state["fail"] and state["fail"] in text:
+                raise RuntimeError("context length exceeded")
+            entities = []
+            for section in sections:
+                number, context = section.split("\n", 1)
+                entities.append({"document_number": number, "Name": context.split("\n")[0].strip()})
+            return entities
+
+        return extract
+
+    monkeypatch.setattr(batch_extraction, "_compile_extraction", compile_extraction)
+    return state
+
+
+def test_contexts_are_packed_in_order_under_the_budgets():
+    contexts = ["x" * 40] * 5  # 10 tokens each
+    assert pack_contexts(contexts, schema_tokens=5, max_tokens=30, max_documents=0) == [[0, 1], [2, 3], [4]]
+    assert pack_contexts(contexts, max_tokens=0, max_documents=2) == [[0, 1], [2, 3], [4]]
+    # A context over the budget on its own still gets a batch
+    assert pack_contexts(["x" * 400, "y"], max_tokens=30) == [[0], [1]]
+
+
+def test_entities_map_back_to_their_documents():
+    entities = [{"document_number": 1, "Name": "Bob", "City": ""}, {"document_number": "1", "City": "Cupertino"},
+                {"document_number": 7, "Name": "Nobody"}, {"Name": "Unnumbered"}]
+    assert unpack_entities(entities, 3) == [{}, {"Name": "Bob", "City": "Cupertino"}, {}]
+
+
+def test_batches_share_one_chain_and_keep_input_order(model):
+    contexts = [f"Person {i}\nlives somewhere" for i in range(5)]
+    items = ai_form_filling_batch(contexts, TARGET, max_tokens=0, max_documents=2, parallelism=2)
+    assert [item.index for item in items] == [0, 1, 2, 3, 4]
+    assert [item.result for item in items] == [{"Name": f"Person {i}"} for i in range(5)]
+    assert model["compiled"] == 1
+    assert sorted(model["requests"]) == [1, 2, 2]
+
+    # Cached per context: only the new one goes to the model
+    items = ai_form_filling_batch(contexts + ["Person 5"], TARGET, max_tokens=0, max_documents=2)
+    assert items[5].result == {"Name": "Person 5"}
+    assert sorted(model["requests"]) == [1, 1, 2, 2]
+
+
+def test_failed_batches_fall_back_to_single_documents(model, monkeypatch):
+    model["fail"] = "Person 1"
+    fallback = []
+
+    def ai_form_filling(context_str, target_json, auto=True, use_cache=True):
+        fallback.append(context_str)
+        if "Person 1" in context_str:
+            raise ValueError("bad document")
+        return {"Name": "single"}
+
+    monkeypatch.setattr(batch_extraction, "ai_form_filling", ai_form_filling)
+    items = ai_form_filling_batch(["Person 0", "Person 1", "Person 2"], TARGET, max_tokens=0, max_documents=2)
+    assert fallback == ["Person 0", "Person 1"]
+    assert [item.to_dict() for item in items] == [
+        {"index": 0, "result": {"Name": "single"}},
+        {"index": 1, "result": None, "error": "ValueError: bad document"},
+        {"index": 2, "result": {"Name": "Person 2"}},
+    ]
+
+
+def test_batches_share_the_llm_stage_limit(monkeypatch):
+    limit = STAGE_CONCURRENCY[Stage.LLM.value]
+    lock = threading.Lock()
+    state = {"running": 0, "peak": 0}
+
+    def compile_extraction(schema):
+        def extract(text):
+            with lock:
+                state["running"] += 1
+                state["peak"] = max(state["peak"], state["running"])
+            time.sleep(0.02)
+            with lock:
+                state["running"] -= 1
+            return [{"document_number": "0", "Name": text.rsplit("\n", 1)[1]}]
+
+        return extract
+
+    monkeypatch.setattr(batch_extraction, "_compile_extraction", compile_extraction)
+    contexts = [f"Person {i}" for i in range(limit * 2)]
+
+    async def main():
+        return await run_in_stage(Stage.LLM, ai_form_filling_batch, contexts, TARGET, use_cache=False,
+                                  max_tokens=0, max_documents=1, parallelism=limit * 2)
+
+    items = asyncio.run(main())
+    assert [item.result for item in items] == [{"Name": context} for context in contexts]
+    assert 1 < state["peak"] <= limit
+
+
+def test_skipped_documents_fall_back_to_single_documents(monkeypatch, temp_fill_cache):
+    def compile_extraction(schema):
+        # Only answers the document "Person 0"
+        def extract(text):
+            return [{"document_number": section.split("\n", 1)[0], "Name": "Person 0"}
+                    for section in text.split("### Document ")[1:] if section.strip().endswith("Person 0")]
+
+        return extract
+
+    fallback = []
+
+    def ai_form_filling(context_str, target_json, auto=True, use_cache=True):
+        fallback.append(context_str)
+        return {"Name": "single"} if context_str == "Person 1" else {}
+
+    monkeypatch.setattr(batch_extraction, "_compile_extraction", compile_extraction)
+    monkeypatch.setattr(batch_extraction, "ai_form_filling", ai_form_filling)
+    items = ai_form_filling_batch(["Person 0", "Person 1", "Person 2"], TARGET, max_tokens=0, max_documents=3)
+    assert fallback == ["Person 1", "Person 2"]
+    assert [item.result for item in items] == [{"Name": "Person 0"}, {"Name": "single"}, {}]
+    # Nothing empty is cached, the next batch asks again for the document nobody could fill
+    ai_form_filling_batch(["Person 0", "Person 1", "Person 2"], TARGET, max_tokens=0, max_documents=3)
+    assert fallback == ["Person 1", "Person 2", "Person 2"]
@@ -0,0 +1,170 @@
+import multiprocessing
+import os
+import pathlib
+import time
+
+from quickfill.cache import (DiskCache, LRUCache, SharedDiskCache, TieredCache,
+                             get_cache_stats, register_cache)
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats.as_dict()["memory_evictions"] == 1
+
+
+def test_memory_tier_expires_with_the_disk_ttl(tmp_path, monkeypatch):
+    cache = TieredCache("test-ttl", memory_items=4, disk=DiskCache(tmp_path, ttl=10))
+    cache.set("k", [1])
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 60)
+    old = time.time() - 60
+    os.utime(cache.disk.path_for("k"), (old, old))
+    assert cache.get("k") is None
+    assert cache.stats.as_dict()["expired"] == 2
+
+
+def test_values_promoted_from_disk_expire_with_their_disk_copy(tmp_path, monkeypatch):
+    cache = TieredCache("test-promoted-ttl", memory_items=4, disk=DiskCache(tmp_path, ttl=10))
+    cache.disk.set("k", [1])
+    old = time.time() - 9
+    os.utime(cache.disk.path_for("k"), (old, old))
+    assert cache.get("k") == [1]
+    now, wall = time.monotonic(), time.time()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 8)
+    monkeypatch.setattr(time, "time", lambda: wall + 8)
+    assert cache.disk.get("k") is None
+    assert cache.get("k") is None
+
+
+def test_disk_cache_roundtrip_leaves_no_temp_files(tmp_path):
+    cache = DiskCache(tmp_path)
+    cache.set("k", {"Blocks": [{"Id": "1"}]})
+    assert cache.get("k") == {"Blocks": [{"Id": "1"}]}
+    assert os.listdir(tmp_path) == ["k.json"]
+
+
+def test_disk_cache_ttl(tmp_path):
+    cache = DiskCache(tmp_path, ttl=10)
+    cache.set("k", [1])
+    old = time.time() - 60
+    os.utime(cache.path_for("k"), (old, old))
+    assert cache.get("k") is None
+    assert not cache.path_for("k").exists()
+    assert cache.stats.as_dict()["expired"] == 1
+
+
+def test_disk_cache_size_eviction_drops_oldest(tmp_path):
+    cache = DiskCache(tmp_path, max_bytes=250)
+    for i in range(5):
+        cache.set(f"k{i}", "x" * 50)
+        mtime = time.time() - 100 + i
+        os.utime(cache.path_for(f"k{i}"), (mtime, mtime))
+    cache.set("k5", "x" * 50)
+    assert cache.size_bytes() <= 250
+    assert cache.get("k0") is None
+    assert cache.get("k5") == "x" * 50
+    assert cache.stats.as_dict()["disk_evictions"] >= 1
+
+
+def test_disk_cache_overwrite_replaces_size(tmp_path):
+    cache = DiskCache(tmp_path, max_bytes=250)
+    cache.set("k", "x" * 50)
+    for _ in range(10):
+        cache.set("k", "x" * 100)
+    assert cache.size_bytes() == 102
+    assert cache.stats.as_dict()["disk_evictions"] == 0
+
+
+def test_tiered_cache_promotes_disk_hits(tmp_path):
+    cache = TieredCache("test-tiered", memory_items=4, disk=DiskCache(tmp_path))
+    assert "test-tiered" not in get_cache_stats()
+    register_cache(cache)
+    assert cache.get("k") is None
+    cache.set("k", {"a": 1})
+    cache.memory.clear()
+    assert cache.get("k") == {"a": 1}
+    assert cache.get("k") == {"a": 1}
+    stats = get_cache_stats()["test-tiered"]
+    assert (stats["misses"], stats["disk_hits"], stats["memory_hits"]) == (1, 1, 1)
+
+
+def test_shared_disk_cache_keeps_one_budget(tmp_path):
+    assert SharedDiskCache(tmp_path / "unused").size_bytes() == 0
+    assert not (tmp_path / "unused").exists()
+    DiskCache(tmp_path).set("old", "x" * 50)  # Written before the index existed
+    first, second = SharedDiskCache(tmp_path, max_bytes=250), SharedDiskCache(tmp_path, max_bytes=250)
+    assert first.size_bytes() == 52
+    assert not (tmp_path / SharedDiskCache.INDEX_NAME).exists()
+    for i in range(3):
+        first.set(f"a{i}", "x" * 50)
+        second.set(f"b{i}", "x" * 50)
+    # One process' writes count against the other one's budget
+    assert first.size_bytes() == second.size_bytes() <= 250
+    assert first.get("old") is None and first.get("a0") is None
+    assert second.get("b2") == "x" * 50
+    second.delete("b2")
+    assert first.get("b2") is None
+    assert first.size_bytes() == second.size_bytes()
+
+
+def _compute_once(directory, marker):
+    cache = TieredCache(f"shared-{os.getpid()}", memory_items=4, disk=SharedDiskCache(pathlib.Path(directory)))
+
+    def compute():
+        with open(marker, "a") as f:
+            f.write("computed\n")
+        time.sleep(0.5)
+        return {"value": 42}
+
+    return cache.compute_shared("k", compute), cache.stats.as_dict()["shared_hits"]
+
+
+def test_compute_shared_runs_once_across_processes(tmp_path):
+    marker = tmp_path / "computed"
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(3) as pool:
+        results = pool.starmap(_compute_once, [(str(tmp_path / "cache"), str(marker))] * 3)
+    assert [value for value, _ in results] == [{"value": 42}] * 3
+    assert sorted(shared for _, shared in results) == [0, 1, 1]
+    assert marker.read_text() == "computed\n"
+
+
+def test_compute_shared_nested_keys_dont_block_each_other(tmp_path):
+    cache = TieredCache("nested", memory_items=4, disk=SharedDiskCache(tmp_path), wait_timeout=0.2)
+    computed = []
+
+    def compute(key):
+        computed.append(key)
+        if key == "outer":
+            # A claimed key only blocks callers of the same key, and them only until wait_timeout
+            return [cache.compute_shared("inner", compute, "inner"), cache.compute_shared("outer", compute, "again")]
+        return key
+
+    assert cache.compute_shared("outer", compute, "outer") == ["inner", "again"]
+    assert computed == ["outer", "inner", "again"]
+    assert not os.listdir(tmp_path / ".locks")
+
+
+def test_compute_shared_takes_over_a_released_claim(tmp_path):
+    cache = TieredCache("takeover", memory_items=4, disk=SharedDiskCache(tmp_path))
+    with cache.disk.claim("k") as claimed:
+        assert claimed
+        with cache.disk.claim("k") as other:
+            assert not other
+    # The holder failed without publishing, the next caller computes it
+    assert cache.compute_shared("k", lambda: "value") == "value"
+    assert cache.stats.as_dict()["shared_hits"] == 0
+
+
+def test_disk_cache_drops_corrupt_entries(tmp_path):
+    cache = DiskCache(tmp_path)
+    cache.path_for("k").write_text('{"Blocks": [')
+    assert cache.get("k") is None
+    assert not cache.path_for("k").exists()
+    assert cache.stats.as_dict()["corrupt"] == 1
@@ -0,0 +1,80 @@
+import asyncio
+import threading
+import time
+
+from quickfill.ai.chunked_fill import (chunk_schema, fill_in_chunks,
+                                       merge_chunk_results)
+from quickfill.const import STAGE_CONCURRENCY
+from quickfill.executor import Stage, run_in_stage
+
+SCHEMA = {f"Field {i}": "" for i in range(10)}
+
+
+def test_chunks_respect_key_and_token_budgets():
+    chunks = chunk_schema(SCHEMA, max_tokens=0, max_keys=4)
+    assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+    assert [key for chunk in chunks for key in chunk] == list(SCHEMA)
+
+    # {"Field 0": ""} is 15 characters, 4 tokens
+    chunks = chunk_schema(SCHEMA, max_tokens=12, max_keys=0)
+    assert [len(chunk) for chunk in chunks] == [3, 3, 3, 1]
+
+    # A key over the budget on its own still gets a chunk
+    assert chunk_schema({"x" * 100: ""}, max_tokens=5) == [{"x" * 100: ""}]
+    assert chunk_schema(SCHEMA, max_tokens=0, max_keys=0) == [SCHEMA]
+
+
+def test_merge_prefers_the_owning_chunk():
+    chunks = [{"Name": "", "City": ""}, {"Phone": ""}]
+    results = [{"Name": "Steve", "City": "", "Phone": "123"}, {"Phone": "456", "City": "Cupertino", "Name": "Bob"}]
+    assert merge_chunk_results(chunks, results) == {"Name": "Steve", "City": "Cupertino", "Phone": "456"}
+
+
+def test_chunks_run_in_parallel_with_bounded_parallelism():
+    lock = threading.Lock()
+    state = {"running": 0, "peak": 0, "calls": []}
+
+    def fill_chunk(chunk):
+        with lock:
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+            state["calls"].append(list(chunk))
+        time.sleep(0.05)
+        with lock:
+            state["running"] -= 1
+        return {key: key.upper() for key in chunk}
+
+    result = fill_in_chunks(fill_chunk, SCHEMA, max_tokens=0, max_keys=2, parallelism=3)
+    assert result == {key: key.upper() for key in SCHEMA}
+    assert len(state["calls"]) == 5
+    assert state["peak"] == 3
+
+
+def test_small_schema_is_one_call():
+    calls = []
+    result = fill_in_chunks(lambda chunk: calls.append(chunk) or ["not a dict"], SCHEMA, max_keys=40)
+    assert calls == [SCHEMA]
+    assert result == ["not a dict"]  # Passed through untouched, as without chunking
+
+
+def test_chunks_share_the_llm_stage_limit():
+    limit = STAGE_CONCURRENCY[Stage.LLM.value]
+    lock = threading.Lock()
+    state = {"running": 0, "peak": 0}
+
+    def fill_chunk(chunk):
+        with lock:
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+        time.sleep(0.02)
+        with lock:
+            state["running"] -= 1
+        return dict(chunk)
+
+    async def main():
+        fills = [run_in_stage(Stage.LLM, fill_in_chunks, fill_chunk, SCHEMA, 0, 1, 4) for _ in range(limit)]
+        return await asyncio.gather(*fills)
+
+    assert asyncio.run(main()) == [SCHEMA] * limit
+    # Each fill has 10 chunks and may use 4 calls at once, all of them together still stay within the stage
+    assert 1 < state["peak"] <= limit
@@ -0,0 +1,75 @@
+import json
+import struct
+
+import pytest
+from quickfill.cache import DiskCache
+from quickfill.ocr.columnar import ColumnarDocument, encode_response
+from quickfill.ocr.document import TextractDocument
+
+from test_textract_document import RESPONSE
+
+
+def _float32_roundtrip(value):
+    return json.loads(json.dumps(value), parse_float=lambda f: pytest.approx(float(f), rel=1e-6))
+
+
+@pytest.fixture
+def response():
+    response = json.loads(json.dumps(RESPONSE))
+    response["DocumentMetadata"] = {"Pages": 1}
+    for i, block in enumerate(response["Blocks"]):
+        block["Confidence"] = 90.0 + i / 3
+        block["Page"] = 1
+        block.setdefault("Geometry", {"BoundingBox": {"Width": 0.5, "Height": 0.1, "Left": 0.25, "Top": 0.125}})
+        block["Geometry"]["Polygon"] = [{"X": 0.1, "Y": 0.2}, {"X": 0.3, "Y": 0.4}]
+    response["Blocks"][1]["Query"] = {"Text": "extra field"}
+    return response
+
+
+def test_views_match_textract_document(response):
+    document = TextractDocument(response)
+    columnar = ColumnarDocument.from_bytes(encode_response(response))
+    assert columnar.text() == document.text()
+    assert list(columnar.key_value_pairs()) == _float32_roundtrip(document.key_value_pairs())
+    assert columnar.tables() == document.tables()
+
+
+def test_text_only_decodes_needed_columns(response):
+    columnar = ColumnarDocument.from_bytes(encode_response(response))
+    columnar.text()
+    assert set(columnar._columns) == {"block_type", "text", "text_offsets"}
+
+
+def test_raw_roundtrip_from_mmap(tmp_path, response):
+    path = tmp_path / "doc.qfb"
+    path.write_bytes(encode_response(response))
+    columnar = ColumnarDocument.open(path)
+    assert columnar.response == _float32_roundtrip(response)
+    assert len(path.read_bytes()) < len(json.dumps(response))
+
+
+def test_truncated_cache_files_are_dropped(tmp_path, response):
+    cache = DiskCache(tmp_path, suffix=".qfb", dumps=lambda document: encode_response(document),
+                      open_file=ColumnarDocument.open)
+    data = encode_response(response)
+    for key, content in (("truncated", data[:len(data) // 2]), ("header", data[:20]), ("empty", b"")):
+        cache.path_for(key).write_bytes(content)
+        assert cache.get(key) is None
+        assert not cache.path_for(key).exists()
+    assert cache.stats.as_dict()["corrupt"] == 3
+    cache.set("k", response)
+    assert cache.get("k").response == _float32_roundtrip(response)
+
+
+def test_corrupt_columns_are_dropped_on_open(tmp_path, response):
+    cache = DiskCache(tmp_path, suffix=".qfb", dumps=encode_response, open_file=ColumnarDocument.open)
+    cache.set("k", response)
+    data = bytearray(cache.path_for("k").read_bytes())
+    (header_size,) = struct.unpack("<I", data[4:8])
+    columns = json.loads(bytes(data[8:8 + header_size]))["columns"]
+    spec = next(spec for spec in columns.values() if spec["codec"] == "zlib")
+    data[8 + header_size + spec["offset"] + spec["size"] // 2] ^= 0xFF
+    cache.path_for("k").write_bytes(bytes(data))
+    assert cache.get("k") is None
+    assert not cache.path_for("k").exists()
+    assert cache.stats.as_dict()["corrupt"] == 1
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import time
+
+from quickfill.const import STAGE_CONCURRENCY
+from quickfill.executor import Stage, _limits, iterate_in_stage, run_in_stage
+
+
+def test_run_in_stage_does_not_block_event_loop():
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        task = asyncio.ensure_future(ticker())
+        result = await run_in_stage(Stage.LLM, lambda: time.sleep(0.2) or "done")
+        task.cancel()
+        return result, ticks
+
+    result, ticks = asyncio.run(main())
+    assert result == "done"
+    assert ticks > 5
+
+
+def test_run_in_stage_respects_concurrency_limit():
+    limit = STAGE_CONCURRENCY[Stage.OCR.value]
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+
+    def work():
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.02)
+        with lock:
+            running -= 1
+
+    async def main():
+        await asyncio.gather(*[run_in_stage(Stage.OCR, work) for _ in range(limit * 3)])
+
+    asyncio.run(main())
+    assert 1 < peak <= limit
+
+
+def test_iterate_in_stage_keeps_its_slot_until_the_generator_stops():
+    release = threading.Event()
+    closed = threading.Event()
+
+    def tokens():
+        try:
+            yield "first"
+            release.wait(5)
+            yield "second"
+        finally:
+            closed.set()
+
+    async def main():
+        stream = iterate_in_stage(Stage.LLM, tokens)
+        assert await stream.__anext__() == "first"
+        await stream.aclose()
+        # The consumer is gone but the generator's thread is still blocked in it
+        in_use = _limits[Stage.LLM].in_use
+        release.set()
+        await asyncio.get_running_loop().run_in_executor(None, closed.wait, 5)
+        await asyncio.sleep(0.05)
+        return in_use, _limits[Stage.LLM].in_use
+
+    assert asyncio.run(main()) == (1, 0)
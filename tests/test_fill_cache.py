@@ -0,0 +1,43 @@
+import pytest
+from quickfill.ai import fill_cache as fill_cache_module
+from quickfill.ai.fill_cache import cached_fill, fill_cache_key
+from quickfill.cache import DiskCache, TieredCache
+
+
+@pytest.fixture(autouse=True)
+def temp_fill_cache(tmp_path, monkeypatch):
+    cache = TieredCache("test-llm-fill", memory_items=16, disk=DiskCache(tmp_path))
+    monkeypatch.setattr(fill_cache_module, "fill_cache", cache)
+    return cache
+
+
+def test_identical_inputs_hit_the_cache():
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"Name": "Bob"}
+
+    args = ("gpt-4", 0.1, "prompt {form_a_content}", b"form a image", '{"Name": ""}')
+    assert cached_fill(compute, *args) == {"Name": "Bob"}
+    assert cached_fill(compute, *args) == {"Name": "Bob"}
+    assert len(calls) == 1
+
+
+def test_bypass_always_calls_the_model(temp_fill_cache):
+    calls = []
+    args = ("gpt-4", 0.1, "prompt", "form a", "form b")
+    for _ in range(2):
+        cached_fill(lambda: calls.append(1) or {}, *args, use_cache=False)
+    assert len(calls) == 2
+    assert temp_fill_cache.stats.as_dict()["writes"] == 0
+
+
+def test_key_covers_every_input():
+    base = ("gpt-4", 0.1, "prompt", "form a", {"Name": ""})
+    keys = {fill_cache_key(*base)}
+    for i, changed in enumerate(("gpt-3.5", 0.2, "prompt v2", "form a'", {"Age": ""})):
+        args = list(base)
+        args[i] = changed
+        keys.add(fill_cache_key(*args))
+    assert len(keys) == 6
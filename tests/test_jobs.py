@@ -0,0 +1,97 @@
+import asyncio
+import io
+
+import pytest
+from quickfill import jobs
+from quickfill.jobs import JobKind, JobStore, JobWorker
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(tmp_path / "jobs", visibility_timeout=60, max_attempts=2, retry_delay=0)
+
+
+@pytest.fixture
+def fake_pipeline(monkeypatch):
+    calls = []
+
+    async def filea_to_fileb_fill_async(form_a, form_b, use_cache=True):
+        calls.append((form_a, form_b, use_cache))
+        if form_b == b"broken":
+            raise ValueError("no key value pairs")
+        return io.BytesIO(b"%PDF " + form_a + b"->" + form_b)
+
+    monkeypatch.setattr(jobs, "filea_to_fileb_fill_async", filea_to_fileb_fill_async)
+    return calls
+
+
+def test_job_lifecycle(store, fake_pipeline, monkeypatch):
+    notified = []
+    monkeypatch.setattr(jobs, "notify", notified.append)
+    job = store.submit(JobKind.GENERAL_FILL, {"form_a": b"a", "form_b": memoryview(b"b")}, {"use_cache": False},
+                       callback_url="http://localhost:9000/done")
+    assert job["status"] == "queued"
+
+    job = asyncio.run(JobWorker(store, "w1").run_once())
+    assert (job["status"], job["attempts"], job["result_url"]) == ("done", 1, f"/jobs/{job['id']}/result")
+    assert fake_pipeline == [(b"a", b"b", False)]
+    assert store.result_path(job["id"]).read_bytes() == b"%PDF a->b"
+    # Inputs are dropped once the result is stored
+    assert sorted(p.name for p in store.job_path(job["id"]).iterdir()) == ["result.pdf"]
+    assert [n["id"] for n in notified] == [job["id"]]
+    assert asyncio.run(JobWorker(store, "w1").run_once()) is None
+
+
+def test_failed_jobs_are_retried_then_failed(store, fake_pipeline):
+    job = store.submit(JobKind.GENERAL_FILL, {"form_a": b"a", "form_b": b"broken"})
+    worker = JobWorker(store, "w1")
+    assert asyncio.run(worker.run_once())["status"] == "queued"
+    job = asyncio.run(worker.run_once())
+    assert (job["status"], job["attempts"], job["error"]) == ("failed", 2, "ValueError: no key value pairs")
+    assert store.info() == {"queued": 0, "running": 0, "done": 0, "failed": 1}
+
+
+def test_expired_claims_move_to_another_worker(store):
+    store.visibility_timeout = 0
+    job = store.submit(JobKind.GENERAL_FILL, {"form_a": b"a", "form_b": b"b"})
+    assert store.claim("w1")["worker"] == "w1"
+    # w1 stopped extending its claim
+    assert store.claim("w2")["worker"] == "w2"
+    assert store.complete(job["id"], "w1", b"late") is None
+    assert store.complete(job["id"], "w2", b"%PDF")["status"] == "done"
+    # Out of attempts: a lost worker fails the job instead of running it again
+    other = store.submit(JobKind.GENERAL_FILL, {"form_a": b"a", "form_b": b"b"})
+    store.claim("w1"), store.claim("w1")
+    assert store.claim("w2") is None
+    assert store.get(other["id"])["error"] == "Worker lost"
+
+
+def test_jobs_whose_worker_died_on_the_last_attempt_send_their_callback(store, fake_pipeline, monkeypatch):
+    notified = []
+    monkeypatch.setattr(jobs, "notify", notified.append)
+    store.visibility_timeout = 0
+    job = store.submit(JobKind.GENERAL_FILL, {"form_a": b"a", "form_b": b"b"},
+                       callback_url="http://localhost:9000/done")
+    # Two workers died running it, the last attempt included
+    store.claim("w1")
+    store.claim("w2")
+    assert asyncio.run(JobWorker(store, "w3").run_once()) is None
+    assert [(n["id"], n["status"], n["error"]) for n in notified] == [(job["id"], "failed", "Worker lost")]
+    assert store.get(job["id"])["status"] == "failed"
+
+
+def test_finished_jobs_are_purged(store):
+    job = store.submit(JobKind.GENERAL_FILL, {"form_a": b"a", "form_b": b"b"})
+    store.claim("w1")
+    store.complete(job["id"], "w1", b"%PDF")
+    assert store.purge() == 0
+    store.retention = -1
+    assert store.purge() == 1
+    assert store.get(job["id"]) is None
+    assert not store.job_path(job["id"]).exists()
+
+
+def test_callback_urls_are_local_only():
+    assert jobs.validate_callback_url("http://127.0.0.1:8080/hook")
+    with pytest.raises(ValueError):
+        jobs.validate_callback_url("https://example.com/hook")
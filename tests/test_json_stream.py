@@ -0,0 +1,54 @@
+import pytest
+from quickfill.ai.json_stream import IncrementalJSONParser, parse_json_response
+
+RESPONSE = 'Here you go:\n```json\n{"Name": "Bob \\"B\\" Smith", "Address": {"City": "SF, CA"}, "Tags": ["a", "}"]}\n```'
+
+
+def test_fields_are_emitted_as_soon_as_they_complete():
+    parser = IncrementalJSONParser()
+    emitted = []
+    for i in range(0, len(RESPONSE), 3):
+        emitted.append(parser.feed(RESPONSE[i:i + 3]))
+    fields = [field for chunk in emitted for field in chunk]
+    assert fields == [("Name", 'Bob "B" Smith'), ("Address", {"City": "SF, CA"}), ("Tags", ["a", "}"])]
+    # Name is known long before the response is complete
+    first = next(i for i, chunk in enumerate(emitted) if chunk)
+    assert first * 3 < RESPONSE.index("Address") + 6
+    assert parser.result() == dict(fields)
+
+
+def test_parse_json_response_without_fences():
+    assert parse_json_response('{"a": 1}') == {"a": 1}
+    assert parse_json_response('[{"a": 1}]') == [{"a": 1}]
+
+
+def test_incomplete_or_missing_json_raises():
+    with pytest.raises(ValueError):
+        parse_json_response('```json\n{"a": 1')
+    with pytest.raises(ValueError):
+        parse_json_response("I could not fill this form")
+
+
+def test_fenced_json_wins_over_brackets_in_prose():
+    response = 'Here are the fields for form [A]: {see below}\n```json\n{"Name": "Bob", "Tags": [1]}\n```'
+    assert parse_json_response(response) == {"Name": "Bob", "Tags": [1]}
+    # Valid JSON in the prose before the fence is dropped too, also when the fence is split between chunks
+    parser = IncrementalJSONParser()
+    fields = []
+    for chunk in ["Form [1] has these fields:\n`", "``js", 'on\n{"Name": ', '"Bob"}\n```']:
+        fields += parser.feed(chunk)
+    assert fields == [("Name", "Bob")]
+    assert parser.result() == {"Name": "Bob"}
+    assert parse_json_response("I found [A] and `b` in {the form}: {\"a\": 1}") == {"a": 1}
+    with pytest.raises(ValueError):
+        parse_json_response('```json\n{"a": 1,,}\n```')
+
+
+def test_long_streams_are_scanned_once():
+    parser = IncrementalJSONParser()
+    parser.feed("{")
+    for i in range(20000):
+        parser.feed(f'"k{i}": {i}, ')
+    parser.feed('"end": 0}')
+    assert len(parser.result()) == 20001
+    assert parser.fields["k19999"] == 19999
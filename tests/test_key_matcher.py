@@ -0,0 +1,88 @@
+from quickfill.ai.key_matcher import (fill_locally, llm_updates, match_keys,
+                                     normalize_key, validate)
+
+FORM_A = {
+    "NAME:": "Steve Jobs",
+    "FIRST NAME": "Steve",
+    "Surname": "Jobs",
+    "DOB": "02/24/1955",
+    "Zip": "CA",  # Misread by OCR, must not fill a zip code
+    "Postal Code": "95014",
+    "Telephone": "(408) 996-1010",
+    "Home Adress": "1 Infinite Loop",
+    "Eye Color": "",
+}
+
+
+def test_normalize_key():
+    assert normalize_key("1. Date of Birth (mm/dd/yyyy):") == "date of birth"
+    assert normalize_key("Name (page 2)") == "name"
+    assert normalize_key("Street & Number") == "street and number"
+
+
+def test_validators():
+    assert validate("date", "02/24/1955")
+    assert validate("date", "June 1, 1955")
+    assert validate("date", "1955-02-24")
+    assert not validate("date", "Steve")
+    assert validate("phone", "+1 (408) 996-1010")
+    assert not validate("phone", "12-34")
+    assert validate("zip", "95014-1234")
+    assert not validate("zip", "CA")
+    assert validate("ssn", "123-45-6789")
+    assert validate(None, "anything")
+
+
+def test_match_engines():
+    matches = match_keys(FORM_A, ["Name", "First Name", "Last Name", "Date of Birth", "Zip Code", "Phone",
+                                  "Home Address", "Eye Color", "Middle Name", "Signature"])
+    engines = {key: (match.engine, match.value) for key, match in matches.items()}
+    assert engines == {
+        "Name": ("exact", "Steve Jobs"),
+        "First Name": ("exact", "Steve"),
+        "Last Name": ("synonym", "Jobs"),
+        "Date of Birth": ("synonym", "02/24/1955"),
+        "Zip Code": ("synonym", "95014"),
+        "Phone": ("synonym", "(408) 996-1010"),
+        "Home Address": ("fuzzy", "1 Infinite Loop"),
+    }
+    assert matches["Zip Code"].source_key == "Postal Code"
+
+
+def test_known_fields_never_fuzzy_match_each_other():
+    assert match_keys({"First Name": "Steve"}, ["Last Name", "Middle Name"]) == {}
+    assert match_keys({"Emergency Contact 1 Name": "Bob"}, ["Emergency Contact 2 Name"]) == {}
+
+
+def test_a_different_word_is_never_a_fuzzy_match():
+    # 0.92 similar, above the threshold, but another field
+    assert match_keys({"Employer Name": "Apple"}, ["Employee Name"]) == {}
+    assert match_keys({"Patient Name": "Steve"}, ["Parent Name"]) == {}
+    assert match_keys({"Home Address": "1 Infinite Loop"}, ["Home Adress", "Hoem Address"]).keys() == \
+        {"Home Adress", "Hoem Address"}
+
+
+def test_fill_locally_leaves_the_rest_to_the_llm():
+    kv_pairs = {"Last Name": "", "Signature": ""}
+    kv_obj = {key: {"BoundingBox": {}, "Value": ""} for key in kv_pairs}
+    matches, remaining = fill_locally(FORM_A, kv_pairs, kv_obj)
+    assert remaining == {"Signature": ""}
+    assert kv_obj["Last Name"] == {"BoundingBox": {}, "Value": "Jobs", "FilledBy": "synonym"}
+    assert llm_updates({"Last Name": "Smith", "Signature": "SJ"}, matches) == {"Signature": "SJ"}
+
+    assert fill_locally(None, kv_pairs, kv_obj) == ({}, kv_pairs)
+
+
+def test_generic_keys_are_left_to_the_llm():
+    assert match_keys({"Emergency Contact Name": "Laurene"}, ["Name"]) == {}
+    assert match_keys({"Name": "Steve Jobs"}, ["Full Name", "First Name"]) == {}
+    assert match_keys({"First": "Steve", "Last": "Jobs", "MI": "P"},
+                      ["First Name", "Last Name", "Middle Name"]) == {}
+    assert match_keys({"Born": "02/24/1955"}, ["Date of Birth"]) == {}
+    assert match_keys({"Street": "Infinite Loop", "Mailing Address": "PO Box 1"}, ["Address"]) == {}
+    assert match_keys({"Mobile": "(408) 555-0100"}, ["Phone"]) == {}
+
+
+def test_equally_good_matches_with_different_values_are_ambiguous():
+    assert match_keys({"Telephone": "(408) 996-1010", "Tel": "(408) 555-0100"}, ["Phone"]) == {}
+    assert match_keys({"Telephone": "(408) 996-1010", "Tel": "(408) 996-1010"}, ["Phone"]).keys() == {"Phone"}
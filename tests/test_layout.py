@@ -0,0 +1,54 @@
+import io
+
+import pytest
+from PyPDF2 import PdfFileReader
+from quickfill.pdf.layout import BORDER_WIDTH, layout_fields, text_widths
+from quickfill.pdf.render import draw_form_fields
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+
+PAGE = (1000, 1000)
+
+
+def field(value, left=0.1, top=0.1, width=0.3, height=0.03, **extra):
+    return {"BoundingBox": {"Left": left, "Top": top, "Width": width, "Height": height}, "Value": value, **extra}
+
+
+def test_text_widths_match_the_font_metrics():
+    texts = ["Steve Jobs", "", "WWW", "café", "02/24/1955"]
+    widths = text_widths(texts)
+    assert widths.tolist() == pytest.approx([stringWidth(text, "Helvetica", 1) for text in texts])
+
+
+def test_geometry_and_one_line_fit():
+    fields = {"Short": field("Bob"), "Long": field("Steven Paul Jobs, 2066 Crist Dr", top=0.5),
+              "Other page": field("x", Page=2)}
+    layout = layout_fields(fields, PAGE, page=1, origin=(10, 20), wrap=False)
+    assert layout.keys == ["Short", "Long"]
+    (_, _, x, y, width, height, short_size, _), (_, text, *_, long_size, multiline) = list(layout)
+    assert (x, y, width, height) == pytest.approx((110, 20 + 870, 300, 30))
+    assert short_size == pytest.approx(21)  # 70% of the box's height
+    assert (text, multiline) == ("Steven Paul Jobs, 2066 Crist Dr", False)
+    assert long_size < short_size
+    assert stringWidth(text, "Helvetica", long_size) <= 300 - 6 * BORDER_WIDTH
+
+
+def test_long_values_wrap_in_tall_boxes():
+    value = "Steven Paul Jobs, 2066 Crist Dr, Los Altos, CA 94024, United States of America"
+    fields = {"Address": field(value, height=0.1)}
+    one_line = layout_fields(fields, PAGE, wrap=False).font_size[0]
+    layout = layout_fields(fields, PAGE)
+    lines = layout.values[0].split("\n")
+    size = layout.font_size[0]
+    assert layout.multiline[0] and len(lines) > 1 and size > 2 * one_line
+    assert " ".join(lines) == value
+    assert max(stringWidth(line, "Helvetica", size) for line in lines) <= 300 - 6 * BORDER_WIDTH
+    assert len(lines) * 1.2 * size <= 100 - 2 * BORDER_WIDTH
+
+    output = io.BytesIO()
+    can = canvas.Canvas(output, pagesize=PAGE)
+    draw_form_fields(can, fields, PAGE)
+    can.save()
+    pdf_field = PdfFileReader(output).getFields()["Address"]
+    assert pdf_field["/V"] == layout.values[0]
+    assert pdf_field["/Ff"] & 4096  # Multiline
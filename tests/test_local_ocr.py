@@ -0,0 +1,101 @@
+import pytest
+from quickfill import providers
+from quickfill.ocr.document import TextractDocument
+from quickfill.ocr.routing import LocalFirstOCR
+from quickfill.ocr.tesseract import TesseractError, TesseractOCR, tsv_to_response
+
+HEADER = "level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext"
+
+
+def tsv(words, page=(1000, 500)):
+    # words: (line, left, top, width, height, conf, text)
+    rows = [HEADER, f"1\t1\t0\t0\t0\t0\t0\t0\t{page[0]}\t{page[1]}\t-1\t"]
+    for number, (line, left, top, width, height, conf, text) in enumerate(words, start=1):
+        rows.append(f"4\t1\t1\t1\t{line}\t0\t{left}\t{top}\t{width}\t{height}\t-1\t")
+        rows.append(f"5\t1\t1\t1\t{line}\t{number}\t{left}\t{top}\t{width}\t{height}\t{conf}\t{text}")
+    return "\n".join(rows) + "\n"
+
+
+FORM = tsv([
+    (1, 100, 50, 80, 20, 96.5, "Name:"), (1, 200, 50, 120, 20, 91.0, "Steve"), (1, 330, 50, 100, 20, 93.0, "Jobs"),
+    (2, 100, 100, 60, 20, 95.0, "Date"), (2, 170, 100, 30, 20, 95.0, "of"), (2, 210, 100, 70, 20, 94.0, "Birth:"),
+    (2, 300, 100, 200, 20, 40.0, "__________"),
+    (3, 100, 150, 100, 20, 90.0, "Signature"),
+])
+
+
+def test_tsv_becomes_a_textract_response():
+    document = TextractDocument(tsv_to_response(FORM))
+    assert document.text() == "Name: Steve Jobs\nDate of Birth: __________\nSignature\n"
+    key_value_pairs, key_value_pairs_obj = document.key_value_pairs()
+    assert key_value_pairs == {"Name:": "Steve Jobs", "Date of Birth:": ""}
+    # The blank line is where the date goes
+    assert key_value_pairs_obj["Date of Birth:"]["BoundingBox"] == pytest.approx(
+        {"Left": 0.3, "Top": 0.2, "Width": 0.2, "Height": 0.04})
+    assert [word["Confidence"] for word in document.blocks_of_type("WORD")][:3] == [96.5, 91.0, 93.0]
+    assert TextractDocument(tsv_to_response(FORM, forms=False)).key_value_pairs() == ({}, {})
+    assert tsv_to_response(HEADER + "\n")["Blocks"][0]["BlockType"] == "PAGE"
+
+
+def test_tesseract_runs_as_a_subprocess(tmp_path):
+    command = tmp_path / "tesseract"
+    command.write_text(f"#!/bin/sh\ncat > /dev/null\ncat <<'EOF'\n{FORM}EOF\n")
+    command.chmod(0o755)
+    response = TesseractOCR(command=str(command)).analyze_document(memoryview(b"image"))
+    assert response["OCREngine"] == "tesseract"
+    assert TextractDocument(response).key_value_pairs()[0]["Name:"] == "Steve Jobs"
+
+    with pytest.raises(TesseractError, match="not found"):
+        TesseractOCR(command=str(tmp_path / "missing")).analyze_document(b"image")
+
+
+@pytest.fixture
+def engines(monkeypatch):
+    monkeypatch.setattr(providers, "PROVIDERS", {kind: dict(names) for kind, names in providers.PROVIDERS.items()})
+    monkeypatch.setattr(providers, "_loaded", {})
+    calls = []
+
+    class Local:
+        def analyze_document(self, image_bytes, feature_types):
+            calls.append("local")
+            if image_bytes == b"broken":
+                raise TesseractError("cannot read image")
+            words = [(1, 100, 50, 80, 20, float(image_bytes), "Name:")] + \
+                    [(1, 200 + 60 * i, 50, 50, 20, float(image_bytes), f"w{i}") for i in range(5)]
+            return tsv_to_response(tsv(words), forms="FORMS" in feature_types)
+
+    class Fallback:
+        def analyze_document(self, image_bytes, feature_types):
+            calls.append("fallback")
+            return {"Blocks": []}
+
+    providers.register_provider("ocr", "local", Local)
+    providers.register_provider("ocr", "fallback", Fallback)
+    return calls
+
+
+def test_low_confidence_falls_back(engines):
+    ocr = LocalFirstOCR(local="local", fallback="fallback", min_confidence=80, min_words=3)
+    assert ocr.analyze_document(b"95")["OCREngine"] == "tesseract"
+    assert ocr.analyze_document(b"60") == {"Blocks": []}
+    assert ocr.analyze_document(b"broken") == {"Blocks": []}
+    assert engines == ["local", "local", "fallback", "local", "fallback"]
+    assert ocr.info() == {"local": 1, "low_confidence": 1, "error": 1}
+
+    ocr.min_words = 10
+    ocr.analyze_document(b"95")
+    assert ocr.info()["few_words"] == 1
+
+
+def test_pdf_pages_skip_the_local_engine(engines, monkeypatch):
+    from quickfill.ocr import aws_text_extract
+
+    monkeypatch.setattr(providers, "CONFIGURED", dict(providers.CONFIGURED, ocr="tesseract"))
+    providers.register_provider("ocr", "tesseract", lambda: TesseractOCR(command="/missing/tesseract"))
+    providers.register_provider("ocr", "textract", providers.PROVIDERS["ocr"]["fallback"])
+    assert aws_text_extract.textract_analyze_document(b"%PDF-1.4 page") == {"Blocks": []}
+    assert engines == ["fallback"]
+
+    ocr = LocalFirstOCR(local="tesseract", fallback="fallback")
+    assert ocr.analyze_document(memoryview(b"%PDF-1.4 page")) == {"Blocks": []}
+    assert engines == ["fallback", "fallback"] and ocr.info() == {"pdf": 1}
@@ -0,0 +1,133 @@
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+from PyPDF2 import PdfFileReader
+from quickfill import pipeline
+from quickfill.cache import TieredCache
+from quickfill.ocr import aws_text_extract
+from quickfill.pdf.pages import split_pages
+from reportlab.pdfgen import canvas
+
+
+def textract_response(page_number):
+    # Every page has a "Name" field, page 2 also has a "Signature"
+    keys = ["Name"] + (["Signature"] if page_number == 2 else [])
+    blocks = [{"Id": "line", "BlockType": "LINE", "Text": f"Page {page_number}"}]
+    for i, key in enumerate(keys):
+        blocks += [
+            {"Id": f"k{i}", "BlockType": "KEY_VALUE_SET", "EntityTypes": ["KEY"],
+             "Relationships": [{"Type": "VALUE", "Ids": [f"v{i}"]}, {"Type": "CHILD", "Ids": [f"w{i}"]}]},
+            {"Id": f"w{i}", "BlockType": "WORD", "Text": key},
+            {"Id": f"v{i}", "BlockType": "KEY_VALUE_SET", "EntityTypes": ["VALUE"],
+             "Geometry": {"BoundingBox": {"Left": 0.1, "Top": 0.2 + 0.2 * i, "Width": 0.5, "Height": 0.05}}},
+        ]
+    return {"Blocks": blocks}
+
+
+@pytest.fixture(autouse=True)
+def fake_textract(monkeypatch):
+    # Stand-in OCR backend: the page number is read back from the page itself
+    calls = []
+
+    def textract_analyze_document(page_bytes):
+        if page_bytes.startswith(b"%PDF"):
+            text = PdfFileReader(io.BytesIO(page_bytes)).getPage(0).extractText()
+            page_number = int(text.split()[-1])
+        else:
+            with Image.open(io.BytesIO(page_bytes)) as image:
+                page_number = image.size[1] // 100
+        calls.append(page_number)
+        return textract_response(page_number)
+
+    monkeypatch.setattr(aws_text_extract, "textract_analyze_document", textract_analyze_document)
+    monkeypatch.setattr(aws_text_extract, "ocr_cache", TieredCache("ocr_pages_test", memory_items=16))
+    return calls
+
+
+def make_pdf(page_count):
+    buffer = io.BytesIO()
+    can = canvas.Canvas(buffer, pagesize=(612, 792))
+    for i in range(page_count):
+        can.drawString(72, 720, f"Page {i + 1}")
+        can.showPage()
+    can.save()
+    return buffer.getvalue()
+
+
+def make_tiff(page_count):
+    # Page n is n * 100 pixels high
+    frames = [Image.new("RGB", (300, 100 * (i + 1)), "white") for i in range(page_count)]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format="TIFF", save_all=True, append_images=frames[1:])
+    return buffer.getvalue()
+
+
+def fill(document_bytes):
+    async def run():
+        form_b = await pipeline.preprocess_async(document_bytes)
+        kv_pairs, kv_obj = await pipeline.key_value_pairs_async(form_b)
+        for key in kv_obj:
+            kv_obj[key]["Value"] = key
+        return form_b, kv_pairs, kv_obj, await pipeline.render_pdf_async(form_b, kv_obj)
+    return asyncio.run(run())
+
+
+def field_pages(pdf):
+    reader = PdfFileReader(pdf)
+    pages = {}
+    for number in range(reader.getNumPages()):
+        for annotation in reader.getPage(number).get("/Annots", ()):
+            pages[annotation.getObject()["/T"]] = number + 1
+    return reader, pages
+
+
+def test_split_pdf_pages():
+    pages = split_pages(make_pdf(3))
+    assert [page.number for page in pages] == [1, 2, 3]
+    assert all(PdfFileReader(io.BytesIO(page.data)).getNumPages() == 1 for page in pages)
+    assert pages[0].size == (612, 792)
+
+
+def test_pdf_fields_land_on_their_pages(fake_textract):
+    form_b, kv_pairs, kv_obj, pdf = fill(make_pdf(3))
+    assert form_b.is_document
+    assert sorted(fake_textract) == [1, 2, 3]
+    assert list(kv_pairs) == ["Name", "Name (page 2)", "Signature", "Name (page 3)"]
+    assert kv_obj["Signature"]["Page"] == 2
+    assert kv_obj["Name (page 3)"]["Page"] == 3
+
+    reader, pages = field_pages(pdf)
+    assert reader.getNumPages() == 3
+    assert "Page 2" in reader.getPage(1).extractText()  # Original content is kept
+    assert pages == {"Name": 1, "Name (page 2)": 2, "Signature": 2, "Name (page 3)": 3}
+    assert reader.getFields()["Signature"]["/V"] == "Signature"
+
+
+def test_tiff_pages_are_rendered_with_their_fields(fake_textract):
+    form_b, kv_pairs, kv_obj, pdf = fill(make_tiff(2))
+    assert form_b.mime == "image/tiff"
+    reader, pages = field_pages(pdf)
+    assert [float(reader.getPage(i).mediaBox[3]) for i in range(2)] == [100, 200]
+    assert pages == {"Name": 1, "Name (page 2)": 2, "Signature": 2}
+
+
+def test_pages_are_cached_separately(fake_textract):
+    fill(make_pdf(2))
+    fill(make_pdf(3))
+    # Pages 1 and 2 are the same bytes in both documents
+    assert sorted(fake_textract) == [1, 2, 3]
+
+
+def test_animated_gif_is_a_single_page_form(fake_textract):
+    frames = [Image.new("RGB", (300, 200), color) for color in ("white", "black")]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format="GIF", save_all=True, append_images=frames[1:])
+    form_b, kv_pairs, kv_obj, pdf = fill(buffer.getvalue())
+    assert not form_b.is_document and form_b.page_size == (300, 200)
+    assert fake_textract == [2]
+    reader, pages = field_pages(pdf)
+    assert reader.getNumPages() == 1
+    assert [float(v) for v in reader.getPage(0).mediaBox] == [0, 0, 300, 200]
+    assert pages == {"Name": 1, "Signature": 1}
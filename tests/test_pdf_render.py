@@ -0,0 +1,63 @@
+import io
+
+from PIL import Image
+from PyPDF2 import PdfFileReader
+from quickfill.pdf.render import orientation_matrix, render_filled_pdf
+
+FIELDS = {
+    "Name": {"BoundingBox": {"Left": 0.1, "Top": 0.1, "Width": 0.4, "Height": 0.05}, "Value": "Steve Jobs"},
+    "Date of Birth": {"BoundingBox": {"Left": 0.1, "Top": 0.3, "Width": 0.4, "Height": 0.05}, "Value": "1955-02-24"},
+}
+
+
+def encode(image, format):
+    buffer = io.BytesIO()
+    image.save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def test_jpeg_is_embedded_as_is():
+    jpeg = encode(Image.new("RGB", (600, 800), "white"), "JPEG")
+    pdf = render_filled_pdf(jpeg, FIELDS).getvalue()
+    assert jpeg in pdf
+
+    reader = PdfFileReader(io.BytesIO(pdf))
+    assert reader.getNumPages() == 1
+    assert [float(v) for v in reader.getPage(0).mediaBox] == [0, 0, 600, 800]
+    fields = reader.getFields()
+    assert fields["Name"]["/V"] == "Steve Jobs"
+    assert fields["Date of Birth"]["/V"] == "1955-02-24"
+
+
+def test_non_jpeg_images_and_given_page_size():
+    for image in (Image.new("RGBA", (300, 200)), Image.new("P", (300, 200))):
+        pdf = render_filled_pdf(encode(image, "PNG"), FIELDS, page_size=(300, 200))
+        reader = PdfFileReader(pdf)
+        assert [float(v) for v in reader.getPage(0).mediaBox] == [0, 0, 300, 200]
+        assert set(reader.getFields()) == set(FIELDS)
+
+
+def test_writes_into_given_output():
+    output = io.BytesIO()
+    jpeg = encode(Image.new("L", (100, 100)), "JPEG")
+    assert render_filled_pdf(jpeg, {}, output=output) is output
+    assert output.tell() == 0
+    assert output.getvalue().startswith(b"%PDF")
+
+
+def test_exif_orientation_is_drawn_upright_from_the_original():
+    image = Image.new("RGB", (400, 200), "white")
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Turned 90 degrees clockwise when displayed
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", exif=exif)
+    jpeg = buffer.getvalue()
+
+    pdf = render_filled_pdf(jpeg, FIELDS, orientation=6).getvalue()
+    assert jpeg in pdf
+    page = PdfFileReader(io.BytesIO(pdf)).getPage(0)
+    assert [float(v) for v in page.mediaBox] == [0, 0, 200, 400]
+    # The stored image's top left corner is the page's top right one
+    a, b, c, d, e, f = orientation_matrix(6, (400, 200), (200, 400))
+    assert (a * 0 + c * 200 + e, b * 0 + d * 200 + f) == (200, 400)
+    assert (a * 400 + c * 0 + e, b * 400 + d * 0 + f) == (0, 0)
@@ -0,0 +1,83 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+
+from PIL import Image
+from quickfill import pipeline
+from quickfill.cache import TieredCache
+from quickfill.ocr import aws_text_extract
+from quickfill.preprocess import detect_mime, preprocess_image
+
+
+def _image_bytes(size, fmt="JPEG", orientation=None, noise=False):
+    image = Image.frombytes("RGB", size, os.urandom(size[0] * size[1] * 3)) if noise else Image.new("RGB", size, "white")
+    buffer = io.BytesIO()
+    if orientation is not None:
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        image.save(buffer, format=fmt, exif=exif)
+    else:
+        image.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def test_detect_mime():
+    assert detect_mime(_image_bytes((8, 8), "JPEG")) == "image/jpeg"
+    assert detect_mime(_image_bytes((8, 8), "PNG")) == "image/png"
+    assert detect_mime(_image_bytes((8, 8), "TIFF")) == "image/tiff"
+    assert detect_mime(b"%PDF-1.7\n") == "application/pdf"
+    assert detect_mime(b"garbage") == "application/octet-stream"
+
+
+def test_small_upload_is_passed_through():
+    data = _image_bytes((300, 200), "PNG")
+    result = preprocess_image(data, max_dimension=1000, target_bytes=1024 ** 2, grayscale=False)
+    assert result.data is data
+    assert (result.mime, result.size) == ("image/png", (300, 200))
+
+
+def test_large_upload_is_downscaled_and_rotated():
+    data = _image_bytes((4000, 3000), orientation=6)  # Rotated 90 degrees by EXIF
+    result = preprocess_image(data, max_dimension=1000, target_bytes=0, grayscale=False)
+    assert result.mime == "image/jpeg"
+    assert result.size == (750, 1000)
+    assert result.original_size == (4000, 3000)
+    # The filled PDF is drawn on the upload, upright
+    assert result.original is data
+    assert result.page_size == (3000, 4000)
+    assert result.data_hash == hashlib.md5(result.data).hexdigest()
+    with Image.open(io.BytesIO(result.data)) as image:
+        assert image.size == (750, 1000)
+
+
+def test_byte_budget_and_cache():
+    data = _image_bytes((800, 800), "PNG", noise=True)
+    result = preprocess_image(data, max_dimension=0, target_bytes=200 * 1024, grayscale=True)
+    assert len(result.data) <= 200 * 1024
+    with Image.open(io.BytesIO(result.data)) as image:
+        assert image.mode == "L"
+    # The preprocessed image is cached, the upload is attached to every result for the PDF
+    again = preprocess_image(data, max_dimension=0, target_bytes=200 * 1024, grayscale=True)
+    assert again.data is result.data
+    assert again.original is data
+
+
+def test_legacy_ocr_entries_of_downscaled_uploads_are_migrated(tmp_path, monkeypatch):
+    # Written before uploads were preprocessed, keyed by the upload's hash
+    data = _image_bytes((4000, 3000), orientation=6)
+    response = {"Blocks": [{"Id": "1", "BlockType": "LINE", "Text": "Steve Jobs"}]}
+    legacy_path = tmp_path / f"{hashlib.md5(data).hexdigest()}.json"
+    legacy_path.write_text(json.dumps(response))
+    monkeypatch.setattr(aws_text_extract, "CACHE_PATH", tmp_path)
+    monkeypatch.setattr(aws_text_extract, "ocr_cache", TieredCache("test-legacy-ocr", memory_items=4))
+
+    def textract_analyze_document(image_bytes):
+        raise AssertionError("the legacy entry was not found")
+
+    monkeypatch.setattr(aws_text_extract, "textract_analyze_document", textract_analyze_document)
+    form = preprocess_image(data, max_dimension=1000, target_bytes=0, grayscale=False)
+    assert form.data_hash != form.original_hash
+    assert asyncio.run(pipeline.form_a_text_async(form)) == "Steve Jobs\n"
+    assert not legacy_path.exists()
@@ -0,0 +1,61 @@
+import json
+import os
+import pathlib
+import subprocess
+import sys
+
+import pytest
+from quickfill import providers
+from quickfill.ocr import aws_text_extract
+
+REPO_PATH = pathlib.Path(__file__).parent.parent
+# Backends that must only be imported when a provider is first used
+PROVIDER_MODULES = ("langchain", "langchain_core", "langchain_community", "openai", "vertexai",
+                    "google.cloud.aiplatform", "boto3", "botocore")
+# Cold import of quickfill.main, generous enough for slow CI machines
+IMPORT_BUDGET_MS = float(os.environ.get("QUICKFILL_IMPORT_BUDGET_MS", 1500))
+
+
+def test_importing_the_app_loads_no_provider():
+    code = ("import json, sys, time\n"
+            "start = time.perf_counter()\n"
+            "import quickfill.main\n"
+            "print(json.dumps({'ms': (time.perf_counter() - start) * 1000, 'modules': list(sys.modules)}))\n")
+    env = {**os.environ, "PYTHONPATH": str(REPO_PATH), "QUICKFILL_PRELOAD_PROVIDERS": "0"}
+    output = subprocess.run([sys.executable, "-c", code], cwd=REPO_PATH, env=env, capture_output=True, text=True,
+                            check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    assert [module for module in PROVIDER_MODULES if module in result["modules"]] == []
+    assert result["ms"] < IMPORT_BUDGET_MS
+
+
+@pytest.fixture
+def fake_ocr(monkeypatch):
+    monkeypatch.setattr(providers, "PROVIDERS", {kind: dict(names) for kind, names in providers.PROVIDERS.items()})
+    monkeypatch.setattr(providers, "_loaded", {})
+    created = []
+
+    class FakeOCR:
+        def __init__(self):
+            created.append(self)
+
+        def analyze_document(self, image_bytes, feature_types):
+            return {"Blocks": [{"Id": "l", "BlockType": "LINE", "Text": image_bytes.decode()}]}
+
+    providers.register_provider("ocr", "textract", FakeOCR)
+    return created
+
+
+def test_providers_are_created_once_on_first_use(fake_ocr):
+    assert providers.loaded_provider("ocr") is None
+    assert fake_ocr == []
+    assert aws_text_extract.textract_analyze_document(b"hello")["Blocks"][0]["Text"] == "hello"
+    aws_text_extract.textract_analyze_document(b"again")
+    assert len(fake_ocr) == 1
+    assert providers.loaded_provider("ocr") is fake_ocr[0]
+    assert providers.get_provider_info()["ocr"] == {"configured": "textract", "loaded": ["textract"]}
+
+
+def test_unknown_provider(fake_ocr):
+    with pytest.raises(ValueError, match="Unknown ocr provider: azure"):
+        providers.get_provider("ocr", "azure")
@@ -0,0 +1,135 @@
+import asyncio
+import io
+import re
+
+from PIL import Image
+from PyPDF2 import PdfFileReader
+from quickfill import refill
+from quickfill.pdf.incremental import FONT_RESOURCE, FilledPDF
+from quickfill.preprocess import PreprocessedImage
+
+FIELDS = {
+    "Name": {"BoundingBox": {"Left": 0.1, "Top": 0.1, "Width": 0.4, "Height": 0.05}, "Value": "Steve Jobs"},
+    "Date of Birth": {"BoundingBox": {"Left": 0.1, "Top": 0.3, "Width": 0.4, "Height": 0.05}, "Value": "1955-02-24"},
+    "City": {"BoundingBox": {"Left": 0.1, "Top": 0.5, "Width": 0.4, "Height": 0.05}, "Value": ""},
+}
+
+
+def jpeg(size=(600, 800)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, "white").save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def read_values(data):
+    return {key: field.get("/V") for key, field in PdfFileReader(io.BytesIO(data), strict=True).getFields().items()}
+
+
+def test_changed_values_are_appended_to_the_pdf():
+    pdf = FilledPDF.render(jpeg(), FIELDS)
+    assert read_values(pdf.data) == {"Name": "Steve Jobs", "Date of Birth": "1955-02-24", "City": ""}
+
+    name = dict(FIELDS["Name"], Value="Steven Paul Jobs (Apple)")
+    updated = pdf.with_values({"Name": name, "City": dict(FIELDS["City"], Value="Cupertino")})
+    assert updated.data.startswith(pdf.data)
+    assert read_values(updated.data) == {"Name": "Steven Paul Jobs (Apple)", "Date of Birth": "1955-02-24",
+                                         "City": "Cupertino"}
+    # Updates chain, the first one stays valid
+    again = updated.with_values({"Date of Birth": dict(FIELDS["Date of Birth"], Value="")})
+    assert read_values(again.data)["Date of Birth"] == ""
+    assert read_values(again.data)["City"] == "Cupertino"
+    assert read_values(updated.data)["Date of Birth"] == "1955-02-24"
+    assert pdf.with_values({"Unknown": name}) is pdf
+
+
+def test_only_keys_backed_by_edited_lines_are_affected():
+    values = dict(FIELDS)
+    session = refill.FillSession({key: "" for key in FIELDS}, {key: "" for key in FIELDS}, values,
+                                 ["My name is Steve Jobs", "Born 1955-02-24", "I like apples"], None)
+    assert refill.affected_keys(session, session.lines) == []
+    # The birth date's line was edited
+    assert refill.affected_keys(session, ["My name is Steve Jobs", "Born 1955-03-24", "I like apples"]) == \
+        ["Date of Birth"]
+    # A new line may hold the blank city, a line naming the key points to it
+    assert refill.affected_keys(session, session.lines + ["I live in Cupertino"]) == ["City"]
+    assert refill.affected_keys(session, ["My name is Steve Jobs", "Born 1955-02-24", "I like pears"]) == []
+
+
+def test_refill_only_asks_for_changed_keys(monkeypatch):
+    form_b = PreprocessedImage(jpeg(), "image/jpeg", (600, 800), "hash", (600, 800))
+    form_b.original = form_b.data
+    blank = {key: dict(field, Value="") for key, field in FIELDS.items()}
+    answers = {"Name": "Steve Jobs", "Date of Birth": "1955-02-24"}
+    asked = []
+
+    async def preprocess_async(image_bytes):
+        return form_b
+
+    async def form_b_fields_async(form):
+        return {key: "" for key in blank}, blank
+
+    def chunked_form_filling(text_input, fields, use_cache=True):
+        asked.append(sorted(fields))
+        return {key: answers[key] for key in fields if key in answers}
+
+    monkeypatch.setattr(refill, "preprocess_async", preprocess_async)
+    monkeypatch.setattr(refill, "form_b_fields_async", form_b_fields_async)
+    monkeypatch.setattr(refill, "chunked_form_filling", chunked_form_filling)
+    monkeypatch.setattr(refill, "fill_sessions", refill.SessionStore())
+
+    text = "Name: Steve Jobs\nDate of Birth: 1955-02-24"
+    pdf, refilled = asyncio.run(refill.refill_async("session", b"form b", text))
+    assert refilled == list(FIELDS) and asked == [sorted(FIELDS)]
+    assert read_values(pdf.getvalue()) == {"Name": "Steve Jobs", "Date of Birth": "1955-02-24", "City": ""}
+
+    answers["Date of Birth"] = "1955-03-24"
+    pdf, refilled = asyncio.run(refill.refill_async("session", b"form b", text.replace("02-24", "03-24")))
+    assert refilled == ["Date of Birth"] and asked[1:] == [["Date of Birth"]]
+    assert read_values(pdf.getvalue())["Date of Birth"] == "1955-03-24"
+
+    # Same text, nothing to ask
+    assert asyncio.run(refill.refill_async("session", b"form b", text.replace("02-24", "03-24")))[1] == []
+    assert len(asked) == 2
+    # Another session fills from scratch
+    asyncio.run(refill.refill_async("other", b"form b", text))
+    assert len(asked) == 3
+
+
+def test_non_object_llm_answers_fill_nothing(monkeypatch):
+    def chunked_form_filling(text_input, fields, use_cache=True):
+        return ["not", "an", "object"]
+
+    monkeypatch.setattr(refill, "chunked_form_filling", chunked_form_filling)
+    assert asyncio.run(refill._llm_values("Name: Steve Jobs", {"Name": ""}, True)) == {}
+
+
+def test_appended_fields_use_the_layout_font_and_size():
+    pdf = FilledPDF.render(jpeg(), FIELDS)
+    # Too long for the box at the largest size, the fitted font size is fractional
+    name = dict(FIELDS["Name"], Value="Steven Paul Jobs, Apple Computer, Cupertino")
+    updated = pdf.with_values({"Name": name})
+    widget = updated.object_source(updated.widgets["Name"])
+    font, size = re.search(rb"/DA \(/(\w+) ([\d.]+) Tf", widget).groups()
+    appearance = updated.object_source(int(re.search(rb"/AP << /N (\d+) 0 R", widget).group(1)))
+    assert b"/%s %s Tf" % (font, size) in appearance
+    assert font == FONT_RESOURCE.encode()
+    assert b"." in size
+
+
+def test_submissions_of_one_session_run_one_after_the_other():
+    store = refill.SessionStore()
+    order = []
+
+    async def submit(key, name):
+        async with store.lock(key):
+            order.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            order.append(f"{name} end")
+
+    async def main():
+        await asyncio.gather(submit("a", "first"), submit("a", "second"), submit("b", "other"))
+
+    asyncio.run(main())
+    assert order.index("first end") < order.index("second start")
+    assert order.index("other start") < order.index("first end")
+    assert store._locks == {}
@@ -0,0 +1,56 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from quickfill.singleflight import SingleFlight, make_key, single_flight
+
+
+def test_concurrent_calls_share_one_execution():
+    group = SingleFlight("test-shared")
+    calls = []
+
+    def slow(x):
+        calls.append(x)
+        time.sleep(0.1)
+        return {"value": x}
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: group.do("k", slow, 1), range(8)))
+
+    assert calls == [1]
+    assert all(r is results[0] for r in results)
+    assert group.info() == {"executed": 1, "shared": 7, "in_flight": 0}
+
+
+def test_errors_are_propagated_to_waiters_and_not_cached():
+    group = SingleFlight("test-errors")
+    started = threading.Event()
+
+    def fail():
+        started.set()
+        time.sleep(0.05)
+        raise RuntimeError("boom")
+
+    with ThreadPoolExecutor(2) as pool:
+        leader = pool.submit(group.do, "k", fail)
+        started.wait()
+        follower = pool.submit(group.do, "k", fail)
+        for future in (leader, follower):
+            with pytest.raises(RuntimeError):
+                future.result()
+
+    assert group.do("k", lambda: "ok") == "ok"
+
+
+def test_decorator_keys_on_arguments():
+    group = SingleFlight("test-decorator")
+
+    @single_flight(group)
+    def echo(a, b=None):
+        return (a, b)
+
+    assert echo(b"img", b=1) == (b"img", 1)
+    assert make_key(b"img") == make_key(bytearray(b"img"))
+    assert make_key("a", {"x": 1, "y": 2}) == make_key("a", {"y": 2, "x": 1})
+    assert make_key("a") != make_key("b")
@@ -0,0 +1,59 @@
+import asyncio
+import json
+
+import pytest
+from quickfill import streaming
+
+
+def _collect(events):
+    async def main():
+        return [event async for event in events]
+
+    return asyncio.run(main())
+
+
+def _fake_stream(monkeypatch, answers, fail=None):
+    calls = []
+
+    def stream_genearl_form_filling(form_a_str, form_b_str, use_cache=True):
+        schema = json.loads(form_b_str)
+        calls.append(list(schema))
+        if fail in schema:
+            raise RuntimeError("context length exceeded")
+        result = {key: answers[key] for key in schema if key in answers}
+        # The model also answers a key of another chunk
+        result.update({key: value for key, value in answers.items() if key not in schema and key.startswith("Extra")})
+        for key, value in result.items():
+            yield "token", value
+            yield "field", (key, value)
+        yield "result", result
+
+    monkeypatch.setattr(streaming, "stream_genearl_form_filling", stream_genearl_form_filling)
+    return calls
+
+
+def test_large_schemas_stream_in_chunks(monkeypatch):
+    answers = {"Name": "Steve", "City": "Cupertino", "Extra": "from another chunk"}
+    calls = _fake_stream(monkeypatch, answers)
+    chunks = [{"Name": "", "City": ""}, {"Extra": ""}, {"Signature": ""}]
+    events = _collect(streaming._chunk_events("form a", chunks, use_cache=False, parallelism=2))
+    assert sorted(calls) == [["Extra"], ["Name", "City"], ["Signature"]]
+    fields = sorted(payload for kind, payload in events if kind == "field")
+    # A chunk only sends its own keys' fields
+    assert fields == [("City", "Cupertino"), ("Extra", "from another chunk"), ("Name", "Steve")]
+    assert all("chunk" in payload for kind, payload in events if kind == "token")
+    assert events[-1] == ("result", {"Name": "Steve", "City": "Cupertino", "Extra": "from another chunk"})
+
+
+def test_one_chunk_streams_the_whole_schema(monkeypatch):
+    calls = _fake_stream(monkeypatch, {"Name": "Steve"})
+    events = _collect(streaming._chunk_events("form a", [{"Name": ""}], use_cache=False))
+    assert calls == [["Name"]]
+    assert events == [("token", "Steve"), ("field", ("Name", "Steve")), ("result", {"Name": "Steve"})]
+
+
+def test_a_failed_chunk_fails_the_stream(monkeypatch):
+    _fake_stream(monkeypatch, {"Name": "Steve"}, fail="City")
+    events = streaming._chunk_events("form a", [{"Name": ""}, {"City": ""}], use_cache=False)
+    with pytest.raises(RuntimeError, match="context length exceeded"):
+        _collect(events)
@@ -0,0 +1,80 @@
+import asyncio
+
+import httpx
+from fastapi import FastAPI
+from quickfill import telemetry
+from quickfill.executor import Stage, run_in_stage
+from quickfill.telemetry import (Histogram, Trace, TraceMiddleware,
+                                 current_trace, span)
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("test_seconds", "Test.", ["stage"], buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe("ocr", value=value)
+    assert histogram.render() == [
+        "# HELP test_seconds Test.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{stage="ocr",le="0.1"} 1',
+        'test_seconds_bucket{stage="ocr",le="1.0"} 3',
+        'test_seconds_bucket{stage="ocr",le="+Inf"} 4',
+        'test_seconds_sum{stage="ocr"} 6.05',
+        'test_seconds_count{stage="ocr"} 4',
+    ]
+
+
+def test_stage_threads_record_into_the_request_trace():
+    def blocking_work():
+        with span("work"):
+            return current_trace().id
+
+    async def handle():
+        trace = Trace("trace-1", "test")
+        telemetry._current_trace.set(trace)
+        assert await run_in_stage(Stage.OCR, blocking_work) == "trace-1"
+        return trace
+
+    trace = asyncio.run(handle())
+    assert [s["name"] for s in trace.spans] == ["work", "ocr"]
+    assert all(s["ok"] for s in trace.spans)
+
+
+def test_middleware_traces_requests():
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: str):
+        with span("lookup"):
+            return {"trace_id": current_trace().id}
+
+    app.add_middleware(TraceMiddleware)
+
+    async def get(path, **kwargs):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.get(path, **kwargs)
+
+    response = asyncio.run(get("/items/1", headers={"X-Request-ID": "req-42"}))
+    assert response.headers["X-Trace-Id"] == "req-42"
+    assert response.json() == {"trace_id": "req-42"}
+
+    generated = asyncio.run(get("/items/2")).headers["X-Trace-Id"]
+    assert generated and generated != "req-42"
+
+    # Labelled by route template, not by path
+    metrics = telemetry.render_metrics()
+    assert 'quickfill_request_seconds_count{route="/items/{item_id}",status="200"}' in metrics
+    assert 'quickfill_span_seconds_count{span="lookup"}' in metrics
+
+
+def test_disabled_spans_are_noops(monkeypatch):
+    monkeypatch.setattr(telemetry, "TELEMETRY_ENABLED", False)
+    trace = Trace("trace-2", "test")
+    token = telemetry._current_trace.set(trace)
+    try:
+        with span("ignored"):
+            pass
+    finally:
+        telemetry._current_trace.reset(token)
+    assert span("ignored") is telemetry._NOOP_SPAN
+    assert trace.spans == []
+    assert 'span="ignored"' not in telemetry.render_metrics()
@@ -0,0 +1,104 @@
+import asyncio
+import io
+import random
+
+import pytest
+from PIL import Image, ImageDraw, ImageEnhance
+from quickfill import pipeline
+from quickfill.preprocess import PreprocessedImage
+from quickfill.templates import TemplateRegistry, difference_hash
+
+KV_PAIRS = {"Name": "", "Date of Birth": ""}
+KV_OBJ = {
+    "Name": {"BoundingBox": {"Left": 0.3, "Top": 0.1, "Width": 0.5, "Height": 0.05}, "Value": ""},
+    "Date of Birth": {"BoundingBox": {"Left": 0.3, "Top": 0.2, "Width": 0.5, "Height": 0.05}, "Value": ""},
+}
+
+
+def blank_form(seed, size=(850, 1100)):
+    # Boxes and rules at seeded positions, like the printed layout of a form
+    rng = random.Random(seed)
+    image = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(image)
+    for _ in range(25):
+        x, y = rng.randrange(0, size[0] - 200), rng.randrange(0, size[1] - 60)
+        draw.rectangle((x, y, x + rng.randrange(80, 200), y + rng.randrange(20, 60)), outline=0, width=3)
+        draw.rectangle((x + 5, y + 5, x + 40, y + 15), fill=rng.randrange(0, 120))
+    return image
+
+
+def encode(image, quality=90):
+    buffer = io.BytesIO()
+    image.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def rescan(image):
+    # Darker exposure, slightly smaller, lower JPEG quality
+    image = ImageEnhance.Brightness(image).enhance(0.9)
+    image = image.resize((image.width * 97 // 100, image.height * 97 // 100))
+    return encode(image, quality=60)
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return TemplateRegistry(tmp_path / "templates", max_distance=24)
+
+
+def test_rescan_matches_its_template(registry):
+    form = blank_form(1)
+    template = registry.register("W-4", encode(form), KV_PAIRS, KV_OBJ)
+    registry.register("I-9", encode(blank_form(2)), KV_PAIRS, KV_OBJ)
+
+    assert registry.match(rescan(form)).id == template.id
+    assert registry.match(encode(blank_form(3))) is None
+    # Same layout squeezed into another page shape
+    assert registry.match(encode(form.resize((850, 850)))) is None
+    assert registry.info()["hits"] == 1
+
+
+def test_templates_persist_and_hand_out_copies(registry, tmp_path):
+    filled = {key: {**value, "Value": "x"} for key, value in KV_OBJ.items()}
+    template = registry.register("W-4", encode(blank_form(1)), KV_PAIRS, filled)
+
+    reloaded = TemplateRegistry(tmp_path / "templates")
+    stored = reloaded.get(template.id)
+    assert stored.name == "W-4"
+    assert stored.phash == template.phash
+    kv_pairs, kv_obj = stored.fields()
+    assert kv_pairs == KV_PAIRS
+    assert kv_obj["Name"]["Value"] == ""  # Values are never stored
+    kv_obj["Name"]["Value"] = "Steve"
+    assert stored.key_value_pairs_obj["Name"]["Value"] == ""
+
+    assert reloaded.delete(template.id)
+    assert TemplateRegistry(tmp_path / "templates").list() == []
+
+
+def test_other_processes_see_new_and_deleted_templates(registry, tmp_path):
+    # Another API process has its own registry on the same directory
+    other = TemplateRegistry(tmp_path / "templates")
+    assert other.list() == []
+    template = registry.register("W-4", encode(blank_form(1)), KV_PAIRS, KV_OBJ)
+    assert [t.id for t in other.list()] == [template.id]
+    assert other.match(rescan(blank_form(1))).id == template.id
+
+    assert registry.delete(template.id)
+    assert other.list() == []
+    assert not other.delete(template.id)
+
+
+def test_pipeline_skips_ocr_on_a_template_match(registry, monkeypatch):
+    form = blank_form(1)
+    registry.register("W-4", encode(form), KV_PAIRS, KV_OBJ)
+    monkeypatch.setattr(pipeline, "template_registry", registry)
+
+    async def no_ocr(form_b):
+        raise AssertionError("OCR called")
+
+    monkeypatch.setattr(pipeline, "key_value_pairs_async", no_ocr)
+    scan = rescan(form)
+    form_b = PreprocessedImage(scan, "image/jpeg", difference_hash(scan)[1], "hash", None)
+    kv_pairs, kv_obj = asyncio.run(pipeline.form_b_fields_async(form_b))
+    assert kv_pairs == KV_PAIRS
+    assert kv_obj == KV_OBJ
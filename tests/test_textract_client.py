@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from quickfill.ocr.textract_client import TextractClient, TokenBucket
+
+IMAGE = b"fake image bytes"
+EXPECTED_PARAMS = {"Document": {"Bytes": IMAGE}, "FeatureTypes": ["TABLES", "FORMS"]}
+RESPONSE = {"Blocks": [{"Id": "1", "BlockType": "LINE", "Text": "hello"}]}
+
+
+@pytest.fixture
+def stubbed():
+    # Local stand-in for the Textract endpoint, no network calls are made
+    client = boto3.client("textract", region_name="us-east-1",
+                          aws_access_key_id="test", aws_secret_access_key="test")
+    with Stubber(client) as stubber:
+        yield client, stubber
+
+
+def _textract_client(client, **kwargs):
+    kwargs.setdefault("tps", 0)
+    return TextractClient(pool_size=1, base_delay=0.001, client_factory=lambda: client, **kwargs)
+
+
+def test_retries_throttling_then_succeeds(stubbed):
+    client, stubber = stubbed
+    stubber.add_client_error("analyze_document", "ThrottlingException", expected_params=EXPECTED_PARAMS)
+    stubber.add_client_error("analyze_document", "ProvisionedThroughputExceededException", expected_params=EXPECTED_PARAMS)
+    stubber.add_response("analyze_document", RESPONSE, EXPECTED_PARAMS)
+
+    textract = _textract_client(client)
+    assert textract.analyze_document(IMAGE) == RESPONSE
+    info = textract.metrics.info()
+    assert (info["requests"], info["retries"], info["throttled"], info["errors"]) == (3, 2, 2, 0)
+    assert info["in_flight"] == 0 and info["waiting"] == 0
+    stubber.assert_no_pending_responses()
+
+
+def test_gives_up_after_max_retries(stubbed):
+    client, stubber = stubbed
+    for _ in range(3):
+        stubber.add_client_error("analyze_document", "ThrottlingException")
+
+    textract = _textract_client(client, max_retries=2)
+    with pytest.raises(ClientError):
+        textract.analyze_document(IMAGE)
+    assert textract.metrics.info()["errors"] == 1
+
+
+def test_non_retryable_errors_are_raised_immediately(stubbed):
+    client, stubber = stubbed
+    stubber.add_client_error("analyze_document", "InvalidParameterException")
+
+    textract = _textract_client(client)
+    with pytest.raises(ClientError):
+        textract.analyze_document(IMAGE)
+    assert textract.metrics.info()["retries"] == 0
+
+
+def test_threads_share_one_client(stubbed):
+    client, stubber = stubbed
+    created = []
+
+    def factory():
+        created.append(client)
+        return client
+
+    for _ in range(3):
+        stubber.add_response("analyze_document", RESPONSE, EXPECTED_PARAMS)
+
+    textract = TextractClient(tps=0, client_factory=factory)
+
+    async def main():
+        for _ in range(3):
+            assert await textract.analyze_document_async(IMAGE) == RESPONSE
+
+    asyncio.run(main())
+    assert len(created) == 1
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.09
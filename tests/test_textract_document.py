@@ -0,0 +1,53 @@
+from quickfill.ocr.aws_text_extract import (extract_key_value_pairs,
+                                            extract_table_content,
+                                            get_text_from_response)
+from quickfill.ocr.document import TextractDocument
+
+
+def _box(left, top):
+    return {"BoundingBox": {"Left": left, "Top": top, "Width": 0.2, "Height": 0.05}}
+
+
+RESPONSE = {"Blocks": [
+    {"Id": "p", "BlockType": "PAGE", "Relationships": [{"Type": "CHILD", "Ids": ["l1", "l2"]}]},
+    {"Id": "l1", "BlockType": "LINE", "Text": "Name: Bob"},
+    {"Id": "l2", "BlockType": "LINE", "Text": "Married"},
+    {"Id": "w1", "BlockType": "WORD", "Text": "Name:"},
+    {"Id": "w2", "BlockType": "WORD", "Text": "Bob"},
+    {"Id": "w3", "BlockType": "WORD", "Text": "Married"},
+    {"Id": "s1", "BlockType": "SELECTION_ELEMENT", "SelectionStatus": "SELECTED"},
+    {"Id": "k1", "BlockType": "KEY_VALUE_SET", "EntityTypes": ["KEY"], "Geometry": _box(0.1, 0.1),
+     "Relationships": [{"Type": "VALUE", "Ids": ["v1"]}, {"Type": "CHILD", "Ids": ["w1"]}]},
+    {"Id": "v1", "BlockType": "KEY_VALUE_SET", "EntityTypes": ["VALUE"], "Geometry": _box(0.3, 0.1),
+     "Relationships": [{"Type": "CHILD", "Ids": ["w2"]}]},
+    {"Id": "k2", "BlockType": "KEY_VALUE_SET", "EntityTypes": ["KEY"], "Geometry": _box(0.1, 0.2),
+     "Relationships": [{"Type": "VALUE", "Ids": ["v2"]}, {"Type": "CHILD", "Ids": ["w3"]}]},
+    {"Id": "v2", "BlockType": "KEY_VALUE_SET", "EntityTypes": ["VALUE"], "Geometry": _box(0.3, 0.2),
+     "Relationships": [{"Type": "CHILD", "Ids": ["s1"]}]},
+    {"Id": "t1", "BlockType": "TABLE", "Relationships": [{"Type": "CHILD", "Ids": ["c3", "c1", "c2", "c4"]}]},
+    {"Id": "c1", "BlockType": "CELL", "RowIndex": 1, "ColumnIndex": 1, "Relationships": [{"Type": "CHILD", "Ids": ["w1"]}]},
+    {"Id": "c2", "BlockType": "CELL", "RowIndex": 1, "ColumnIndex": 2, "Relationships": [{"Type": "CHILD", "Ids": ["w2"]}]},
+    {"Id": "c3", "BlockType": "CELL", "RowIndex": 2, "ColumnIndex": 1, "Relationships": [{"Type": "CHILD", "Ids": ["w3"]}]},
+    {"Id": "c4", "BlockType": "CELL", "RowIndex": 2, "ColumnIndex": 2},
+]}
+
+
+def test_text_keeps_line_order():
+    assert get_text_from_response(RESPONSE) == "Name: Bob\nMarried\n"
+
+
+def test_key_value_pairs_and_geometry():
+    key_value_pairs, key_value_pairs_obj = extract_key_value_pairs(RESPONSE["Blocks"])
+    assert key_value_pairs == {"Name:": "Bob", "Married": "X"}
+    assert key_value_pairs_obj["Name:"] == {"BoundingBox": _box(0.3, 0.1)["BoundingBox"], "Value": ""}
+
+
+def test_tables_are_grouped_by_row_and_column():
+    assert extract_table_content(RESPONSE["Blocks"]) == [[["Name:", "Bob"], ["Married", ""]]]
+
+
+def test_document_index():
+    document = TextractDocument(RESPONSE)
+    assert document.by_id["w2"]["Text"] == "Bob"
+    assert [b["Id"] for b in document.child_blocks(document.by_id["p"])] == ["l1", "l2"]
+    assert len(document.blocks_of_type("KEY_VALUE_SET")) == 4
@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import io
+import tempfile
+
+import httpx
+import pytest
+from fastapi import FastAPI, UploadFile
+from PIL import Image
+from quickfill import upload as upload_module
+from quickfill.pdf.render import render_filled_pdf
+from quickfill.preprocess import preprocess_image
+from quickfill.upload import (UploadLimitMiddleware, UploadTooLarge,
+                              open_buffer, read_upload)
+
+
+class _AsyncFile:
+    def __init__(self, data, filename="scan.png"):
+        self._file = io.BytesIO(data)
+        self.filename = filename
+
+    async def read(self, size=-1):
+        return self._file.read(size)
+
+
+def _png(size=(640, 480)):
+    buffer = io.BytesIO()
+    Image.effect_noise(size, 64).convert("RGB").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_small_uploads_stay_in_memory():
+    data = _png((32, 32))
+    upload = asyncio.run(read_upload(_AsyncFile(data), spool_bytes=len(data)))
+    assert not upload.spooled
+    assert upload.data == data
+    assert upload.hash == hashlib.md5(data).hexdigest()
+
+
+def test_large_uploads_are_spooled_and_read_in_place():
+    data = _png()
+    upload = asyncio.run(read_upload(_AsyncFile(data), spool_bytes=1024))
+    assert upload.spooled
+    assert upload.size == len(data)
+    assert upload.data == data
+    assert upload.hash == hashlib.md5(data).hexdigest()
+
+    # Preprocessing and rendering read the view without copying it first
+    result = preprocess_image(upload.data, max_dimension=0, target_bytes=0, grayscale=False,
+                              image_hash=upload.hash)
+    assert result.data is upload.data
+    assert (result.mime, result.size, result.original_hash) == ("image/png", (640, 480), upload.hash)
+    assert result.data_hash == upload.hash  # The OCR cache key, not hashed again
+    assert render_filled_pdf(upload.data, {}, result.size).getvalue().startswith(b"%PDF")
+
+    reader = open_buffer(upload.data)
+    reader.seek(-4, io.SEEK_END)
+    assert reader.read() == data[-4:]
+
+
+def test_starlette_spooled_uploads_are_read_in_place(monkeypatch):
+    data = _png()
+    # Never read in chunks into a copy of our own
+    monkeypatch.setattr(upload_module, "_map_spool", None)
+    monkeypatch.setattr(UploadFile, "read", None)
+    spooled = tempfile.SpooledTemporaryFile(max_size=1024)
+    spooled.write(data)
+    upload = asyncio.run(read_upload(UploadFile(spooled, filename="scan.png"), spool_bytes=1024))
+    assert upload.spooled
+    assert upload.data == data
+    assert upload.hash == hashlib.md5(data).hexdigest()
+    spooled.close()
+    assert upload.data == data  # The mapping outlives the file
+
+    small = tempfile.SpooledTemporaryFile(max_size=1024)
+    small.write(b"x" * 100)
+    upload = asyncio.run(read_upload(UploadFile(small), spool_bytes=1024))
+    assert (upload.data, upload.spooled) == (b"x" * 100, False)
+
+
+def test_upload_size_limit():
+    with pytest.raises(UploadTooLarge):
+        asyncio.run(read_upload(_AsyncFile(b"x" * 2048), max_bytes=1024))
+    spooled = tempfile.SpooledTemporaryFile()
+    spooled.write(b"x" * 2048)
+    with pytest.raises(UploadTooLarge):
+        asyncio.run(read_upload(UploadFile(spooled), max_bytes=1024))
+
+
+def test_middleware_rejects_large_bodies_before_the_route():
+    app = FastAPI()
+    reached = []
+
+    @app.post("/upload")
+    async def upload(file: UploadFile):
+        reached.append(file.filename)
+        return {"size": (await read_upload(file)).size}
+
+    app.add_middleware(UploadLimitMiddleware, max_bytes=4096)
+
+    async def post(**kwargs):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.post("/upload", **kwargs)
+
+    assert asyncio.run(post(files={"file": ("a.bin", b"x" * 100)})).json() == {"size": 100}
+    # Declared by Content-Length
+    assert asyncio.run(post(files={"file": ("b.bin", b"x" * 8192)})).status_code == 413
+
+    # Chunked, without a Content-Length
+    async def body():
+        yield b"--boundary\r\nContent-Disposition: form-data; name=\"file\"; filename=\"c.bin\"\r\n\r\n"
+        for _ in range(8):
+            yield b"x" * 1024
+        yield b"\r\n--boundary--\r\n"
+
+    response = asyncio.run(post(content=body(), headers={"Content-Type": "multipart/form-data; boundary=boundary"}))
+    assert response.status_code == 413
+    assert reached == ["a.bin"]